@@ -1,9 +1,50 @@
 import os
+import re
+from datetime import timedelta
 from flask import Flask, request, abort, jsonify, request, render_template
+from flask import Response
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from auth import AuthError, requires_auth
-from models import setup_db, Actors, Movies, db_drop_and_create_all
+from auth import AuthError, requires_auth, check_permissions
+from models import setup_db, db, Actors, Movies, db_drop_and_create_all
+from models import movies_of_actors, actors_of_movies
+from models import assign_actor, unassign_actor
+from queries import parse_limit, parse_sort, parse_cursor, paginate
+from queries import wants_stream, stream_rows
+from queries import parse_fields, select_columns, rows_formatter
+from queries import parse_include, parse_since, changes_since
+from queries import parse_search, parse_search_cursor, search_rows
+from queries import parse_filters, check_sort
+from bulk import parse_bulk_body, validate_items, error_list
+from bulk import validate_movie, validate_actor, parse_bulk_ids
+from bulk import validate_movie_patch, validate_actor_patch
+from cache import response_cache
+from changes import changes
+from pool import pool_stats
+from routing import replicas
+from metrics import metrics
+from autocomplete import autocomplete
+
+
+# ?sort= fields and filter fields of GET /movies and GET /actors, every
+# filter field leads an index
+MOVIE_SORTS = ('id', 'title', 'release_date')
+MOVIE_FILTERS = ('id', 'title', 'release_date')
+ACTOR_SORTS = ('id', 'name', 'gender')
+ACTOR_FILTERS = ('id', 'name', 'gender')
+
+# ?tables= names of GET /changes
+CHANGE_TABLES = {
+    'movies': 'movies',
+    'actors': 'actors',
+    'castings': 'movie_actor_relationship'
+}
+
+# ?types= of GET /autocomplete, with the suggested column
+AUTOCOMPLETE_COLUMNS = {
+    'movies': (Movies, Movies.title),
+    'actors': (Actors, Actors.name)
+}
 
 
 def create_app(test_config=None):
@@ -11,6 +52,11 @@ def create_app(test_config=None):
 
     app = Flask(__name__)
     setup_db(app)
+    response_cache.init_app(app)
+    changes.init_app(app)
+    replicas.init_app(app)
+    metrics.init_app(app)
+    autocomplete.init_app(app)
     # uncomment this if you want to start a new database on app refresh
     # db_drop_and_create_all()
 
@@ -24,21 +70,83 @@ def create_app(test_config=None):
     def login():
         return render_template('login.html')
 
+    @app.route('/health')
+    def health():
+        return jsonify({
+            'success': True,
+            'database': pool_stats(db.engine),
+            'cache': response_cache.stats(),
+            'changes': changes.feed.stats(),
+            'replicas': replicas.stats(app),
+            'autocomplete': autocomplete.stats()
+        })
+
+    @app.route('/metrics')
+    def get_metrics():
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+
     @app.route('/movies')
     @requires_auth('read:movies')
+    @response_cache.cached('movies',
+                           include=('movie_actor_relationship', 'actors'),
+                           bypass=('since',))
+    @replicas.read_only
     def get_all_movies(payload):
+        limit = parse_limit(app.config['PAGE_SIZE'],
+                            app.config['MAX_PAGE_SIZE'])
+        spec, keys = parse_sort(Movies, MOVIE_SORTS)
+        filters, equal = parse_filters(Movies, MOVIE_FILTERS)
+        check_sort(Movies, keys, equal)
+        fields = parse_fields(Movies)
+        include = parse_include(('actors',))
+        format_rows = rows_formatter(fields, include, actors_of_movies)
+        since = parse_since(timedelta(
+            days=app.config['TOMBSTONE_RETENTION_DAYS']))
+        if since is not None:
+            # a row leaving the filter would never be reported
+            if filters:
+                abort(400)
+            return sync(
+                Movies, 'movies', fields, since, limit, format_rows)
+        query = select_columns(Movies, fields, keys).filter(*filters)
+        if wants_stream():
+            return stream_rows(query, keys, 'movies', format_rows,
+                               app.config['STREAM_BATCH_SIZE'])
+        after = parse_cursor(spec, keys)
+
         try:
-            movies = Movies.query.all()
-            movies = [movie.format() for movie in movies]
-            return jsonify
-            ({
+            movies, next_cursor = paginate(query, spec, keys, limit, after)
+            movies = format_rows(movies)
+            return jsonify({
               'success': True,
-              'movies': movies
-            }
-            )
+              'movies': movies,
+              'next': next_cursor
+            })
         except Exception:
             abort(422)
 
+    @app.route('/movies/search')
+    @requires_auth('read:movies')
+    @response_cache.cached('movies')
+    @replicas.read_only
+    def search_movies(payload):
+        return search(Movies, 'movies', Movies.title)
+
+    @app.route('/movies/<int:movie_id>')
+    @requires_auth('read:movies')
+    @response_cache.cached('movies')
+    @replicas.read_only
+    def get_movie(payload, movie_id):
+        movie = Movies.query.filter_by(id=movie_id).first()
+        if not movie:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'movie': movie.format()
+        })
+
     @app.route('/movies', methods=['POST'])
     @requires_auth('write:movies')
     def add_movie(payload):
@@ -60,6 +168,33 @@ def create_app(test_config=None):
         except Exception:
             abort(422)
 
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('write:movies')
+    def add_movies(payload):
+        on_conflict = request.args.get('on_conflict', 'skip')
+        if on_conflict not in ('skip', 'update'):
+            abort(400)
+        items, errors = parse_bulk_body(app.config['MAX_BULK_SIZE'])
+        indexes, rows = validate_items(items, errors, validate_movie,
+                                       unique='title')
+        if not rows:
+            return bulk_rejected(errors)
+
+        try:
+            ids = Movies.bulk_insert(rows, on_conflict)
+        except Exception:
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'movies': [{'index': index, 'id': movie_id}
+                       for index, movie_id in zip(indexes, ids)
+                       if movie_id is not None],
+            'skipped': [index for index, movie_id in zip(indexes, ids)
+                        if movie_id is None],
+            'errors': error_list(errors)
+        }), 201
+
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('update:movies')
     def edit_movie(payload, movie_id):
@@ -109,19 +244,183 @@ def create_app(test_config=None):
         except Exception:
             abort(422)
 
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth('update:movies')
+    def edit_movies(payload):
+        items, errors = parse_bulk_body(app.config['MAX_BULK_SIZE'])
+        indexes, patches = validate_items(items, errors,
+                                          validate_movie_patch,
+                                          unique=('id', 'title'))
+        conflicts = Movies.title_conflicts(patches)
+        for index, patch in zip(indexes, patches):
+            if patch['id'] in conflicts:
+                errors[index] = 'title already exists'
+        patches = [patch for patch in patches
+                   if patch['id'] not in conflicts]
+        if not patches:
+            return bulk_rejected(errors)
+
+        try:
+            updated = Movies.bulk_update(patches)
+        except Exception:
+            abort(422)
+
+        updated = set(updated)
+        return jsonify({
+            'success': True,
+            'updated': sorted(updated),
+            'not_found': [patch['id'] for patch in patches
+                          if patch['id'] not in updated],
+            'errors': error_list(errors)
+        }), 200
+
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @requires_auth('delete:movies')
+    def delete_movies(payload):
+        ids = parse_bulk_ids(app.config['MAX_BULK_SIZE'])
+
+        try:
+            deleted = set(Movies.bulk_delete(ids))
+        except Exception:
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'deleted': sorted(deleted),
+            'not_found': [id for id in ids if id not in deleted]
+        }), 200
+
+    @app.route('/movies/<int:movie_id>/actors')
+    @requires_auth('read:actors')
+    @response_cache.cached('movies', 'movie_actor_relationship', 'actors')
+    @replicas.read_only
+    def get_movie_actors(payload, movie_id):
+        if not Movies.query.filter_by(id=movie_id).count():
+            abort(404)
+
+        try:
+            return jsonify({
+                'success': True,
+                'movie': movie_id,
+                'actors': actors_of_movies([movie_id])[movie_id]
+            })
+        except Exception:
+            abort(422)
+
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>',
+               methods=['PUT'])
+    @requires_auth('update:movies')
+    def assign_movie_actor(payload, movie_id, actor_id):
+        if not Movies.query.filter_by(id=movie_id).count():
+            abort(404)
+        if not Actors.query.filter_by(id=actor_id).count():
+            abort(404)
+
+        try:
+            created = assign_actor(movie_id, actor_id)
+            return jsonify({
+                'success': True,
+                'movie': movie_id,
+                'actor': actor_id
+            }), 201 if created else 200
+        except Exception:
+            abort(422)
+
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>',
+               methods=['DELETE'])
+    @requires_auth('update:movies')
+    def unassign_movie_actor(payload, movie_id, actor_id):
+        try:
+            removed = unassign_actor(movie_id, actor_id)
+        except Exception:
+            abort(422)
+        if not removed:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'movie': movie_id,
+            'actor': actor_id
+        }), 200
+
     @app.route('/actors')
     @requires_auth('read:actors')
+    @response_cache.cached('actors',
+                           include=('movie_actor_relationship', 'movies'),
+                           bypass=('since',))
+    @replicas.read_only
     def get_all_actors(payload):
+        limit = parse_limit(app.config['PAGE_SIZE'],
+                            app.config['MAX_PAGE_SIZE'])
+        spec, keys = parse_sort(Actors, ACTOR_SORTS)
+        filters, equal = parse_filters(Actors, ACTOR_FILTERS)
+        check_sort(Actors, keys, equal)
+        fields = parse_fields(Actors)
+        include = parse_include(('movies',))
+        format_rows = rows_formatter(fields, include, movies_of_actors)
+        since = parse_since(timedelta(
+            days=app.config['TOMBSTONE_RETENTION_DAYS']))
+        if since is not None:
+            # a row leaving the filter would never be reported
+            if filters:
+                abort(400)
+            return sync(
+                Actors, 'actors', fields, since, limit, format_rows)
+        query = select_columns(Actors, fields, keys).filter(*filters)
+        if wants_stream():
+            return stream_rows(query, keys, 'actors', format_rows,
+                               app.config['STREAM_BATCH_SIZE'])
+        after = parse_cursor(spec, keys)
+
         try:
-            actors = Actors.query.all()
-            actors = [actor.format() for actor in actors]
+            actors, next_cursor = paginate(query, spec, keys, limit, after)
+            actors = format_rows(actors)
             return jsonify({
                 'success': True,
-                'actors': actors
+                'actors': actors,
+                'next': next_cursor
             })
         except Exception:
             abort(422)
 
+    @app.route('/actors/search')
+    @requires_auth('read:actors')
+    @response_cache.cached('actors')
+    @replicas.read_only
+    def search_actors(payload):
+        return search(Actors, 'actors', Actors.name)
+
+    @app.route('/actors/<int:actor_id>/movies')
+    @requires_auth('read:movies')
+    @response_cache.cached('actors', 'movie_actor_relationship', 'movies')
+    @replicas.read_only
+    def get_actor_movies(payload, actor_id):
+        if not Actors.query.filter_by(id=actor_id).count():
+            abort(404)
+
+        try:
+            return jsonify({
+                'success': True,
+                'actor': actor_id,
+                'movies': movies_of_actors([actor_id])[actor_id]
+            })
+        except Exception:
+            abort(422)
+
+    @app.route('/actors/<int:actor_id>')
+    @requires_auth('read:actors')
+    @response_cache.cached('actors')
+    @replicas.read_only
+    def get_actor(payload, actor_id):
+        actor = Actors.query.filter_by(id=actor_id).first()
+        if not actor:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'actor': actor.format()
+        })
+
     @app.route('/actors', methods=['POST'])
     @requires_auth('write:actors')
     def add_actor(payload):
@@ -144,6 +443,26 @@ def create_app(test_config=None):
         except Exception:
             abort(422)
 
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('write:actors')
+    def add_actors(payload):
+        items, errors = parse_bulk_body(app.config['MAX_BULK_SIZE'])
+        indexes, rows = validate_items(items, errors, validate_actor)
+        if not rows:
+            return bulk_rejected(errors)
+
+        try:
+            ids = Actors.bulk_insert(rows)
+        except Exception:
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'actors': [{'index': index, 'id': actor_id}
+                       for index, actor_id in zip(indexes, ids)],
+            'errors': error_list(errors)
+        }), 201
+
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('update:actors')
     def edit_actor(payload, actor_id):
@@ -192,6 +511,129 @@ def create_app(test_config=None):
         except Exception:
             abort(422)
 
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth('update:actors')
+    def edit_actors(payload):
+        items, errors = parse_bulk_body(app.config['MAX_BULK_SIZE'])
+        indexes, patches = validate_items(items, errors,
+                                          validate_actor_patch,
+                                          unique='id')
+        if not patches:
+            return bulk_rejected(errors)
+
+        try:
+            updated = Actors.bulk_update(patches)
+        except Exception:
+            abort(422)
+
+        updated = set(updated)
+        return jsonify({
+            'success': True,
+            'updated': sorted(updated),
+            'not_found': [patch['id'] for patch in patches
+                          if patch['id'] not in updated],
+            'errors': error_list(errors)
+        }), 200
+
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @requires_auth('delete:actors')
+    def delete_actors(payload):
+        ids = parse_bulk_ids(app.config['MAX_BULK_SIZE'])
+
+        try:
+            deleted = set(Actors.bulk_delete(ids))
+        except Exception:
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'deleted': sorted(deleted),
+            'not_found': [id for id in ids if id not in deleted]
+        }), 200
+
+    @app.route('/autocomplete')
+    @requires_auth()
+    def get_autocomplete(payload):
+        prefix = request.args.get('prefix', '').strip()
+        types = request.args.get('types', 'movies,actors')
+        types = set(name.strip() for name in types.split(','))
+        if not prefix or not types <= set(AUTOCOMPLETE_COLUMNS):
+            abort(400)
+        for name in types:
+            check_permissions(f'read:{name}', payload)
+        limit = parse_limit(app.config['AUTOCOMPLETE_LIMIT'],
+                            app.config['AUTOCOMPLETE_MAX_LIMIT'])
+
+        response = {'success': True}
+        for name in sorted(types):
+            model, column = AUTOCOMPLETE_COLUMNS[name]
+            found = autocomplete.lookup(name, prefix, limit)
+            if found is None:
+                # the index isn't read yet or is full, ask the database
+                words = re.findall(r'\w+', prefix)
+                try:
+                    found = search_rows(model, column, ('id', column.key),
+                                        words, limit)[0] if words else []
+                except Exception:
+                    abort(422)
+            response[name] = [{'id': id, column.key: text}
+                              for id, text in found]
+        return jsonify(response)
+
+    @app.route('/changes')
+    @requires_auth('read:movies')
+    def get_changes(payload):
+        check_permissions('read:actors', payload)
+        tables = request.args.get('tables', 'movies,actors,castings')
+        tables = set(name.strip() for name in tables.split(','))
+        if not tables or not tables <= set(CHANGE_TABLES):
+            abort(400)
+        return changes.stream(
+            set(CHANGE_TABLES[name] for name in tables),
+            request.headers.get('Last-Event-ID'))
+
+    def sync(model, name, fields, since, limit, format_rows):
+        # a lagging replica could hide rows the cursor then moves past
+        replicas.use_primary()
+        settle = timedelta(seconds=app.config['SYNC_SETTLE_SECONDS'])
+        try:
+            rows, deleted, next_since, more = changes_since(
+                model, fields, since, limit, settle)
+            return jsonify({
+                'success': True,
+                name: format_rows(rows),
+                'deleted': deleted,
+                'next': next_since,
+                'more': more
+            })
+        except Exception:
+            abort(422)
+
+    def search(model, name, searched):
+        limit = parse_limit(app.config['PAGE_SIZE'],
+                            app.config['MAX_PAGE_SIZE'])
+        words = parse_search()
+        fields = parse_fields(model)
+        after = parse_search_cursor(words)
+        try:
+            rows, next_cursor = search_rows(
+                model, searched, fields, words, limit, after)
+            return jsonify({
+                'success': True,
+                name: rows_formatter(fields)(rows),
+                'next': next_cursor
+            })
+        except Exception:
+            abort(422)
+
+    def bulk_rejected(errors):
+        return jsonify({
+            "success": False,
+            "error": 400,
+            "message": "bad request",
+            "errors": error_list(errors)
+        }), 400
+
     @app.errorhandler(400)
     def bad_request(error):
         return jsonify({
@@ -216,6 +658,22 @@ def create_app(test_config=None):
             "message": "duplicate"
         }), 409
 
+    @app.errorhandler(410)
+    def gone(error):
+        return jsonify({
+            "success": False,
+            "error": 410,
+            "message": "gone"
+        }), 410
+
+    @app.errorhandler(413)
+    def too_large(error):
+        return jsonify({
+            "success": False,
+            "error": 413,
+            "message": "payload too large"
+        }), 413
+
     @app.errorhandler(422)
     def unprocessable(error):
         return jsonify({
@@ -235,9 +693,8 @@ def create_app(test_config=None):
     return app
 
 
-# create the app as set above
-app = create_app()
-
+# the app is only created when served, importing this module (gunicorn
+# workers, manage.py, tests) stays cheap: gunicorn 'app:create_app()'
 # run the app with http://0.0.0.0:8080
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=True)
+    create_app().run(host='0.0.0.0', port=8080, debug=True)
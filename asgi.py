@@ -0,0 +1,170 @@
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import auth
+from app import create_app
+
+
+'''
+ASGI entry point
+
+    serves the Flask app, every route and error handler included, from an
+        asyncio event loop: `uvicorn --factory asgi:create_asgi_app`
+    the event loop holds the connections (keep-alive, slow clients) and
+        reads the request bodies; the views run on a pool of ASGI_THREADS
+        threads, one per pooled database connection by default, so a
+        request never waits in a thread for a connection
+    SQLAlchemy 1.3 and the models have no async API, the database calls
+        run on those threads like they do under gunicorn
+    the Auth0 signing keys are fetched off the event loop when the server
+        starts, the first authenticated request doesn't wait for them
+    streamed responses (?stream=1 dumps, GET /changes) are sent chunk by
+        chunk and closed when the client goes away
+'''
+
+
+class WsgiToAsgi(object):
+    def __init__(self, wsgi_app, threads):
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+        self.executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError(f'unsupported scope {scope["type"]!r}')
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                asyncio.get_running_loop().run_in_executor(
+                    self.executor, warm_jwks)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.threads,
+                                               thread_name_prefix='asgi')
+
+    async def http(self, scope, receive, send):
+        self.start()
+        loop = asyncio.get_running_loop()
+        body = io.BytesIO()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.write(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        length = body.tell()
+        body.seek(0)
+
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        def call():
+            # the app and its first chunk run in one hop to the threads
+            iterable = self.wsgi_app(environ(scope, body, length),
+                                     start_response)
+            iterator = iter(iterable)
+            return iterable, iterator, next(iterator, None)
+
+        iterable, iterator, chunk = await loop.run_in_executor(
+            self.executor, call)
+        disconnected = asyncio.ensure_future(wait_disconnect(receive))
+        try:
+            status, headers = started
+            await send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'),
+                             value.encode('latin-1'))
+                            for name, value in headers]
+            })
+            while chunk is not None and not disconnected.done():
+                if chunk:
+                    await send({'type': 'http.response.body',
+                                'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(
+                    self.executor, next, iterator, None)
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            if hasattr(iterable, 'close'):
+                await loop.run_in_executor(self.executor, iterable.close)
+
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def environ(scope, body, length):
+    """returns the WSGI environ of an ASGI http scope, body holds the
+    length bytes of the request body
+    """
+    server = scope.get('server') or ('localhost', 80)
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    # the ASGI path includes the root_path, PATH_INFO is what follows it
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    # the body is read whole, chunked uploads included
+    environ['CONTENT_LENGTH'] = str(length)
+    return environ
+
+
+def warm_jwks():
+    try:
+        auth.jwks_cache.refresh()
+    except auth.AuthError:
+        # the first request retries, after JWKS_MIN_REFRESH_INTERVAL
+        pass
+
+
+def create_asgi_app():
+    """returns the ASGI application of a new Flask app"""
+    app = create_app()
+    threads = app.config['ASGI_THREADS'] or (
+        app.config['DB_POOL_SIZE'] + app.config['DB_MAX_OVERFLOW'])
+    return WsgiToAsgi(app, threads)
@@ -1,13 +1,39 @@
+import base64
+import binascii
+import hashlib
 import json
+import threading
+import time
+from collections import OrderedDict
 from flask import request, _request_ctx_stack, abort
 from functools import wraps
-from jose import jwt
 from urllib.request import urlopen
 import os
-
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
-ALGORITHMS = os.environ['ALGORITHMS']
-API_AUDIENCE = os.environ['API_AUDIENCE']
+from metrics import timed
+
+# read with .get() so importing auth needs no environment, a missing
+# setting fails the first request instead (503 jwks_unavailable)
+AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
+ALGORITHMS = os.environ.get('ALGORITHMS')
+API_AUDIENCE = os.environ.get('API_AUDIENCE')
+
+# JWKS cache settings, all durations in seconds
+# JWKS_URL may point at a local file:// or stub server for offline tests
+JWKS_URL = os.environ.get('JWKS_URL',
+                          f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+JWKS_STALE_TTL = int(os.environ.get('JWKS_STALE_TTL', 3600))
+JWKS_MIN_REFRESH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+
+# number of verified tokens kept in memory
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
+# rejected tokens are remembered for REJECTED_TOKEN_TTL seconds
+REJECTED_TOKEN_CACHE_SIZE = int(
+    os.environ.get('REJECTED_TOKEN_CACHE_SIZE', 4096))
+REJECTED_TOKEN_TTL = int(os.environ.get('REJECTED_TOKEN_TTL', 30))
 
 # AuthError Exception
 '''
@@ -22,6 +48,298 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# JWKS key store
+'''
+JWKSCache
+    process-wide store of the Auth0 signing keys
+    the key set is fetched once and every key is parsed into an RSA key
+        object kept by its kid
+    keys are fresh for ttl seconds, after that they are served stale for up
+        to stale_ttl more seconds while one background refresh runs
+    a kid that is not in the store forces a refresh
+    every refresh, in the background or not, is attempted at most once
+        every min_refresh_interval seconds, so an unreachable Auth0 costs
+        one fetch timeout per interval, not one per request
+    only one thread fetches at a time, the others wait and reuse its result
+    a failed fetch keeps serving the keys already held until they are
+        ttl + stale_ttl seconds old; past that, requests fail with 503
+        until a fetch succeeds
+'''
+
+
+class JWKSCache(object):
+    def __init__(self, url, ttl=JWKS_CACHE_TTL, stale_ttl=JWKS_STALE_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT, clock=time.monotonic):
+        self.url = url
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.clock = clock
+        self.keys = {}
+        self.fetched_at = None
+        self.attempted_at = None
+        self.attempts = 0
+        self.fetches = 0
+        self._lock = threading.Lock()
+
+    def get_key(self, kid):
+        """returns the parsed key for kid, or None if Auth0 has no such key
+        """
+        now = self.clock()
+        if self._usable(now):
+            key = self.keys.get(kid)
+            if key is not None:
+                if now - self.fetched_at >= self.ttl and self._due(now):
+                    self._refresh_in_background()
+                return key
+
+        if self._due(now):
+            self.refresh()
+        elif not self._usable(now):
+            raise self._unavailable()
+        return self.keys.get(kid)
+
+    def has_key(self, kid):
+        """returns True if kid is held and not past the stale window"""
+        return kid in self.keys and self._usable(self.clock())
+
+    def refresh(self):
+        """fetches the key set, unless another thread did so while this
+        one was waiting for the lock
+        """
+        attempts = self.attempts
+        with self._lock:
+            if self.attempts != attempts:
+                return
+            self._refresh_locked()
+
+        if not self._usable(self.clock()):
+            raise self._unavailable()
+
+    def clear(self):
+        """drops every key, the next lookup fetches the key set again
+        """
+        with self._lock:
+            self.keys = {}
+            self.fetched_at = None
+            self.attempted_at = None
+
+    def _usable(self, now):
+        return (self.fetched_at is not None and
+                now - self.fetched_at < self.ttl + self.stale_ttl)
+
+    def _due(self, now):
+        return (self.attempted_at is None or
+                now - self.attempted_at >= self.min_refresh_interval)
+
+    @staticmethod
+    def _unavailable():
+        return AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys.'
+        }, 503)
+
+    def _refresh_in_background(self):
+        if not self._lock.acquire(blocking=False):
+            return
+        # closes the gate before the thread starts
+        self.attempted_at = self.clock()
+
+        def run():
+            try:
+                self._refresh_locked()
+            finally:
+                self._lock.release()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _refresh_locked(self):
+        self.attempts += 1
+        self.attempted_at = self.clock()
+        try:
+            keys = self._fetch()
+        except Exception:
+            return
+        self.keys = keys
+        self.fetched_at = self.clock()
+
+    def _fetch(self):
+        # jose and its RSA backend are imported when first needed, they
+        # are a noticeable part of the import time of the app
+        from jose import jwk
+        jsonurl = urlopen(self.url, timeout=self.timeout)
+        jwks = json.loads(jsonurl.read())
+        self.fetches += 1
+
+        keys = {}
+        for key in jwks['keys']:
+            if key.get('kty') != 'RSA' or 'kid' not in key:
+                continue
+            rsa_key = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use'),
+                'n': key['n'],
+                'e': key['e']
+            }
+            keys[key['kid']] = jwk.construct(rsa_key,
+                                             key.get('alg', 'RS256'))
+        return keys
+
+
+jwks_cache = JWKSCache(JWKS_URL)
+
+
+# Verified token cache
+'''
+TokenCache
+    bounded LRU of tokens that passed verify_decode_jwt, keyed by the
+        sha256 digest of the token
+    an entry is dropped when the token expires or when its signing key is
+        no longer in the JWKS cache
+    hits and misses are counted, see stats()
+'''
+
+
+class VerifiedToken(object):
+    __slots__ = ('payload', 'permissions', 'kid', 'expires_at')
+
+    def __init__(self, payload, kid):
+        self.payload = payload
+        self.kid = kid
+        self.expires_at = payload.get('exp', 0)
+        if 'permissions' in payload:
+            self.permissions = frozenset(payload['permissions'])
+        else:
+            self.permissions = None
+
+
+class TokenCache(object):
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, keys=jwks_cache,
+                 clock=time.time):
+        self.maxsize = maxsize
+        self.keys = keys
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        """returns the VerifiedToken for token, or None on a miss
+        """
+        digest = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                if (entry.expires_at > self.clock() and
+                        self.keys.has_key(entry.kid)):
+                    self._entries.move_to_end(digest)
+                    self.hits += 1
+                    return entry
+                del self._entries[digest]
+            self.misses += 1
+            return None
+
+    def put(self, token, entry):
+        if self.maxsize <= 0:
+            return
+        digest = self.digest(token)
+        with self._lock:
+            self._entries[digest] = entry
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """returns the cache counters"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+
+token_cache = TokenCache()
+
+
+# Rejected token cache
+'''
+RejectedTokenCache
+    bounded LRU of tokens that failed verification, keyed by the sha256
+        digest of the token
+    the AuthError is replayed for ttl seconds without touching the JWKS
+        cache or the RSA verify
+    failures to reach Auth0 (503) are not remembered
+'''
+
+
+class RejectedTokenCache(object):
+    def __init__(self, maxsize=REJECTED_TOKEN_CACHE_SIZE,
+                 ttl=REJECTED_TOKEN_TTL, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, token):
+        """raises the remembered AuthError if token was rejected recently
+        """
+        digest = TokenCache.digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return
+            expires_at, error, status_code = entry
+            if expires_at <= self.clock():
+                del self._entries[digest]
+                return
+            self.hits += 1
+        raise AuthError(error, status_code)
+
+    def put(self, token, auth_error):
+        if self.maxsize <= 0 or auth_error.status_code >= 500:
+            return
+        digest = TokenCache.digest(token)
+        with self._lock:
+            self._entries[digest] = (self.clock() + self.ttl,
+                                     auth_error.error,
+                                     auth_error.status_code)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """returns the cache counters"""
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits
+        }
+
+
+rejected_token_cache = RejectedTokenCache()
+
+
 # Auth Header
 '''
     get the header from the request
@@ -60,6 +378,7 @@ def get_token_auth_header():
     @INPUTS
         permission: string permission (i.e. 'post:drink')
         payload: decoded jwt payload
+        permissions: optional precomputed set of the payload permissions
     raise an AuthError if permissions are not included in the payload
     raise an AuthError if the requested permission string is not in the
         payload permissions array
@@ -67,10 +386,12 @@ def get_token_auth_header():
 '''
 
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        abort(400)
-    if permission not in payload['permissions']:
+def check_permissions(permission, payload, permissions=None):
+    if permissions is None:
+        if 'permissions' not in payload:
+            abort(400)
+        permissions = payload['permissions']
+    if permission not in permissions:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission Not found',
@@ -82,7 +403,8 @@ def check_permissions(permission, payload):
     @INPUTS
         token: a json web token (string)
     Auth0 token with key id (kid)
-    verify the token using Auth0 /.well-known/jwks.json
+    look up the signing key in the JWKS cache
+    verify the token using the cached Auth0 /.well-known/jwks.json key
     decode the payload from the token
     validate the claims
     return the decoded payload
@@ -90,9 +412,7 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-
+    from jose import jwt
     # Get the data in the header
     unverified_header = jwt.get_unverified_header(token)
 
@@ -103,21 +423,10 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed'
         }, 401)
 
-    rsa_key = {}
-
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-            break
+    rsa_key = jwks_cache.get_key(unverified_header['kid'])
 
     # verify the token
-    if rsa_key:
+    if rsa_key is not None:
         try:
             # Validate the token using the rsa_key
             payload = jwt.decode(
@@ -157,11 +466,90 @@ def verify_decode_jwt(token):
     }, 400)
 
 
+'''
+    @INPUTS
+        token: a json web token (string)
+    cheap structural checks that run before any network or crypto work
+    raise an AuthError if the token is not three base64url segments
+    raise an AuthError if the header has no key id (kid)
+    raise an AuthError if the unverified exp claim is already in the past
+    return the unverified header
+'''
+
+
+def _b64_json(segment):
+    padded = segment + '=' * (-len(segment) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+
+
+def precheck_token(token):
+    segments = token.split('.')
+    if len(segments) != 3 or not all(segments):
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization malformed'
+        }, 401)
+
+    try:
+        header = _b64_json(segments[0])
+        claims = _b64_json(segments[1])
+    except (ValueError, UnicodeError, binascii.Error):
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
+
+    if not isinstance(header, dict) or 'kid' not in header:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization malformed'
+        }, 401)
+
+    exp = claims.get('exp') if isinstance(claims, dict) else None
+    if isinstance(exp, (int, float)) and exp < time.time():
+        raise AuthError({
+            'code': 'token_expired',
+            'description': 'Token expired.'
+        }, 401)
+
+    return header
+
+
+'''
+    @INPUTS
+        token: a json web token (string)
+    return the cached VerifiedToken for the token
+    replay the AuthError of a recently rejected token
+    on a cache miss run precheck_token, then verify_decode_jwt
+    remember the AuthError if the token is rejected
+    tokens without an exp claim are verified every time
+'''
+
+
+def verify_token(token):
+    entry = token_cache.get(token)
+    if entry is not None:
+        return entry
+
+    rejected_token_cache.check(token)
+    try:
+        header = precheck_token(token)
+        payload = verify_decode_jwt(token)
+    except AuthError as error:
+        rejected_token_cache.put(token, error)
+        raise
+
+    entry = VerifiedToken(payload, header['kid'])
+    if 'exp' in payload:
+        token_cache.put(token, entry)
+    return entry
+
+
 '''
     @INPUTS
         permission: string permission (i.e. 'post:drink')
     use the get_token_auth_header method to get the token
-    use the verify_decode_jwt method to decode the jwt
+    use the verify_token method to decode the jwt
     use the check_permissions method validate claims and
         check the requested permission
     return the decorator which passes the decoded payload
@@ -173,9 +561,15 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            with timed('auth_header'):
+                token = get_token_auth_header()
+            with timed('verify_jwt'):
+                verified = verify_token(token)
+            with timed('permissions'):
+                # no permission: any valid token, the view checks the rest
+                if permission:
+                    check_permissions(permission, verified.payload,
+                                      verified.permissions)
+            return f(verified.payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
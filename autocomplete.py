@@ -0,0 +1,260 @@
+import logging
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+from flask import current_app, has_app_context
+from models import db, on_change, Movies, Actors
+
+
+logger = logging.getLogger('casting.autocomplete')
+
+
+'''
+Prefix autocomplete for GET /autocomplete
+
+    every worker keeps an index of movies.title and actors.name in memory:
+        a sorted array of (key, id), the keys of a name being the name and
+        what follows each of its spaces, lowercased and without accents,
+        so "pi" finds "Brad Pitt"; a lookup is a binary search and a scan
+        of the matches, without a database round trip
+    the indexes are read with a streamed query in a background thread when
+        the worker serves its first request, and again once they are older
+        than AUTOCOMPLETE_REFRESH_SECONDS, to pick up the writes of the
+        other workers; until then those writes are not suggested, and
+        every read is of the whole table, in every worker
+    a read is started at most once every AUTOCOMPLETE_RETRY_SECONDS per
+        index, so a database that fails the read isn't asked again by
+        every request
+    the writes of this worker are applied as they are committed, through
+        models.on_change; the ones committed while an index is read are
+        applied once it is
+    an index holds at most AUTOCOMPLETE_MAX_ENTRIES keys, names of at most
+        80 characters each; an index that would need more stops taking
+        names and is not used
+    until an index is read, or when it is full, GET /autocomplete runs the
+        search query of queries.py instead
+'''
+
+
+def normalize(text):
+    """returns text lowercased, without accents and with single spaces"""
+    decomposed = unicodedata.normalize('NFKD', text)
+    stripped = ''.join(character for character in decomposed
+                       if not unicodedata.combining(character))
+    return ' '.join(stripped.casefold().split())
+
+
+def name_keys(name):
+    """returns the keys of name: the name from each of its words on"""
+    words = normalize(name).split(' ')
+    return list(dict.fromkeys(' '.join(words[start:])
+                              for start in range(len(words))))
+
+
+class PrefixIndex(object):
+    '''the names of one column by id, with their keys in a sorted array'''
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.full = False
+        self._entries = []
+        self._names = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, rows, max_entries):
+        """returns the index of the (id, name) rows, sorted once"""
+        index = cls(max_entries)
+        for id, name in rows:
+            keys = name_keys(name)
+            if len(index._entries) + len(keys) > max_entries:
+                index.full = True
+                break
+            index._names[id] = name
+            index._entries.extend((key, id) for key in keys)
+        index._entries.sort()
+        return index
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, id, name):
+        """indexes name under id, in place of its previous name"""
+        with self._lock:
+            self._remove(id)
+            keys = name_keys(name)
+            if len(self._entries) + len(keys) > self.max_entries:
+                self.full = True
+                return
+            self._names[id] = name
+            for key in keys:
+                entry = (key, id)
+                self._entries.insert(bisect_left(self._entries, entry),
+                                     entry)
+
+    def remove(self, id):
+        with self._lock:
+            self._remove(id)
+
+    def _remove(self, id):
+        name = self._names.pop(id, None)
+        if name is None:
+            return
+        for key in name_keys(name):
+            del self._entries[bisect_left(self._entries, (key, id))]
+
+    def lookup(self, prefix, limit):
+        """returns [(id, name)] of the first limit names in key order with
+        a key starting with prefix
+        """
+        prefix = normalize(prefix)
+        found = {}
+        with self._lock:
+            position = bisect_left(self._entries, (prefix,))
+            while (len(found) < limit and position < len(self._entries) and
+                   self._entries[position][0].startswith(prefix)):
+                id = self._entries[position][1]
+                found.setdefault(id, self._names[id])
+                position += 1
+        return list(found.items())
+
+
+class TableIndex(object):
+    '''the PrefixIndex of one column, read again when it gets old'''
+    def __init__(self, model, column, max_entries):
+        self.model = model
+        self.column = column
+        self.max_entries = max_entries
+        self.index = None
+        self.built_at = None
+        self.attempted_at = None
+        # writes committed while the index is read, None when not reading
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def due(self, seconds, retry_seconds):
+        """returns True, to one caller, if the index should be read: it is
+        missing or older than seconds, isn't being read, and no read was
+        started in the last retry_seconds
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._pending is not None or (
+                    self.attempted_at is not None and
+                    now - self.attempted_at < retry_seconds):
+                return False
+            if self.built_at is not None and now - self.built_at <= seconds:
+                return False
+            self.attempted_at = now
+            return True
+
+    def build(self, batch_size):
+        """reads the index from the database, in batches of batch_size"""
+        with self._lock:
+            if self._pending is not None:
+                return
+            self._pending = []
+            self.attempted_at = time.monotonic()
+        try:
+            index = PrefixIndex.build(
+                db.session.query(self.model.id, self.column)
+                .yield_per(batch_size), self.max_entries)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            for action, rows in self._pending:
+                self._apply(index, action, rows)
+            self.index = index
+            self.built_at = time.monotonic()
+            self._pending = None
+
+    def apply(self, action, rows):
+        """applies a committed write to the index"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((action, rows))
+            index = self.index
+        if index is not None:
+            self._apply(index, action, rows)
+
+    def _apply(self, index, action, rows):
+        for row in rows:
+            if action == 'delete':
+                index.remove(row['id'])
+            elif self.column.key in row:
+                index.add(row['id'], row[self.column.key])
+
+
+class Autocomplete(object):
+    def init_app(self, app):
+        max_entries = app.config['AUTOCOMPLETE_MAX_ENTRIES']
+        app.extensions['autocomplete'] = {
+            'movies': TableIndex(Movies, Movies.title, max_entries),
+            'actors': TableIndex(Actors, Actors.name, max_entries)
+        }
+        if app.config['AUTOCOMPLETE_BACKGROUND_BUILD']:
+            app.before_first_request(lambda: self.start(app))
+
+    @property
+    def indexes(self):
+        # like the models, fall back to the app bound by setup_db
+        app = current_app if has_app_context() else db.app
+        if app is None:
+            return {}
+        return app.extensions.get('autocomplete', {})
+
+    def start(self, app, tables=None):
+        """reads the indexes of app in a background thread"""
+        def run():
+            try:
+                self.refresh(app, tables)
+            except Exception:
+                logger.exception('reading the autocomplete index failed')
+        threading.Thread(target=run, daemon=True).start()
+
+    def refresh(self, app, tables=None):
+        """reads the indexes of tables, all by default, of app from its
+        database
+        """
+        indexes = app.extensions['autocomplete']
+        with app.app_context():
+            for table in tables or indexes:
+                indexes[table].build(app.config['STREAM_BATCH_SIZE'])
+
+    def lookup(self, table, prefix, limit):
+        """returns [(id, name)] of the names of table with a word starting
+        with prefix, None if the index of table can't answer
+        """
+        table_index = self.indexes[table]
+        config = current_app.config
+        if (config['AUTOCOMPLETE_BACKGROUND_BUILD'] and
+                table_index.due(config['AUTOCOMPLETE_REFRESH_SECONDS'],
+                                config['AUTOCOMPLETE_RETRY_SECONDS'])):
+            self.start(current_app._get_current_object(), [table])
+        index = table_index.index
+        if index is None or index.full:
+            return None
+        return index.lookup(prefix, limit)
+
+    def stats(self):
+        """returns the size and state of every index"""
+        return {
+            table: {
+                'entries': len(table_index.index)
+                if table_index.index is not None else 0,
+                'ready': table_index.index is not None,
+                'full': bool(table_index.index and table_index.index.full)
+            } for table, table_index in self.indexes.items()
+        }
+
+
+autocomplete = Autocomplete()
+
+
+@on_change
+def _index_write(tablename, action, rows):
+    table_index = autocomplete.indexes.get(tablename)
+    if table_index is not None:
+        table_index.apply(action, rows)
@@ -0,0 +1,97 @@
+'''
+Micro-benchmark: the in-memory autocomplete index of GET /autocomplete
+
+    builds a PrefixIndex of --names generated two and three word names,
+        reports the build time and the memory the index holds
+    times --lookups lookups of random 1 to 6 character prefixes of those
+        names, and --writes renames applied to the built index
+    exits with status 1 when the p99 lookup is over --lookup-budget
+        milliseconds, so it can run in CI
+
+    $ python benchmarks/bench_autocomplete.py --names 100000
+'''
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('SECRET', 'benchmark')
+os.environ.setdefault('APP_SETTINGS', 'config.TestingConfig')
+
+from autocomplete import PrefixIndex  # noqa: E402
+
+LOOKUP_BUDGET_MS = 1.0
+SYLLABLES = ['ba', 'le', 'ri', 'mo', 'sa', 'ton', 'ka', 'vel', 'ne', 'dor',
+             'pi', 'an', 'ju', 'ro', 'é', 'mar', 'li', 'sen', 'co', 'ha']
+
+
+def word(rng):
+    return ''.join(rng.choice(SYLLABLES)
+                   for _ in range(rng.randint(2, 4))).capitalize()
+
+
+def names(count, rng):
+    return [(id, ' '.join(word(rng) for _ in range(rng.randint(2, 3))))
+            for id in range(1, count + 1)]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--names', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=20000)
+    parser.add_argument('--writes', type=int, default=2000)
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--lookup-budget', type=float,
+                        default=LOOKUP_BUDGET_MS)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    rows = names(args.names, rng)
+    start = time.perf_counter()
+    index = PrefixIndex.build(rows, max_entries=len(rows) * 3)
+    build = time.perf_counter() - start
+    # built again, tracemalloc slows the build down
+    tracemalloc.start()
+    copy = PrefixIndex.build(rows, max_entries=len(rows) * 3)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del copy
+
+    prefixes = [rng.choice(rows)[1][:rng.randint(1, 6)]
+                for _ in range(args.lookups)]
+    lookups = []
+    for prefix in prefixes:
+        start = time.perf_counter()
+        index.lookup(prefix, args.limit)
+        lookups.append((time.perf_counter() - start) * 1000)
+
+    writes = []
+    for id, name in rng.sample(rows, min(args.writes, len(rows))):
+        start = time.perf_counter()
+        index.add(id, name + ' Jr')
+        writes.append((time.perf_counter() - start) * 1000)
+
+    p99 = percentile(lookups, 0.99)
+    print(f'{args.names} names, {len(index)} keys')
+    print(f'build            {build * 1000:9.1f} ms')
+    print(f'memory           {memory / 2 ** 20:9.1f} MB')
+    print(f'lookup p50       {percentile(lookups, 0.5):9.3f} ms')
+    print(f'lookup p99       {p99:9.3f} ms  budget {args.lookup_budget} ms'
+          f'{"  OVER" if p99 > args.lookup_budget else ""}')
+    print(f'rename p50       {percentile(writes, 0.5):9.3f} ms')
+    print(f'rename p99       {percentile(writes, 0.99):9.3f} ms')
+    sys.exit(1 if p99 > args.lookup_budget else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+'''
+Benchmark: hot queries before and after the casting keys and indexes
+
+    migrates a scratch database to the initial schema, seeds it, then
+        times the hot queries and prints their plans (EXPLAIN QUERY PLAN on
+        SQLite, EXPLAIN ANALYZE on Postgres)
+    then upgrades to head, which adds the keys and indexes, and repeats
+    uses a temporary SQLite file unless BENCH_DATABASE_URL is set; the
+        database is dropped and recreated, never point it at real data
+
+    $ python benchmarks/bench_indexes.py --actors 20000 --movies 5000
+'''
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('SECRET', 'benchmark')
+os.environ.setdefault('APP_SETTINGS', 'config.TestingConfig')
+
+from flask import Flask  # noqa: E402
+from flask_migrate import Migrate, upgrade  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+from models import setup_db, db  # noqa: E402
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'migrations')
+INITIAL_REVISION = '3f2c1a7d9e10'
+
+QUERIES = [
+    ('actors page by name',
+     'SELECT id, name, gender FROM actors '
+     'WHERE (name, id) > (:name, :id) ORDER BY name, id LIMIT 51'),
+    ('movies page by release_date desc',
+     'SELECT id, title, release_date FROM movies '
+     'WHERE (release_date, id) < (:release_date, :id) '
+     'ORDER BY release_date DESC, id DESC LIMIT 51'),
+    ('movies of an actor',
+     'SELECT l.actor_id, m.id, m.title, m.release_date '
+     'FROM movie_actor_relationship l JOIN movies m ON m.id = l.movie_id '
+     'WHERE l.actor_id = :id ORDER BY l.actor_id, m.id'),
+    ('cast of a movie',
+     'SELECT l.movie_id, a.id, a.name, a.gender '
+     'FROM movie_actor_relationship l JOIN actors a ON a.id = l.actor_id '
+     'WHERE l.movie_id = :id ORDER BY l.movie_id, a.id'),
+]
+
+
+def seed(actors, movies, castings):
+    first = date(1950, 1, 1)
+    db.session.execute(text(
+        'INSERT INTO movies (title, release_date) VALUES (:title, :date)'),
+        [{'title': f'Movie {i}', 'date': first + timedelta(days=i % 20000)}
+         for i in range(movies)])
+    db.session.execute(text(
+        'INSERT INTO actors (name, gender) VALUES (:name, :gender)'),
+        [{'name': f'Actor {random.randrange(actors):08}', 'gender': 'Male'}
+         for i in range(actors)])
+    db.session.execute(text(
+        'INSERT INTO movie_actor_relationship (movie_id, actor_id) '
+        'VALUES (:movie_id, :actor_id)'),
+        [{'movie_id': random.randrange(1, movies + 1),
+          'actor_id': random.randrange(1, actors + 1)}
+         for i in range(castings)])
+    db.session.commit()
+
+
+def params(actors, movies):
+    return {
+        'name': f'Actor {actors // 2:08}',
+        'release_date': date(1950, 1, 1) + timedelta(days=movies // 2),
+        'id': min(actors, movies) // 2
+    }
+
+
+def explain(sql, values):
+    if db.engine.dialect.name == 'postgresql':
+        prefix = 'EXPLAIN (ANALYZE, BUFFERS) '
+    else:
+        prefix = 'EXPLAIN QUERY PLAN '
+    rows = db.session.execute(text(prefix + sql), values).fetchall()
+    return [str(row[-1]) for row in rows]
+
+
+def measure(sql, values, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        db.session.execute(text(sql), values).fetchall()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def run(label, values, repeat):
+    print(f'== {label}')
+    results = {}
+    for name, sql in QUERIES:
+        results[name] = measure(sql, values, repeat)
+        print(f'-- {name}: {results[name] * 1000:.3f} ms')
+        for line in explain(sql, values):
+            print(f'     {line}')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--actors', type=int, default=20000)
+    parser.add_argument('--movies', type=int, default=5000)
+    parser.add_argument('--castings', type=int, default=60000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    scratch = tempfile.NamedTemporaryFile(suffix='.db')
+    url = os.environ.get('BENCH_DATABASE_URL', f'sqlite:///{scratch.name}')
+    app = Flask(__name__)
+    setup_db(app, url)
+    Migrate(app, db, directory=MIGRATIONS)
+    random.seed(0)
+
+    with app.app_context():
+        db.drop_all()
+        db.session.execute(text('DROP TABLE IF EXISTS alembic_version'))
+        db.session.commit()
+        upgrade(directory=MIGRATIONS, revision=INITIAL_REVISION)
+        seed(args.actors, args.movies, args.castings)
+        values = params(args.actors, args.movies)
+
+        before = run('before (initial schema)', values, args.repeat)
+        upgrade(directory=MIGRATIONS)
+        # the migration ran on its own connection, start from a fresh one
+        db.session.remove()
+        db.engine.dispose()
+        after = run('after (keys and indexes)', values, args.repeat)
+
+        print('== summary')
+        for name, _ in QUERIES:
+            print(f'{name:35} {before[name] * 1000:9.3f} ms -> '
+                  f'{after[name] * 1000:9.3f} ms '
+                  f'{before[name] / after[name]:8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
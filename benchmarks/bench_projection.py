@@ -0,0 +1,82 @@
+'''
+Micro-benchmark: ORM list serialization vs column projection
+
+    compares the old list path, Movies.query.all() + format() per row,
+        with the column-only select used by GET /movies today, and with a
+        sparse ?fields=id,title select
+    runs against an in-memory SQLite database unless DATABASE_URL is set
+
+    $ python benchmarks/bench_projection.py --rows 50000 --repeat 5
+'''
+import argparse
+import os
+import sys
+import timeit
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('SECRET', 'benchmark')
+os.environ.setdefault('APP_SETTINGS', 'config.TestingConfig')
+
+from flask import Flask  # noqa: E402
+from models import setup_db, db, Movies  # noqa: E402
+from queries import select_columns, rows_formatter  # noqa: E402
+
+
+def seed(rows):
+    db.drop_all()
+    db.create_all()
+    first = date(1950, 1, 1)
+    db.session.execute(Movies.__table__.insert(), [
+        {'title': f'Movie {i}', 'release_date': first + timedelta(days=i)}
+        for i in range(rows)])
+    db.session.commit()
+
+
+def orm_format():
+    rows = [movie.format() for movie in Movies.query.order_by(Movies.id)]
+    db.session.expunge_all()
+    return rows
+
+
+def projection(fields):
+    keys = [(Movies.id, False)]
+    format_rows = rows_formatter(fields)
+
+    def run():
+        query = select_columns(Movies, fields, keys).order_by(Movies.id)
+        return format_rows(query.all())
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    setup_db(app, os.environ['DATABASE_URL'])
+    with app.app_context():
+        seed(args.rows)
+        cases = [
+            ('Movies.query.all() + format()', orm_format),
+            ('column projection', projection(Movies.fields)),
+            ('column projection, fields=id,title',
+             projection(('id', 'title'))),
+        ]
+        baseline = None
+        print(f'{args.rows} rows, best of {args.repeat}')
+        for name, run in cases:
+            assert len(run()) == args.rows
+            best = min(timeit.repeat(run, number=1, repeat=args.repeat))
+            baseline = baseline or best
+            print(f'{name:40} {best * 1000:9.1f} ms '
+                  f'{best * 1e6 / args.rows:7.2f} us/row '
+                  f'{baseline / best:5.1f}x')
+
+
+if __name__ == '__main__':
+    main()
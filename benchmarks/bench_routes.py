@@ -0,0 +1,443 @@
+'''
+Load test of every route, offline: no Auth0, no shared database
+
+    mints RS256 tokens with a key generated for the run and serves its JWKS
+        from a local file (JWKS_URL=file://...), so the full token
+        verification runs without Auth0
+    brings the schema up to date with the migrations, like the release
+        phase of the Procfile, then starts the server in its own process,
+        against a new SQLite file unless DATABASE_URL is set, and seeds
+        --movies movies, --actors actors and --castings actors per movie
+        through the bulk endpoints
+    --concurrency keep-alive clients then send a weighted mix of the
+        requests of every route in app.py for --duration seconds; writes
+        touch rows created by the run, the seeded rows only get renamed
+        GET /changes is left out, its streams are long lived by design
+    reports requests/sec and p50/p95/p99 latency per route, --output
+        writes them as JSON; --compare fails (exit 1) when a route's p95
+        or requests/sec is worse than in that baseline by more than
+        --tolerance
+    --server runs another server, {port} is replaced by the port:
+        --server "gunicorn -w 4 -b 127.0.0.1:{port} 'app:create_app()'"
+    baseline_routes.json is the report of the default run on the machine
+        described in its meta; timings only compare on the same hardware,
+        record a baseline of your own before comparing elsewhere
+
+    $ python benchmarks/bench_routes.py --output baseline.json
+    $ python benchmarks/bench_routes.py --compare baseline.json
+'''
+import argparse
+import base64
+import http.client
+import json
+import os
+import platform
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+import rsa
+from jose import jwt
+
+from bench_serving import MIGRATE, ROOT, free_port, percentile, wait_ready
+
+AUDIENCE = 'casting_agency'
+DOMAIN = 'bench.local'
+PERMISSIONS = [
+    'read:movies', 'read:actors', 'write:movies', 'write:actors',
+    'update:movies', 'update:actors', 'delete:movies', 'delete:actors']
+
+# serves the app with the threaded dev server
+SERVER = '''
+import sys
+from werkzeug.serving import run_simple
+from app import create_app
+run_simple('127.0.0.1', int(sys.argv[1]), create_app(), threaded=True)
+'''
+
+
+class LocalSigner(object):
+    '''an RS256 key and its JWKS file, standing in for Auth0'''
+    def __init__(self, directory, kid='bench-1'):
+        public, self._private = rsa.newkeys(2048)
+        self.kid = kid
+        self.private_pem = self._private.save_pkcs1().decode('ascii')
+        self.jwks_path = os.path.join(directory, 'jwks.json')
+        with open(self.jwks_path, 'w') as jwks_file:
+            json.dump({'keys': [{
+                'kty': 'RSA', 'kid': kid, 'use': 'sig', 'alg': 'RS256',
+                'n': _b64_int(public.n), 'e': _b64_int(public.e)
+            }]}, jwks_file)
+
+    def token(self, permissions, ttl=3600):
+        """returns a signed token with permissions"""
+        return jwt.encode({
+            'iss': f'https://{DOMAIN}/',
+            'aud': AUDIENCE,
+            'sub': 'bench',
+            'exp': int(time.time()) + ttl,
+            'permissions': permissions
+        }, self.private_pem, algorithm='RS256', headers={'kid': self.kid})
+
+
+def _b64_int(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+class Client(object):
+    def __init__(self, port, token):
+        self.port = port
+        self.headers = {'Authorization': f'Bearer {token}',
+                        'Content-Type': 'application/json'}
+        self.connection = None
+
+    def request(self, method, path, body=None):
+        """returns (status, parsed JSON body or None, seconds)"""
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(
+                '127.0.0.1', self.port, timeout=60)
+        data = json.dumps(body) if body is not None else None
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, path, body=data,
+                                    headers=self.headers)
+            response = self.connection.getresponse()
+            raw = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            return None, None, time.perf_counter() - start
+        seconds = time.perf_counter() - start
+        try:
+            parsed = json.loads(raw) if raw else None
+        except ValueError:
+            parsed = None
+        return response.status, parsed, seconds
+
+
+def seed(client, movies, actors, castings, batch=1000):
+    """returns (movie ids, actor ids) of the seeded rows"""
+    movie_ids, actor_ids = [], []
+    for start in range(0, movies, batch):
+        _, body, _ = client.request('POST', '/movies/bulk', [
+            {'title': f'Seed movie {i}',
+             'release_date': f'{1950 + i % 70}-01-{1 + i % 28:02}'}
+            for i in range(start, min(start + batch, movies))])
+        movie_ids += [item['id'] for item in body['movies']]
+    for start in range(0, actors, batch):
+        _, body, _ = client.request('POST', '/actors/bulk', [
+            {'name': f'Seed actor {i}', 'gender': 'Female' if i % 2
+             else 'Male'} for i in range(start, min(start + batch, actors))])
+        actor_ids += [item['id'] for item in body['actors']]
+    rng = random.Random(0)
+    for movie_id in movie_ids:
+        for actor_id in rng.sample(actor_ids, min(castings, len(actor_ids))):
+            client.request('PUT', f'/movies/{movie_id}/actors/{actor_id}')
+    return movie_ids, actor_ids
+
+
+class Workload(object):
+    '''the weighted requests of every route
+        every scenario returns the (route, method, path, body) requests it
+        sends, in order; later ones may use the response of earlier ones
+    '''
+    def __init__(self, movie_ids, actor_ids):
+        self.movie_ids = movie_ids
+        self.actor_ids = actor_ids
+        self.created = {'movies': deque(), 'actors': deque()}
+        self.counter = iter(range(10 ** 12))
+        self.lock = threading.Lock()
+        self.scenarios = [
+            (10, self.read('GET /movies', '/movies')),
+            (3, self.read('GET /movies?include=actors',
+                          '/movies?include=actors&limit=20')),
+            (10, self.read('GET /movies/<id>', '/movies/{movie}')),
+            (5, self.read('GET /movies/<id>/actors',
+                          '/movies/{movie}/actors')),
+            (10, self.read('GET /actors', '/actors')),
+            (3, self.read('GET /actors?gender=&sort=name',
+                          '/actors?gender=Female&sort=name')),
+            (3, self.read('GET /movies?release_date[gte]=',
+                          '/movies?release_date[gte]=1990-01-01'
+                          '&sort=-release_date')),
+            (10, self.read('GET /actors/<id>', '/actors/{actor}')),
+            (5, self.read('GET /actors/<id>/movies',
+                          '/actors/{actor}/movies')),
+            (3, self.read('GET /movies/search',
+                          '/movies/search?q=movie%20{movie}')),
+            (3, self.read('GET /actors/search',
+                          '/actors/search?q=seed%20act%20{actor}')),
+            (5, self.read('GET /autocomplete',
+                          '/autocomplete?prefix=seed%20{actor}')),
+            (1, self.read('GET /health', '/health')),
+            (1, self.read('GET /metrics', '/metrics')),
+            (1, self.read('GET /login', '/login')),
+            (2, self.create_one), (2, self.create_bulk),
+            (2, self.edit_one), (1, self.edit_bulk),
+            (1, self.delete_one), (1, self.delete_bulk),
+            (2, self.casting)
+        ]
+        self.weights = [weight for weight, _ in self.scenarios]
+
+    def pick(self, rng):
+        return rng.choices(self.scenarios, self.weights)[0][1]
+
+    def read(self, route, template):
+        def scenario(client, rng, record):
+            path = template.format(movie=rng.choice(self.movie_ids),
+                                   actor=rng.choice(self.actor_ids))
+            record(route, *client.request('GET', path))
+        return scenario
+
+    def _next(self):
+        with self.lock:
+            return next(self.counter)
+
+    def _new(self, table, client, rng, record, count=1):
+        """creates count rows through the bulk endpoint, returns their ids
+        """
+        n = self._next()
+        if table == 'movies':
+            items = [{'title': f'Load movie {n}.{i}',
+                      'release_date': '2020-02-02'} for i in range(count)]
+        else:
+            items = [{'name': f'Load actor {n}.{i}', 'gender': 'Female'}
+                     for i in range(count)]
+        status, body, seconds = client.request('POST', f'/{table}/bulk',
+                                               items)
+        record(f'POST /{table}/bulk', status, body, seconds)
+        return [item['id'] for item in (body or {}).get(table, [])]
+
+    def create_one(self, client, rng, record):
+        n = self._next()
+        if rng.random() < 0.5:
+            record('POST /movies', *client.request(
+                'POST', '/movies', {'title': f'Single movie {n}',
+                                    'release_date': '2021-03-03'}))
+        else:
+            record('POST /actors', *client.request(
+                'POST', '/actors', {'name': f'Single actor {n}',
+                                    'gender': 'Male'}))
+
+    def create_bulk(self, client, rng, record):
+        table = rng.choice(['movies', 'actors'])
+        ids = self._new(table, client, rng, record, count=20)
+        self.created[table].extend(ids)
+
+    def edit_one(self, client, rng, record):
+        n = self._next()
+        if rng.random() < 0.5:
+            record('PATCH /movies/<id>', *client.request(
+                'PATCH', f'/movies/{rng.choice(self.movie_ids)}',
+                {'title': f'Renamed movie {n}'}))
+        else:
+            record('PATCH /actors/<id>', *client.request(
+                'PATCH', f'/actors/{rng.choice(self.actor_ids)}',
+                {'name': f'Renamed actor {n}'}))
+
+    def edit_bulk(self, client, rng, record):
+        n = self._next()
+        if rng.random() < 0.5:
+            record('PATCH /movies/bulk', *client.request(
+                'PATCH', '/movies/bulk', [
+                    {'id': movie_id, 'title': f'Bulk renamed {n}.{movie_id}'}
+                    for movie_id in rng.sample(self.movie_ids, 10)]))
+        else:
+            record('PATCH /actors/bulk', *client.request(
+                'PATCH', '/actors/bulk', [
+                    {'id': actor_id, 'name': f'Bulk renamed {n}.{actor_id}'}
+                    for actor_id in rng.sample(self.actor_ids, 10)]))
+
+    def _take(self, table, count, client, rng, record):
+        with self.lock:
+            ids = [self.created[table].popleft()
+                   for _ in range(min(count, len(self.created[table])))]
+        return ids or self._new(table, client, rng, record, count)
+
+    def delete_one(self, client, rng, record):
+        table = rng.choice(['movies', 'actors'])
+        for row_id in self._take(table, 1, client, rng, record):
+            record(f'DELETE /{table}/<id>', *client.request(
+                'DELETE', f'/{table}/{row_id}'))
+
+    def delete_bulk(self, client, rng, record):
+        table = rng.choice(['movies', 'actors'])
+        ids = self._take(table, 10, client, rng, record)
+        if ids:
+            record(f'DELETE /{table}/bulk', *client.request(
+                'DELETE', f'/{table}/bulk', {'ids': ids}))
+
+    def casting(self, client, rng, record):
+        path = (f'/movies/{rng.choice(self.movie_ids)}'
+                f'/actors/{rng.choice(self.actor_ids)}')
+        record('PUT /movies/<id>/actors/<id>',
+               *client.request('PUT', path))
+        record('DELETE /movies/<id>/actors/<id>',
+               *client.request('DELETE', path))
+
+
+def run(port, token, workload, concurrency, duration):
+    """returns ({route: (latencies, statuses)}, elapsed seconds)"""
+    results = {}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(index):
+        client = Client(port, token)
+        rng = random.Random(index)
+        mine = {}
+
+        def record(route, status, body, seconds):
+            latencies, statuses = mine.setdefault(route, ([], {}))
+            statuses[status] = statuses.get(status, 0) + 1
+            if status is not None and status < 500:
+                latencies.append(seconds)
+
+        while time.monotonic() < deadline:
+            workload.pick(rng)(client, rng, record)
+        with lock:
+            for route, (latencies, statuses) in mine.items():
+                total = results.setdefault(route, ([], {}))
+                total[0].extend(latencies)
+                for status, count in statuses.items():
+                    total[1][status] = total[1].get(status, 0) + count
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.monotonic() - start
+
+
+def summary(results, elapsed):
+    """returns the JSON report of every route"""
+    routes = {}
+    for route, (latencies, statuses) in sorted(results.items()):
+        latencies.sort()
+        requests = sum(statuses.values())
+        routes[route] = {
+            'requests': requests,
+            'rps': round(requests / elapsed, 2),
+            'errors': sum(count for status, count in statuses.items()
+                          if status is None or status >= 500),
+            'statuses': {str(status): count
+                         for status, count in sorted(
+                             statuses.items(), key=lambda item: str(item[0]))}
+        }
+        for name, fraction in [('p50_ms', 0.5), ('p95_ms', 0.95),
+                               ('p99_ms', 0.99)]:
+            routes[route][name] = round(
+                percentile(latencies, fraction) * 1000, 2) \
+                if latencies else None
+    return routes
+
+
+def regressions(routes, baseline, tolerance):
+    """returns the routes worse than baseline by more than tolerance"""
+    worse = []
+    for route, before in baseline['routes'].items():
+        after = routes.get(route)
+        if after is None or not before['p95_ms'] or not after['p95_ms']:
+            continue
+        if after['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            worse.append(f'{route}: p95 {before["p95_ms"]} -> '
+                         f'{after["p95_ms"]} ms')
+        if after['rps'] < before['rps'] * (1 - tolerance):
+            worse.append(f'{route}: {before["rps"]} -> {after["rps"]} req/s')
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--movies', type=int, default=1000)
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--castings', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--server')
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    signer = LocalSigner(directory)
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(
+        directory, 'routes.db'))
+    env.setdefault('SECRET', 'benchmark')
+    env.setdefault('APP_SETTINGS', 'config.ProductionConfig')
+    env.update({'JWKS_URL': 'file://' + signer.jwks_path,
+                'AUTH0_DOMAIN': DOMAIN, 'API_AUDIENCE': AUDIENCE,
+                'ALGORITHMS': 'RS256'})
+
+    subprocess.run([sys.executable, '-c', MIGRATE], cwd=ROOT, env=env,
+                   check=True, capture_output=True)
+    port = free_port()
+    if args.server:
+        command = shlex.split(args.server.format(port=port))
+    else:
+        command = [sys.executable, '-c', SERVER, str(port)]
+    server = subprocess.Popen(command, cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(port)
+        token = signer.token(PERMISSIONS)
+        movie_ids, actor_ids = seed(Client(port, token), args.movies,
+                                    args.actors, args.castings)
+        results, elapsed = run(port, token,
+                               Workload(movie_ids, actor_ids),
+                               args.concurrency, args.duration)
+    finally:
+        server.terminate()
+        server.wait()
+
+    routes = summary(results, elapsed)
+    print(f'{args.movies} movies, {args.actors} actors, {args.castings} '
+          f'castings per movie, {args.concurrency} clients, '
+          f'{args.duration:g}s')
+    print(f'{"route":34} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} '
+          f'{"p99 ms":>8} {"errors":>6}  statuses')
+    for route, stats in routes.items():
+        print(f'{route:34} {stats["rps"]:8.1f} '
+              + ' '.join(f'{stats[name] or 0:8.1f}'
+                         for name in ('p50_ms', 'p95_ms', 'p99_ms'))
+              + f' {stats["errors"]:6}  {stats["statuses"]}')
+
+    report = {
+        'meta': {
+            'movies': args.movies, 'actors': args.actors,
+            'castings': args.castings, 'concurrency': args.concurrency,
+            'duration': args.duration, 'server': args.server or 'werkzeug',
+            'database': env['DATABASE_URL'].split(':', 1)[0],
+            'python': platform.python_version(),
+            'machine': f'{platform.machine()}, {os.cpu_count()} cpus',
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        },
+        'routes': routes
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            worse = regressions(routes, json.load(baseline_file),
+                                args.tolerance)
+        for line in worse:
+            print(f'REGRESSION {line}')
+        if worse:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+'''
+Load benchmark: threaded gunicorn workers vs the ASGI entry point
+
+    starts each server on a free port, then keeps --concurrency
+        keep-alive clients requesting --path for --duration seconds and
+        reports requests/sec and the p50/p99 latency
+    gunicorn: `gunicorn --worker-class gthread --threads 8
+        'app:create_app()'`, the Procfile deployment
+    uvicorn: `uvicorn --factory asgi:create_asgi_app`
+    a server whose package isn't installed is skipped
+    runs against a new SQLite file unless DATABASE_URL is set; the
+        endpoints of movies and actors need a token, pass it with --header
+
+    $ python benchmarks/bench_serving.py --workers 2 --concurrency 64 \\
+        --path /movies --header "Authorization: Bearer $PRODUCER_TOKEN"
+'''
+import argparse
+import http.client
+import importlib.util
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    'gunicorn': lambda port, workers: [
+        sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+        '--worker-class', 'gthread', '--threads', '8',
+        '--bind', f'127.0.0.1:{port}', 'app:create_app()'],
+    'uvicorn': lambda port, workers: [
+        sys.executable, '-m', 'uvicorn', '--factory', '--workers',
+        str(workers), '--port', str(port), '--log-level', 'warning',
+        'asgi:create_asgi_app']
+}
+
+# `manage.py db upgrade`, without the Flask-Script command line
+MIGRATE = '''
+from flask_migrate import Migrate, upgrade
+from app import create_app
+from models import db
+app = create_app()
+Migrate(app, db)
+with app.app_context():
+    upgrade()
+'''
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                    timeout=1)
+            connection.request('GET', '/health')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def load(port, path, headers, concurrency, duration):
+    """returns (sorted latencies in seconds, errors, elapsed seconds)"""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                timeout=30)
+        mine, failed = [], 0
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    failed += 1
+                    continue
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                connection.close()
+                continue
+            mine.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(mine)
+            errors.append(failed)
+
+    start = time.monotonic()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return sorted(latencies), sum(errors), time.monotonic() - start
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--servers', default='gunicorn,uvicorn')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--path', default='/health')
+    parser.add_argument('--header', action='append', default=[])
+    args = parser.parse_args()
+    headers = dict(header.split(': ', 1) for header in args.header)
+
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'serving.db'))
+    env.setdefault('SECRET', 'benchmark')
+    env.setdefault('APP_SETTINGS', 'config.ProductionConfig')
+    subprocess.run([sys.executable, '-c', MIGRATE], cwd=ROOT, env=env,
+                   check=True, capture_output=True)
+
+    print(f'GET {args.path}, {args.workers} workers, '
+          f'{args.concurrency} clients, {args.duration:g}s')
+    for name in args.servers.split(','):
+        if importlib.util.find_spec(name) is None:
+            print(f'{name:10} skipped, not installed')
+            continue
+        port = free_port()
+        server = subprocess.Popen(SERVERS[name](port, args.workers),
+                                  cwd=ROOT, env=env,
+                                  stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL)
+        try:
+            wait_ready(port)
+            latencies, errors, elapsed = load(
+                port, args.path, headers, args.concurrency, args.duration)
+        finally:
+            server.terminate()
+            server.wait()
+        if not latencies:
+            print(f'{name:10} no successful requests, {errors} errors')
+            continue
+        print(f'{name:10} {len(latencies) / elapsed:9.1f} req/s  '
+              f'p50 {percentile(latencies, 0.5) * 1000:7.1f} ms  '
+              f'p99 {percentile(latencies, 0.99) * 1000:7.1f} ms  '
+              f'{errors} errors')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+'''
+Startup benchmark: import time and time to first request of a worker
+
+    every step runs in a fresh interpreter, as a new gunicorn worker does
+    import: `python -X importtime -c "import app"`, the cumulative time of
+        the app module and of the slowest imports under it
+    create_app: import app, then create_app()
+    first request: import app, create_app() and GET /health
+    runs against a new SQLite file unless DATABASE_URL is set; exits with
+        status 1 when a step is over its budget, so it can run in CI
+
+    $ python benchmarks/bench_startup.py --repeat 5 --import-budget 500
+'''
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# milliseconds, best of --repeat runs, measured on a laptop with headroom
+IMPORT_BUDGET_MS = 500
+CREATE_APP_BUDGET_MS = 800
+FIRST_REQUEST_BUDGET_MS = 1000
+
+TIMED = '''
+import time
+start = time.perf_counter()
+import app
+{step}
+print((time.perf_counter() - start) * 1000)
+'''
+STEPS = {
+    'create_app': 'app.create_app()',
+    'first request': (
+        "response = app.create_app().test_client().get('/health')\n"
+        "assert response.status_code == 200, response.status_code")
+}
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def run(args, env):
+    return subprocess.run([sys.executable] + args, cwd=ROOT, env=env,
+                          check=True, capture_output=True, text=True)
+
+
+def import_times(env):
+    """returns {module: cumulative ms} of `import app`"""
+    stderr = run(['-X', 'importtime', '-c', 'import app'], env).stderr
+    times = {}
+    for line in stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            times[match.group(4)] = int(match.group(2)) / 1000
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=8)
+    parser.add_argument('--import-budget', type=float,
+                        default=IMPORT_BUDGET_MS)
+    parser.add_argument('--create-app-budget', type=float,
+                        default=CREATE_APP_BUDGET_MS)
+    parser.add_argument('--first-request-budget', type=float,
+                        default=FIRST_REQUEST_BUDGET_MS)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL',
+                   'sqlite:///' + os.path.join(directory, 'startup.db'))
+    env.setdefault('SECRET', 'benchmark')
+    env.setdefault('APP_SETTINGS', 'config.TestingConfig')
+
+    runs = [import_times(env) for _ in range(args.repeat)]
+    best = min(runs, key=lambda times: times['app'])
+    results = [('import', best['app'], args.import_budget)]
+    for name, budget in [('create_app', args.create_app_budget),
+                         ('first request', args.first_request_budget)]:
+        script = TIMED.format(step=STEPS[name])
+        results.append((name, min(
+            float(run(['-c', script], env).stdout.split()[-1])
+            for _ in range(args.repeat)), budget))
+
+    print(f'best of {args.repeat}')
+    over = False
+    for name, ms, budget in results:
+        over = over or ms > budget
+        print(f'{name:20} {ms:9.1f} ms  budget {budget:7.1f} ms'
+              f'{"  OVER" if ms > budget else ""}')
+    print('\nslowest imports under app, cumulative')
+    for module, ms in sorted(best.items(), key=lambda item: -item[1])[
+            1:args.top + 1]:
+        print(f'{module:40} {ms:9.1f} ms')
+    sys.exit(1 if over else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import json
+from datetime import date
+from flask import request, abort
+from werkzeug.http import parse_date
+
+
+'''
+Bulk request helpers
+
+    bulk endpoints take a JSON array, or an application/x-ndjson body with
+        one JSON object per line
+    every item is validated up front; invalid items are reported by their
+        index and the valid ones are written in a single transaction
+'''
+
+NDJSON = 'application/x-ndjson'
+
+
+def parse_bulk_body(maximum):
+    '''returns (items, errors) for the request body
+        errors maps the index of every unparseable NDJSON line to a message
+        abort 400 if the body is not a list, 413 if it has over maximum items
+    '''
+    errors = {}
+    if request.mimetype == NDJSON:
+        items = []
+        lines = request.get_data(as_text=True).splitlines()
+        for line in (line for line in lines if line.strip()):
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                errors[len(items)] = 'invalid json'
+                items.append(None)
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            abort(400)
+
+    if not items:
+        abort(400)
+    if len(items) > maximum:
+        abort(413)
+    return items, errors
+
+
+def _text(item, key, max_length):
+    value = item.get(key)
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f'{key} is required')
+    if len(value) > max_length:
+        raise ValueError(f'{key} is longer than {max_length} characters')
+    return value
+
+
+def parse_release_date(value):
+    '''returns value as a date, accepts ISO (2020-02-16) and HTTP dates
+        (Sun, 16 Feb 2020 00:00:00 GMT) as returned by GET /movies
+    '''
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError('release_date is required')
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        pass
+    parsed = parse_date(value)
+    if parsed is None:
+        raise ValueError('release_date is not a valid date')
+    return parsed.date()
+
+
+def validate_movie(item):
+    '''returns the movies row for a bulk item, raise ValueError if invalid
+    '''
+    if not isinstance(item, dict):
+        raise ValueError('item must be an object')
+    return {
+        'title': _text(item, 'title', 80),
+        'release_date': parse_release_date(item.get('release_date'))
+    }
+
+
+def validate_actor(item):
+    '''returns the actors row for a bulk item, raise ValueError if invalid
+    '''
+    if not isinstance(item, dict):
+        raise ValueError('item must be an object')
+    return {
+        'name': _text(item, 'name', 80),
+        'gender': _text(item, 'gender', 6)
+    }
+
+
+def _patch_id(item):
+    if not isinstance(item, dict):
+        raise ValueError('item must be an object')
+    item_id = item.get('id')
+    if not isinstance(item_id, int) or isinstance(item_id, bool):
+        raise ValueError('id is required')
+    return {'id': item_id}
+
+
+def validate_movie_patch(item):
+    '''returns the id and new movies columns of a bulk patch item,
+        raise ValueError if invalid
+    '''
+    row = _patch_id(item)
+    if 'title' in item:
+        row['title'] = _text(item, 'title', 80)
+    if 'release_date' in item:
+        row['release_date'] = parse_release_date(item['release_date'])
+    if len(row) == 1:
+        raise ValueError('title or release_date is required')
+    return row
+
+
+def validate_actor_patch(item):
+    '''returns the id and new actors columns of a bulk patch item,
+        raise ValueError if invalid
+    '''
+    row = _patch_id(item)
+    if 'name' in item:
+        row['name'] = _text(item, 'name', 80)
+    if 'gender' in item:
+        row['gender'] = _text(item, 'gender', 6)
+    if len(row) == 1:
+        raise ValueError('name or gender is required')
+    return row
+
+
+def parse_bulk_ids(maximum):
+    '''returns the distinct ids of a {"ids": [...]} request body
+        abort 400 if they are not integers, 413 if there are over maximum
+    '''
+    body = request.get_json(silent=True)
+    ids = body.get('ids') if isinstance(body, dict) else None
+    if not isinstance(ids, list) or not ids:
+        abort(400)
+    if any(not isinstance(id, int) or isinstance(id, bool) for id in ids):
+        abort(400)
+    if len(ids) > maximum:
+        abort(413)
+    return list(dict.fromkeys(ids))
+
+
+def validate_items(items, errors, validate, unique=()):
+    '''returns (indexes, rows) of the valid items, adding a message to
+        errors for every invalid one
+        unique: optional column, or tuple of columns, that must not repeat
+            within the request; rows without the column are not checked
+    '''
+    if isinstance(unique, str):
+        unique = (unique,)
+    indexes = []
+    rows = []
+    seen = {column: set() for column in unique}
+    for index, item in enumerate(items):
+        if index in errors:
+            continue
+        try:
+            row = validate(item)
+        except ValueError as error:
+            errors[index] = str(error)
+            continue
+        repeated = [column for column in unique
+                    if column in row and row[column] in seen[column]]
+        if repeated:
+            errors[index] = f'duplicate {repeated[0]} in request'
+            continue
+        for column in unique:
+            if column in row:
+                seen[column].add(row[column])
+        indexes.append(index)
+        rows.append(row)
+    return indexes, rows
+
+
+def error_list(errors):
+    '''returns the per-item errors in request order'''
+    return [{'index': index, 'message': errors[index]}
+            for index in sorted(errors)]
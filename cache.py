@@ -0,0 +1,263 @@
+import calendar
+import hashlib
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+from flask import Response, current_app, g, has_app_context, request
+from models import db, table_versions
+from queries import wants_stream
+
+
+'''
+Read-through response cache for the GET endpoints
+
+    a cached view's JSON body is stored under its path, its query string
+        and the current version of every table it reads
+    the versions are kept in the database and bumped in the transaction
+        of every write through the models (see models.table_versions), so
+        the next read of any worker or instance builds a new key and the
+        stale entries are never served again; they age out of the LRU or
+        expire after CACHE_TTL seconds
+    reading the versions is one primary key lookup per request
+    the versions are read before the view runs, so a write that commits
+        while a response is being built leaves it under the old key
+    a miss is built by one request at a time per key, concurrent requests
+        for the same key wait and reuse its result
+    only 200 responses are stored; streamed dumps are never cached
+
+Conditional GET
+    the same key, which holds the time of every version, is hashed into a
+        strong ETag; the time of the last write to the tables read is sent
+        as Last-Modified
+    If-None-Match, or If-Modified-Since when there is no If-None-Match,
+        is answered with a 304 only when the response under the key is a
+        200: straight from the stored entry on a hit, so neither the query
+        nor the serializer is run for a client that is up to date, and
+        after running the view otherwise, so a request that fails (a
+        missing id, a bad argument) gets its error and not a 304
+    the validators come from the database only, so they hold across
+        workers, restarts and CACHE_BACKEND=none
+'''
+
+
+class LocalBackend(object):
+    '''in-process LRU, bounded by the bytes of the stored bodies'''
+    def __init__(self, max_bytes, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, body = entry
+            if expires_at <= self.clock():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return body
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def set(self, key, body, ttl):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (self.clock() + ttl, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        expires_at, body = self._entries.pop(key)
+        self.size -= len(body)
+
+
+class RedisBackend(object):
+    '''cache shared by every worker and instance, needs the redis package
+        a response built by one worker is a hit for all of them
+    '''
+    prefix = 'casting:'
+    enabled = True
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, body, ttl):
+        self.client.set(self.prefix + key, body, ex=max(int(ttl), 1))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + 'v*/*'))
+        if keys:
+            self.client.delete(*keys)
+
+    def __len__(self):
+        return 0
+
+
+def make_backend(config):
+    '''returns the backend named by CACHE_BACKEND
+        'none' stores no responses, the ETags still work
+    '''
+    name = config.get('CACHE_BACKEND', 'local')
+    if name == 'local':
+        return LocalBackend(config.get('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    if name == 'redis':
+        return RedisBackend(config['CACHE_URL'])
+    if name == 'none':
+        return LocalBackend(0)
+    raise ValueError(f'unknown CACHE_BACKEND {name!r}')
+
+
+def not_modified(etag, last_modified):
+    """returns True if the client's copy is the current one"""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    if since is None:
+        return False
+    return int(last_modified) <= calendar.timegm(since.utctimetuple())
+
+
+def validators(response, etag, last_modified):
+    """sets the ETag, Last-Modified and Cache-Control headers"""
+    response.set_etag(etag)
+    response.last_modified = int(last_modified)
+    response.headers['Cache-Control'] = current_app.config['CACHE_CONTROL']
+    return response
+
+
+class ResponseCache(object):
+    def __init__(self, stripes=64):
+        self.hits = 0
+        self.misses = 0
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def init_app(self, app):
+        app.extensions['response_cache'] = make_backend(app.config)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def backend(self):
+        # like the models, fall back to the app bound by setup_db
+        app = current_app if has_app_context() else db.app
+        if app is None:
+            return None
+        return app.extensions.get('response_cache')
+
+    def cached(self, *tables, include=(), bypass=()):
+        '''decorator for a GET view, goes under @requires_auth
+            tables: the tables the response is built from
+            include: further tables read when the request has ?include=
+            bypass: arguments whose responses depend on more than the
+                table versions, they are neither cached nor validated
+        '''
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                backend = self.backend
+                if (backend is None or wants_stream() or
+                        any(name in request.args for name in bypass)):
+                    return f(*args, **kwargs)
+
+                read = tables + (include if 'include' in request.args
+                                 else ())
+                versions = table_versions(read)
+                if versions is None:
+                    return f(*args, **kwargs)
+                key = self.key(versions)
+                etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+                last_modified = max(changed for _, changed in versions)
+                # for replicas.read_only, None if never written to
+                g.tables_changed_at = last_modified if any(
+                    version for version, _ in versions) else None
+
+                def fresh(response):
+                    # a 304 instead of a 200 the client already has
+                    if not_modified(etag, last_modified):
+                        response = Response(status=304)
+                    return validators(response, etag, last_modified)
+
+                if not backend.enabled:
+                    response = f(*args, **kwargs)
+                    if (isinstance(response, Response) and
+                            response.status_code == 200):
+                        return fresh(response)
+                    return response
+
+                body = backend.get(key)
+                if body is None:
+                    lock = self._locks[zlib.crc32(key.encode('utf-8')) %
+                                       len(self._locks)]
+                    with lock:
+                        body = backend.get(key)
+                        if body is None:
+                            self.misses += 1
+                            response = f(*args, **kwargs)
+                            if (not isinstance(response, Response) or
+                                    response.status_code != 200 or
+                                    response.is_streamed):
+                                return response
+                            body = response.get_data()
+                            backend.set(key, body,
+                                        current_app.config['CACHE_TTL'])
+                            response.headers['X-Cache'] = 'MISS'
+                            return fresh(response)
+                self.hits += 1
+                response = Response(body, mimetype='application/json')
+                response.headers['X-Cache'] = 'HIT'
+                return fresh(response)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def key(versions):
+        query = urlencode(sorted(request.args.items(multi=True)))
+        # the times tell a recreated database from the one it replaced
+        version = '.'.join(f'{value}-{changed:.6f}'
+                           for value, changed in versions)
+        return f'v{version}/{request.path}?{query}'
+
+    def clear(self):
+        backend = self.backend
+        if backend is not None:
+            backend.clear()
+
+    def stats(self):
+        """returns the cache counters"""
+        lookups = self.hits + self.misses
+        backend = self.backend
+        return {
+            'size': len(backend) if backend is not None else 0,
+            'bytes': getattr(backend, 'size', 0),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+
+response_cache = ResponseCache()
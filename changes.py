@@ -0,0 +1,270 @@
+import select
+import threading
+import time
+import uuid
+from collections import deque
+from flask import Response, current_app, has_app_context
+from flask import json as flask_json
+from sqlalchemy import create_engine, func
+from sqlalchemy import select as sql_select
+from sqlalchemy.pool import NullPool
+from models import db, on_change, on_write
+
+
+'''
+Change feed for GET /changes (server-sent events)
+
+    every committed write through the models is published as one event
+        per table, action and group of rows
+    on Postgres the events travel through NOTIFY on the casting_changes
+        channel, sent inside the write transaction: Postgres delivers them
+        only if the write commits, in commit order; every worker LISTENs
+        on its own connection, so a client sees the writes of every
+        worker and instance in commit order
+    on other databases the events are published in-process only
+    every event has an id; the last history_size events are kept, so a
+        client that reconnects with Last-Event-ID gets what it missed
+    every subscriber has its own queue of at most queue_size events; a
+        subscriber that falls further behind, or asks for an id that is
+        no longer kept, has its queue dropped and gets a reset event
+        telling it to catch up with ?since= instead
+    every open stream holds a worker thread (one of the --threads of a
+        gunicorn gthread worker) until it ends, for up to
+        CHANGES_MAX_STREAM_SECONDS
+'''
+
+CHANNEL = 'casting_changes'
+# NOTIFY payloads must be shorter than 8000 bytes
+MAX_PAYLOAD = 7900
+
+
+class Subscriber(object):
+    def __init__(self, tables, queue_size):
+        self.tables = tables
+        self.queue_size = queue_size
+        self.events = deque()
+        self.reset = None
+        self._ready = threading.Condition()
+
+    def push(self, event):
+        """queues event, returns False if the queue was full and dropped
+        """
+        with self._ready:
+            self._ready.notify()
+            if len(self.events) < self.queue_size:
+                self.events.append(event)
+                return True
+            self.events.clear()
+            self.reset = 'overflow'
+            return False
+
+    def wait(self, timeout):
+        """returns (reset reason or None, events), waiting up to timeout
+        seconds for either
+        """
+        with self._ready:
+            if not self.events and self.reset is None:
+                self._ready.wait(timeout)
+            reset, self.reset = self.reset, None
+            events = list(self.events)
+            self.events.clear()
+            return reset, events
+
+
+class ChangeFeed(object):
+    '''in-process hub of the events, with the history for Last-Event-ID
+    '''
+    def __init__(self, history_size, queue_size):
+        self.queue_size = queue_size
+        self.published = 0
+        self.resets = 0
+        self._history = deque(maxlen=history_size)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def publish(self, event):
+        """event: (id, table, data) with data already serialized"""
+        with self._lock:
+            self._history.append(event)
+            self.published += 1
+            for subscriber in self._subscribers:
+                if (event[1] in subscriber.tables and
+                        not subscriber.push(event)):
+                    self.resets += 1
+
+    def subscribe(self, tables, last_event_id=None):
+        """returns a new Subscriber to tables, holding the events that
+        followed last_event_id
+        """
+        subscriber = Subscriber(tables, self.queue_size)
+        with self._lock:
+            if last_event_id is not None:
+                ids = [event[0] for event in self._history]
+                if last_event_id in ids:
+                    start = ids.index(last_event_id) + 1
+                    for event in list(self._history)[start:]:
+                        if event[1] in tables:
+                            subscriber.push(event)
+                else:
+                    subscriber.reset = 'unknown_id'
+                if subscriber.reset is not None:
+                    self.resets += 1
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def stats(self):
+        """returns the feed counters"""
+        return {
+            'subscribers': len(self._subscribers),
+            'history': len(self._history),
+            'published': self.published,
+            'resets': self.resets
+        }
+
+
+class PostgresBridge(object):
+    '''LISTENs on the channel and publishes every notification to feed
+        the thread starts with the first subscriber, so it runs in the
+        worker process rather than in a pre-fork master
+    '''
+    def __init__(self, url, feed, reconnect_delay=1.0):
+        self.url = url
+        self.feed = feed
+        self.reconnect_delay = reconnect_delay
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        engine = create_engine(self.url, poolclass=NullPool)
+        while True:
+            try:
+                self._listen(engine)
+            except Exception:
+                time.sleep(self.reconnect_delay)
+
+    def _listen(self, engine):
+        connection = engine.raw_connection()
+        try:
+            connection.connection.set_isolation_level(0)
+            cursor = connection.cursor()
+            cursor.execute(f'LISTEN {CHANNEL}')
+            raw = connection.connection
+            while True:
+                if select.select([raw], [], [], 5.0) == ([], [], []):
+                    continue
+                raw.poll()
+                while raw.notifies:
+                    notify = raw.notifies.pop(0)
+                    event_id, table, data = notify.payload.split('\n', 2)
+                    self.feed.publish((event_id, table, data))
+        finally:
+            connection.close()
+
+
+def _payloads(action, rows):
+    """returns the serialized data of rows, split into groups that fit a
+    NOTIFY payload
+    """
+    data = flask_json.dumps({'action': action, 'rows': rows})
+    if len(data.encode('utf-8')) <= MAX_PAYLOAD or len(rows) == 1:
+        return [data]
+    middle = len(rows) // 2
+    return _payloads(action, rows[:middle]) + _payloads(action, rows[middle:])
+
+
+class ChangeStream(object):
+    def init_app(self, app):
+        feed = ChangeFeed(app.config['CHANGES_HISTORY_SIZE'],
+                          app.config['CHANGES_QUEUE_SIZE'])
+        bridge = None
+        url = app.config['SQLALCHEMY_DATABASE_URI']
+        if url.startswith(('postgres://', 'postgresql')):
+            bridge = PostgresBridge(url, feed)
+        app.extensions['change_feed'] = (feed, bridge)
+
+    @property
+    def _state(self):
+        # like the models, fall back to the app bound by setup_db
+        app = current_app if has_app_context() else db.app
+        if app is None:
+            return None, None
+        return app.extensions.get('change_feed', (None, None))
+
+    @property
+    def feed(self):
+        return self._state[0]
+
+    def notify(self, tablename, action, rows):
+        """sends a write about to commit through NOTIFY, on Postgres"""
+        feed, bridge = self._state
+        if bridge is None:
+            return
+        for data in _payloads(action, rows):
+            event_id = uuid.uuid4().hex[:16]
+            db.session.execute(sql_select([func.pg_notify(
+                CHANNEL, f'{event_id}\n{tablename}\n{data}')]))
+
+    def publish(self, tablename, action, rows):
+        """publishes a committed write in this worker, on databases
+        without NOTIFY
+        """
+        feed, bridge = self._state
+        if feed is None or bridge is not None:
+            return
+        for data in _payloads(action, rows):
+            feed.publish((uuid.uuid4().hex[:16], tablename, data))
+
+    def stream(self, tables, last_event_id=None):
+        '''returns the text/event-stream response of the events of tables
+            the response ends after CHANGES_MAX_STREAM_SECONDS, clients
+            reconnect with Last-Event-ID and carry on
+        '''
+        feed, bridge = self._state
+        if bridge is not None:
+            bridge.start()
+        config = current_app.config
+        heartbeat = config['CHANGES_HEARTBEAT_SECONDS']
+        duration = config['CHANGES_MAX_STREAM_SECONDS']
+        subscriber = feed.subscribe(tables, last_event_id)
+
+        def generate():
+            try:
+                yield f'retry: {config["CHANGES_RETRY_MS"]}\n\n'
+                deadline = time.monotonic() + duration
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    reset, events = subscriber.wait(min(heartbeat,
+                                                        remaining))
+                    if reset is not None:
+                        yield ('event: reset\ndata: ' +
+                               flask_json.dumps({'reason': reset}) + '\n\n')
+                    if reset is None and not events:
+                        yield ': keepalive\n\n'
+                    for event_id, table, data in events:
+                        yield f'id: {event_id}\nevent: {table}\n' \
+                            f'data: {data}\n\n'
+            finally:
+                feed.unsubscribe(subscriber)
+
+        return Response(generate(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+
+
+changes = ChangeStream()
+on_write(changes.notify)
+on_change(changes.publish)
@@ -8,10 +8,110 @@ class Config(object):
     CSRF_ENABLED = True
     SECRET_KEY = os.environ['SECRET']
     SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URL']
+    # comma separated read replicas of DATABASE_URL for the GET endpoints
+    DATABASE_REPLICA_URLS = [
+        url.strip() for url in
+        os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    # replicas further behind are skipped, and tables written to more
+    # recently are read from the primary; health is checked this often
+    REPLICA_MAX_LAG_SECONDS = float(
+        os.environ.get('REPLICA_MAX_LAG_SECONDS', 5))
+    REPLICA_CHECK_SECONDS = float(os.environ.get('REPLICA_CHECK_SECONDS', 10))
+    # connection pool of every worker process; keep
+    # workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) below max_connections
+    # and DB_POOL_SIZE at about the number of threads per worker
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 5))
+    # seconds to wait for a free connection before failing the request
+    DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+    # connections are replaced after DB_POOL_RECYCLE seconds and tested
+    # before use, so the pool recovers from failovers and idle timeouts
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    DB_POOL_PRE_PING = True
+    # Postgres cancels statements running longer than this, 0 disables it
+    DB_STATEMENT_TIMEOUT_MS = int(
+        os.environ.get('DB_STATEMENT_TIMEOUT_MS', 30000))
+    # checkouts waiting at least this long are logged
+    DB_POOL_SLOW_CHECKOUT_MS = float(
+        os.environ.get('DB_POOL_SLOW_CHECKOUT_MS', 100))
+    # page size of GET /movies and GET /actors, clients can ask for fewer
+    # or more rows with ?limit= up to MAX_PAGE_SIZE
+    PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 50))
+    MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+    # rows fetched and written per chunk by streamed dumps (?stream=1)
+    STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 1000))
+    # most items accepted by POST /movies/bulk and POST /actors/bulk
+    MAX_BULK_SIZE = int(os.environ.get('MAX_BULK_SIZE', 10000))
+    # response cache of the GET endpoints: 'local' (per process LRU of at
+    # most CACHE_MAX_BYTES), 'redis' (shared, at CACHE_URL) or 'none'
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'local')
+    CACHE_URL = os.environ.get('CACHE_URL')
+    CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    # upper bound on the age of a cached response, writes that bypass the
+    # models (psql, other services) show up after at most this long
+    CACHE_TTL = int(os.environ.get('CACHE_TTL', 300))
+    # Cache-Control of the cacheable GET responses; the default lets
+    # clients keep a copy but makes them revalidate it with its ETag
+    CACHE_CONTROL = os.environ.get('CACHE_CONTROL', 'private, no-cache')
+    # ?since= syncs leave out changes younger than SYNC_SETTLE_SECONDS, so
+    # transactions still committing are picked up by the next sync
+    SYNC_SETTLE_SECONDS = float(os.environ.get('SYNC_SETTLE_SECONDS', 2))
+    # tombstones of deleted rows are kept this long by
+    # `manage.py prune_tombstones`, older ?since= cursors get a 410
+    TOMBSTONE_RETENTION_DAYS = int(
+        os.environ.get('TOMBSTONE_RETENTION_DAYS', 30))
+    # GET /changes keeps the last CHANGES_HISTORY_SIZE events for clients
+    # resuming with Last-Event-ID, and at most CHANGES_QUEUE_SIZE undelivered
+    # events per client before it is told to resync
+    CHANGES_HISTORY_SIZE = int(os.environ.get('CHANGES_HISTORY_SIZE', 1000))
+    CHANGES_QUEUE_SIZE = int(os.environ.get('CHANGES_QUEUE_SIZE', 100))
+    # keepalive comment interval, and how long one response streams before
+    # the client is asked to reconnect (after CHANGES_RETRY_MS)
+    CHANGES_HEARTBEAT_SECONDS = float(
+        os.environ.get('CHANGES_HEARTBEAT_SECONDS', 15))
+    CHANGES_MAX_STREAM_SECONDS = float(
+        os.environ.get('CHANGES_MAX_STREAM_SECONDS', 300))
+    CHANGES_RETRY_MS = int(os.environ.get('CHANGES_RETRY_MS', 1000))
+    # threads running the views under asgi.py, 0 for one per pooled
+    # connection (DB_POOL_SIZE + DB_MAX_OVERFLOW); every open GET /changes
+    # stream holds one while it waits for events
+    ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 0))
+    # directory shared by the worker processes for GET /metrics, empty it
+    # when the server starts; unset, every worker reports its own requests
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    # statements slower than this are logged with their parameter types
+    SQL_SLOW_QUERY_MS = float(os.environ.get('SQL_SLOW_QUERY_MS', 200))
+    # a statement run this many times in one request is logged as an N+1
+    SQL_REPEAT_THRESHOLD = int(os.environ.get('SQL_REPEAT_THRESHOLD', 5))
+    # send the query count and time of every request as Server-Timing
+    SQL_SERVER_TIMING = os.environ.get(
+        'SQL_SERVER_TIMING', 'true').lower() == 'true'
+    # sorts of GET /movies and GET /actors that no index returns in order
+    # are sorted by the database for every page; off, they get a 400
+    ALLOW_UNINDEXED_SORTS = os.environ.get(
+        'ALLOW_UNINDEXED_SORTS', 'true').lower() == 'true'
+    # GET /autocomplete: keys kept per table in every worker (about 150
+    # bytes each), how often the index is read again for the writes of
+    # other workers, and the default and largest number of suggestions
+    AUTOCOMPLETE_MAX_ENTRIES = int(
+        os.environ.get('AUTOCOMPLETE_MAX_ENTRIES', 200000))
+    AUTOCOMPLETE_REFRESH_SECONDS = float(
+        os.environ.get('AUTOCOMPLETE_REFRESH_SECONDS', 300))
+    # an index whose read failed is read again after this long
+    AUTOCOMPLETE_RETRY_SECONDS = float(
+        os.environ.get('AUTOCOMPLETE_RETRY_SECONDS', 30))
+    AUTOCOMPLETE_LIMIT = int(os.environ.get('AUTOCOMPLETE_LIMIT', 10))
+    AUTOCOMPLETE_MAX_LIMIT = int(os.environ.get('AUTOCOMPLETE_MAX_LIMIT', 50))
+    # read the index in a background thread at the first request
+    AUTOCOMPLETE_BACKGROUND_BUILD = True
 
 
 class ProductionConfig(Config):
     DEBUG = False
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    ALLOW_UNINDEXED_SORTS = os.environ.get(
+        'ALLOW_UNINDEXED_SORTS', 'false').lower() == 'true'
 
 
 class StagingConfig(Config):
@@ -22,7 +122,17 @@ class StagingConfig(Config):
 class DevelopmentConfig(Config):
     DEVELOPMENT = True
     DEBUG = True
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 2))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 2))
+    CACHE_CONTROL = os.environ.get('CACHE_CONTROL', 'no-store')
 
 
 class TestingConfig(Config):
     TESTING = True
+    # tests hold few connections, fail fast instead of hanging on a leak
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 2))
+    DB_MAX_OVERFLOW = 0
+    DB_POOL_TIMEOUT = 5
+    DB_POOL_PRE_PING = False
+    # tests read the index themselves, on the connection of the test
+    AUTOCOMPLETE_BACKGROUND_BUILD = False
@@ -1,12 +1,24 @@
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
-from app import app
+from app import create_app
+from datetime import datetime, timedelta
+import models
 from models import db
 
+app = create_app()
 migrate = Migrate(app, db)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
+
+@manager.command
+def prune_tombstones():
+    """deletes tombstones older than TOMBSTONE_RETENTION_DAYS"""
+    retention = timedelta(days=app.config['TOMBSTONE_RETENTION_DAYS'])
+    count = models.prune_tombstones(datetime.utcnow() - retention)
+    print(f'deleted {count} tombstones')
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,273 @@
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request
+from flask.json import JSONEncoder
+from sqltrace import request_trace
+
+
+'''
+Request metrics for GET /metrics (Prometheus text format)
+
+    http_request_duration_seconds: latency histogram of every request, by
+        route (the URL rule, e.g. /movies/<int:movie_id>), method and status
+    http_request_phase_seconds: time of a request spent in one phase, by
+        route and phase:
+        auth_header: get_token_auth_header
+        verify_jwt: verify_token, the token cache and verify_decode_jwt
+        permissions: check_permissions
+        db: the SQL statements, on the primary and the replicas, as timed
+            by sqltrace.py
+        serialize: JSON encoding of the responses
+    without METRICS_DIR every worker reports only its own requests
+    with METRICS_DIR every worker process adds its values to its own
+        mmap'd file in that directory and GET /metrics sums the files of
+        all of them, so any worker answers for the whole server; empty the
+        directory when the server starts, the files of workers that exited
+        since are still counted
+'''
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+PHASE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                 0.25, 0.5, 1.0)
+HISTOGRAMS = {
+    'http_request_duration_seconds': (
+        'Time to handle a request.', REQUEST_BUCKETS),
+    'http_request_phase_seconds': (
+        'Time of a request spent in one phase.', PHASE_BUCKETS)
+}
+
+
+class LocalValues(object):
+    '''the values of this process only'''
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+
+class MmapValues(object):
+    '''one mmap'd file of values per process in directory, read by all
+        layout: the used length, then per value the length of its key, the
+        key padded to 8 bytes and the value as a double; the used length
+        is written last, so a reader never sees half a value
+    '''
+    initial_size = 64 * 1024
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.pid = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # a new file after a fork, the parent keeps its own
+        self.pid = os.getpid()
+        path = os.path.join(self.directory, f'metrics_{self.pid}.db')
+        self._file = open(path, 'a+b')
+        size = max(os.fstat(self._file.fileno()).st_size, self.initial_size)
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._positions = {key: position for key, _, position
+                           in _entries(self._map)}
+        self._used = _used(self._map)
+
+    def add(self, key, amount):
+        with self._lock:
+            if self.pid != os.getpid():
+                self._open()
+            position = self._positions.get(key)
+            if position is None:
+                position = self._append(key)
+            value, = struct.unpack_from('<d', self._map, position)
+            struct.pack_into('<d', self._map, position, value + amount)
+
+    def _append(self, key):
+        encoded = key.encode('utf-8')
+        padded = encoded + b' ' * (-(4 + len(encoded)) % 8)
+        end = self._used + 4 + len(padded) + 8
+        if end > len(self._map):
+            size = max(end, len(self._map) * 2)
+            self._map.close()
+            self._file.truncate(size)
+            self._map = mmap.mmap(self._file.fileno(), size)
+        struct.pack_into(f'<I{len(padded)}sd', self._map, self._used,
+                         len(padded), padded, 0.0)
+        position = end - 8
+        self._positions[key] = position
+        self._used = end
+        struct.pack_into('<Q', self._map, 0, end)
+        return position
+
+    def items(self):
+        totals = {}
+        for path in glob.glob(os.path.join(self.directory, 'metrics_*.db')):
+            with open(path, 'rb') as metrics_file:
+                data = metrics_file.read()
+            for key, value, _ in _entries(data):
+                totals[key] = totals.get(key, 0.0) + value
+        return list(totals.items())
+
+
+def _used(data):
+    used, = struct.unpack_from('<Q', data, 0)
+    return used or 8
+
+
+def _entries(data):
+    """returns (key, value, position of the value) of every value"""
+    entries = []
+    position = 8
+    used = min(_used(data), len(data))
+    while position < used:
+        length, = struct.unpack_from('<I', data, position)
+        key = bytes(data[position + 4:position + 4 + length])
+        position += 4 + length
+        value, = struct.unpack_from('<d', data, position)
+        entries.append((key.decode('utf-8').rstrip(' '), value, position))
+        position += 8
+    return entries
+
+
+class Registry(object):
+    def __init__(self, values):
+        self.values = values
+
+    def observe(self, name, labels, value):
+        """adds value to the histogram name"""
+        buckets = HISTOGRAMS[name][1]
+        index = bisect_left(buckets, value)
+        le = str(buckets[index]) if index < len(buckets) else '+Inf'
+        labels = sorted(labels.items())
+        self.values.add(_key(name, 'bucket', labels + [('le', le)]), 1.0)
+        self.values.add(_key(name, 'sum', labels), value)
+        self.values.add(_key(name, 'count', labels), 1.0)
+
+    def render(self):
+        """returns every histogram in the Prometheus text format"""
+        series = {}
+        for key, value in self.values.items():
+            name, suffix, labels = json.loads(key)
+            labels = [tuple(label) for label in labels]
+            if suffix == 'bucket':
+                le = labels.pop()[1]
+                series.setdefault((name, tuple(labels)), {})[le] = value
+            else:
+                series.setdefault((name, tuple(labels)), {})[suffix] = value
+
+        lines = []
+        for name, (help_text, buckets) in sorted(HISTOGRAMS.items()):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for (series_name, labels), values in sorted(series.items()):
+                if series_name != name:
+                    continue
+                total = 0.0
+                for le in [str(bucket) for bucket in buckets] + ['+Inf']:
+                    total += values.get(le, 0.0)
+                    lines.append(f'{name}_bucket'
+                                 f'{_labels(labels + (("le", le),))} '
+                                 f'{_number(total)}')
+                lines.append(f'{name}_sum{_labels(labels)} '
+                             f'{_number(values.get("sum", 0.0))}')
+                lines.append(f'{name}_count{_labels(labels)} '
+                             f'{_number(values.get("count", 0.0))}')
+        return '\n'.join(lines) + '\n'
+
+
+def _key(name, suffix, labels):
+    return json.dumps([name, suffix, labels], separators=(',', ':'))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = [(name, value.replace('\\', r'\\').replace('"', r'\"')
+                .replace('\n', r'\n')) for name, value in labels]
+    return '{' + ','.join(f'{name}="{value}"'
+                          for name, value in escaped) + '}'
+
+
+def _number(value):
+    return repr(int(value)) if value == int(value) else repr(value)
+
+
+def add_time(phase, seconds):
+    """adds seconds to phase of the current request"""
+    if has_request_context():
+        phases = g.setdefault('metrics_phases', {})
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def timed(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(phase, time.perf_counter() - start)
+
+
+class TimedJSONEncoder(JSONEncoder):
+    def encode(self, o):
+        with timed('serialize'):
+            return super().encode(o)
+
+
+class Metrics(object):
+    def init_app(self, app):
+        directory = app.config['METRICS_DIR']
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            values = MmapValues(directory)
+        else:
+            values = LocalValues()
+        app.extensions['metrics'] = Registry(values)
+        app.json_encoder = TimedJSONEncoder
+        app.before_request(self._start)
+        app.after_request(self._record)
+
+    @staticmethod
+    def _start():
+        g.metrics_started = time.perf_counter()
+
+    @staticmethod
+    def _record(response):
+        started = g.get('metrics_started')
+        if started is None:
+            return response
+        registry = current_app.extensions['metrics']
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        registry.observe('http_request_duration_seconds', {
+            'route': route,
+            'method': request.method,
+            'status': str(response.status_code)
+        }, time.perf_counter() - started)
+        phases = dict(g.get('metrics_phases', {}))
+        trace = request_trace()
+        if trace is not None:
+            phases['db'] = trace.seconds
+        for phase, seconds in phases.items():
+            registry.observe('http_request_phase_seconds',
+                             {'route': route, 'phase': phase}, seconds)
+        return response
+
+    def render(self):
+        """returns the metrics of every worker in the Prometheus format"""
+        return current_app.extensions['metrics'].render()
+
+
+metrics = Metrics()
@@ -0,0 +1,55 @@
+"""initial schema
+
+Revision ID: 3f2c1a7d9e10
+Revises:
+Create Date: 2026-10-18 09:12:41.302118
+
+Databases created by db.create_all() before migrations existed already
+have these tables; they are left alone so `db upgrade` can run on them.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2c1a7d9e10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    tables = sa.inspect(op.get_bind()).get_table_names()
+
+    if 'movies' not in tables:
+        op.create_table(
+            'movies',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(length=80), nullable=False),
+            sa.Column('release_date', sa.Date(), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('title')
+        )
+    if 'actors' not in tables:
+        op.create_table(
+            'actors',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(length=80), nullable=False),
+            sa.Column('gender', sa.String(length=6), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'movie_actor_relationship' not in tables:
+        op.create_table(
+            'movie_actor_relationship',
+            sa.Column('movie_id', sa.Integer(), nullable=True),
+            sa.Column('actor_id', sa.Integer(), nullable=True),
+            sa.ForeignKeyConstraint(['actor_id'], ['actors.id']),
+            sa.ForeignKeyConstraint(['movie_id'], ['movies.id'])
+        )
+
+
+def downgrade():
+    op.drop_table('movie_actor_relationship')
+    op.drop_table('actors')
+    op.drop_table('movies')
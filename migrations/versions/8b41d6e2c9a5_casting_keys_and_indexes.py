@@ -0,0 +1,154 @@
+"""casting keys and indexes
+
+Revision ID: 8b41d6e2c9a5
+Revises: 3f2c1a7d9e10
+Create Date: 2026-10-18 10:03:17.884512
+
+- composite primary key (movie_id, actor_id) on movie_actor_relationship,
+  incomplete and duplicate castings are dropped first
+- index on movie_actor_relationship.actor_id for lookups by actor
+- ON DELETE CASCADE on both movie_actor_relationship foreign keys
+- (name, id) on actors and (release_date, id) on movies, for the keyset
+  pagination sorts of GET /actors and GET /movies
+
+On Postgres the indexes are built CONCURRENTLY and the foreign keys are
+added NOT VALID and validated afterwards, so the migration can run against
+a live database without blocking writes for the length of a table scan.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b41d6e2c9a5'
+down_revision = '3f2c1a7d9e10'
+branch_labels = None
+depends_on = None
+
+LINK = 'movie_actor_relationship'
+PRIMARY_KEY = 'movie_actor_relationship_pkey'
+INDEXES = [
+    ('ix_movie_actor_relationship_actor_id', LINK, ['actor_id']),
+    ('ix_actors_name_id', 'actors', ['name', 'id']),
+    ('ix_movies_release_date_id', 'movies', ['release_date', 'id']),
+]
+FOREIGN_KEYS = [
+    ('movie_actor_relationship_movie_id_fkey', 'movie_id', 'movies'),
+    ('movie_actor_relationship_actor_id_fkey', 'actor_id', 'actors'),
+]
+
+
+def _has_primary_key(inspector):
+    return bool(inspector.get_pk_constraint(LINK)['constrained_columns'])
+
+
+def _index_names(inspector, table):
+    return set(index['name'] for index in inspector.get_indexes(table))
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if bind.dialect.name == 'postgresql':
+        _upgrade_postgres(inspector)
+    else:
+        _upgrade_generic(inspector)
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        _downgrade_postgres()
+    else:
+        _downgrade_generic()
+
+
+def _upgrade_postgres(inspector):
+    add_primary_key = not _has_primary_key(inspector)
+    if add_primary_key:
+        op.execute(f'DELETE FROM {LINK} '
+                   'WHERE movie_id IS NULL OR actor_id IS NULL')
+        op.execute(f'DELETE FROM {LINK} a USING {LINK} b '
+                   'WHERE a.ctid < b.ctid AND a.movie_id = b.movie_id '
+                   'AND a.actor_id = b.actor_id')
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with op.get_context().autocommit_block():
+        if add_primary_key:
+            op.execute(f'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS '
+                       f'{PRIMARY_KEY} ON {LINK} (movie_id, actor_id)')
+        for name, table, columns in INDEXES:
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} '
+                       f'ON {table} ({", ".join(columns)})')
+
+    if add_primary_key:
+        op.execute(f'ALTER TABLE {LINK} ADD CONSTRAINT {PRIMARY_KEY} '
+                   f'PRIMARY KEY USING INDEX {PRIMARY_KEY}')
+
+    cascading = set(
+        foreign_key['name'] for foreign_key in inspector.get_foreign_keys(LINK)
+        if foreign_key['options'].get('ondelete', '').upper() == 'CASCADE')
+    for name, column, table in FOREIGN_KEYS:
+        if name in cascading:
+            continue
+        op.execute(f'ALTER TABLE {LINK} DROP CONSTRAINT IF EXISTS {name}, '
+                   f'ADD CONSTRAINT {name} FOREIGN KEY ({column}) '
+                   f'REFERENCES {table} (id) ON DELETE CASCADE NOT VALID')
+        op.execute(f'ALTER TABLE {LINK} VALIDATE CONSTRAINT {name}')
+
+
+def _downgrade_postgres():
+    for name, column, table in FOREIGN_KEYS:
+        op.execute(f'ALTER TABLE {LINK} DROP CONSTRAINT IF EXISTS {name}, '
+                   f'ADD CONSTRAINT {name} FOREIGN KEY ({column}) '
+                   f'REFERENCES {table} (id) NOT VALID')
+        op.execute(f'ALTER TABLE {LINK} VALIDATE CONSTRAINT {name}')
+
+    op.execute(f'ALTER TABLE {LINK} DROP CONSTRAINT IF EXISTS {PRIMARY_KEY}')
+    op.execute(f'ALTER TABLE {LINK} ALTER COLUMN movie_id DROP NOT NULL, '
+               'ALTER COLUMN actor_id DROP NOT NULL')
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+
+def _create_link_table(name, primary_key):
+    op.create_table(
+        name,
+        sa.Column('movie_id', sa.Integer(), nullable=not primary_key),
+        sa.Column('actor_id', sa.Integer(), nullable=not primary_key),
+        sa.ForeignKeyConstraint(['movie_id'], ['movies.id'],
+                                ondelete='CASCADE' if primary_key else None),
+        sa.ForeignKeyConstraint(['actor_id'], ['actors.id'],
+                                ondelete='CASCADE' if primary_key else None),
+        *([sa.PrimaryKeyConstraint('movie_id', 'actor_id')]
+          if primary_key else [])
+    )
+
+
+def _rebuild_link_table(primary_key):
+    # SQLite can't add a primary key or change a foreign key in place
+    _create_link_table(f'{LINK}_new', primary_key)
+    op.execute(f'INSERT INTO {LINK}_new (movie_id, actor_id) '
+               f'SELECT DISTINCT movie_id, actor_id FROM {LINK} '
+               'WHERE movie_id IS NOT NULL AND actor_id IS NOT NULL')
+    op.drop_table(LINK)
+    op.rename_table(f'{LINK}_new', LINK)
+
+
+def _upgrade_generic(inspector):
+    if not _has_primary_key(inspector):
+        _rebuild_link_table(primary_key=True)
+        inspector = sa.inspect(op.get_bind())
+
+    for name, table, columns in INDEXES:
+        if name not in _index_names(inspector, table):
+            op.create_index(name, table, columns)
+
+
+def _downgrade_generic():
+    for name, table, columns in INDEXES:
+        if table != LINK:
+            op.drop_index(name, table_name=table)
+    _rebuild_link_table(primary_key=False)
@@ -0,0 +1,44 @@
+"""table versions
+
+Revision ID: a3d8f5c1e972
+Revises: f1b7c94e2d08
+Create Date: 2026-10-18 21:12:40.508113
+
+- table_versions: the version and time of the last write of movies,
+  actors and movie_actor_relationship, bumped by every write and read by
+  the response cache for its keys and validators
+- every table starts at version 0, changed at the time of the migration
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3d8f5c1e972'
+down_revision = 'f1b7c94e2d08'
+branch_labels = None
+depends_on = None
+
+TABLES = ['movies', 'actors', 'movie_actor_relationship']
+
+
+def upgrade():
+    if 'table_versions' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    table = op.create_table(
+        'table_versions',
+        sa.Column('table_name', sa.String(length=40), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('changed_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('table_name')
+    )
+    now = datetime.utcnow()
+    op.bulk_insert(table, [
+        {'table_name': name, 'version': 0, 'changed_at': now}
+        for name in TABLES])
+
+
+def downgrade():
+    op.drop_table('table_versions')
@@ -0,0 +1,115 @@
+"""change tracking
+
+Revision ID: c4a9e2f7b613
+Revises: 8b41d6e2c9a5
+Create Date: 2026-10-18 13:26:05.217930
+
+- created_at and updated_at on movies and actors, existing rows get the
+  time of the migration
+- (updated_at, id) indexes for the ?since= scans of changed rows
+- tombstones table of deleted ids, indexed for the ?since= scans of
+  deleted rows
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4a9e2f7b613'
+down_revision = '8b41d6e2c9a5'
+branch_labels = None
+depends_on = None
+
+TABLES = ['movies', 'actors']
+COLUMNS = ['created_at', 'updated_at']
+INDEXES = [
+    ('ix_movies_updated_at_id', 'movies', ['updated_at', 'id']),
+    ('ix_actors_updated_at_id', 'actors', ['updated_at', 'id']),
+    ('ix_tombstones_table_name_deleted_at', 'tombstones',
+     ['table_name', 'deleted_at', 'row_id']),
+]
+
+
+def _create_tombstones():
+    op.create_table(
+        'tombstones',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('table_name', sa.String(length=40), nullable=False),
+        sa.Column('row_id', sa.Integer(), nullable=False),
+        sa.Column('deleted_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if 'tombstones' not in inspector.get_table_names():
+        _create_tombstones()
+
+    if bind.dialect.name == 'postgresql':
+        _upgrade_postgres(inspector)
+    else:
+        _upgrade_generic(inspector)
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+    else:
+        for name, table, columns in INDEXES:
+            op.drop_index(name, table_name=table)
+
+    op.drop_table('tombstones')
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch:
+            for column in COLUMNS:
+                batch.drop_column(column)
+
+
+def _upgrade_postgres(inspector):
+    # now() is stable, so the default is stored once instead of being
+    # written to every row, and dropping it afterwards keeps the values
+    for table in TABLES:
+        existing = [column['name'] for column in inspector.get_columns(table)]
+        for column in COLUMNS:
+            if column in existing:
+                continue
+            op.execute(f'ALTER TABLE {table} ADD COLUMN {column} timestamp '
+                       "NOT NULL DEFAULT (now() AT TIME ZONE 'utc')")
+            op.execute(f'ALTER TABLE {table} ALTER COLUMN {column} '
+                       'DROP DEFAULT')
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} '
+                       f'ON {table} ({", ".join(columns)})')
+
+
+def _upgrade_generic(inspector):
+    # SQLite can't add a NOT NULL column without a constant default
+    for table in TABLES:
+        existing = [column['name'] for column in inspector.get_columns(table)]
+        added = [column for column in COLUMNS if column not in existing]
+        for column in added:
+            op.add_column(table, sa.Column(column, sa.DateTime()))
+        if not added:
+            continue
+        op.execute(sa.table(table, *[sa.column(column) for column in added])
+                   .update().values({column: sa.func.current_timestamp()
+                                     for column in added}))
+        with op.batch_alter_table(table) as batch:
+            for column in added:
+                batch.alter_column(column, existing_type=sa.DateTime(),
+                                   nullable=False)
+
+    inspector = sa.inspect(op.get_bind())
+    for name, table, columns in INDEXES:
+        if name not in [index['name']
+                        for index in inspector.get_indexes(table)]:
+            op.create_index(name, table, columns)
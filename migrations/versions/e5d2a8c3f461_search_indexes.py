@@ -0,0 +1,83 @@
+"""search indexes
+
+Revision ID: e5d2a8c3f461
+Revises: c4a9e2f7b613
+Create Date: 2026-10-18 16:40:52.610384
+
+- search indexes of movies.title and actors.name for GET /movies/search
+  and GET /actors/search
+- Postgres: the pg_trgm extension, a GIN index of
+  to_tsvector('simple', column) and a GIN trigram index, built
+  CONCURRENTLY
+- SQLite: an FTS5 table <table>_search per table, filled from the existing
+  rows and kept up to date by triggers
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5d2a8c3f461'
+down_revision = 'c4a9e2f7b613'
+branch_labels = None
+depends_on = None
+
+COLUMNS = [('movies', 'title'), ('actors', 'name')]
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        _upgrade_postgres()
+    elif bind.dialect.name == 'sqlite':
+        _upgrade_sqlite(sa.inspect(bind))
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for table, column in COLUMNS:
+                for suffix in ('words', 'trgm'):
+                    op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS '
+                               f'ix_{table}_{column}_{suffix}')
+    elif bind.dialect.name == 'sqlite':
+        for table, column in COLUMNS:
+            for action in ('insert', 'delete', 'update'):
+                op.execute(f'DROP TRIGGER IF EXISTS {table}_search_{action}')
+            op.execute(f'DROP TABLE IF EXISTS {table}_search')
+
+
+def _upgrade_postgres():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with op.get_context().autocommit_block():
+        for table, column in COLUMNS:
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS '
+                       f'ix_{table}_{column}_words ON {table} '
+                       f"USING gin (to_tsvector('simple', {column}))")
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS '
+                       f'ix_{table}_{column}_trgm ON {table} '
+                       f'USING gin ({column} gin_trgm_ops)')
+
+
+def _upgrade_sqlite(inspector):
+    tables = inspector.get_table_names()
+    for table, column in COLUMNS:
+        search = f'{table}_search'
+        if search in tables:
+            continue
+        insert = (f'INSERT INTO {search} (rowid, {column}) '
+                  f'VALUES (new.id, new.{column});')
+        delete = (f"INSERT INTO {search} ({search}, rowid, {column}) "
+                  f"VALUES ('delete', old.id, old.{column});")
+        op.execute(f"CREATE VIRTUAL TABLE {search} USING fts5({column}, "
+                   f"content='{table}', content_rowid='id', prefix='2 3')")
+        op.execute(f'CREATE TRIGGER {search}_insert AFTER INSERT ON {table} '
+                   f'BEGIN {insert} END')
+        op.execute(f'CREATE TRIGGER {search}_delete AFTER DELETE ON {table} '
+                   f'BEGIN {delete} END')
+        op.execute(f'CREATE TRIGGER {search}_update AFTER UPDATE OF '
+                   f'{column} ON {table} BEGIN {delete} {insert} END')
+        op.execute(f"INSERT INTO {search} ({search}) VALUES ('rebuild')")
@@ -0,0 +1,43 @@
+"""actors gender index
+
+Revision ID: f1b7c94e2d08
+Revises: e5d2a8c3f461
+Create Date: 2026-10-18 19:05:33.471926
+
+- (gender, name, id) on actors, for GET /actors?gender= filters, sorted
+  by name with keyset pagination
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1b7c94e2d08'
+down_revision = 'e5d2a8c3f461'
+branch_labels = None
+depends_on = None
+
+INDEX = ('ix_actors_gender_name_id', 'actors', ['gender', 'name', 'id'])
+
+
+def upgrade():
+    name, table, columns = INDEX
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        # CREATE INDEX CONCURRENTLY can't run inside a transaction
+        with op.get_context().autocommit_block():
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} '
+                       f'ON {table} ({", ".join(columns)})')
+    elif name not in [index['name'] for index in
+                      sa.inspect(bind).get_indexes(table)]:
+        op.create_index(name, table, columns)
+
+
+def downgrade():
+    name, table, columns = INDEX
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+    else:
+        op.drop_index(name, table_name=table)
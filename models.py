@@ -1,29 +1,43 @@
 from sqlalchemy import Column, String, create_engine
-from sqlalchemy import Table, Integer, ForeignKey, Date
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Table, Integer, ForeignKey, Date, bindparam, select
+from sqlalchemy import literal_column, DateTime, event, text
+from pool import engine_options, guard_fork
+from routing import RoutingSQLAlchemy
+from sqltrace import sql_trace, trace_engine
+import calendar
 import json
+import logging
 import os
-from datetime import date
+from datetime import date, datetime
 
 
-db = SQLAlchemy()
-
-database_path = os.environ['DATABASE_URL']
-
+db = RoutingSQLAlchemy()
+logger = logging.getLogger('casting.models')
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    the engine and pool options come from the DB_* settings of the Config
+        class, see pool.py
+    every statement is timed and counted per request, see sqltrace.py
+    no connection is opened and no schema is created here; the tables are
+        created by `python manage.py db upgrade`
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None):
     app.config.from_object(os.environ['APP_SETTINGS'])
+    database_path = database_path or app.config['SQLALCHEMY_DATABASE_URI']
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        app.config, database_path)
     db.app = app
     db.init_app(app)
-    db.create_all()
+    engine = db.get_engine(app)
+    guard_fork(engine)
+    trace_engine(engine, app.config)
+    sql_trace.init_app(app)
 
 
 def db_drop_and_create_all():
@@ -41,33 +55,405 @@ def db_init_records():
 
     new_movie = (Movies(title='Fight Club', release_date=date.today()))
 
+    new_actor.insert()
+    new_movie.insert()
+
     new_relationship = movie_actor_relationship.insert().values(
-        Movie_id=new_movie.id,
-        Actor_id=new_actor.id,
+        movie_id=new_movie.id,
+        actor_id=new_actor.id,
     )
 
-    new_actor.insert()
-    new_movie.insert()
     db.session.execute(new_relationship)
+    _touch('movie_actor_relationship')
     db.session.commit()
 
 
+'''
+change listeners
+    callables registered with on_change(listener) are called after every
+        committed write made through the model methods as
+        listener(tablename, action, rows); the write is committed by then,
+        so an error of a listener is logged rather than raised
+    callables registered with on_write(listener) are called the same way
+        inside the write transaction, just before it commits: what they
+        write commits, or rolls back, with the write and in its order
+    action is 'insert', 'update' or 'delete'
+    rows are dicts of the written columns, always including the primary key
+'''
+
+_change_listeners = []
+_write_listeners = []
+
+
+def on_change(listener):
+    """registers listener for committed writes, returns it"""
+    _change_listeners.append(listener)
+    return listener
+
+
+def on_write(listener):
+    """registers listener for writes about to commit, returns it"""
+    _write_listeners.append(listener)
+    return listener
+
+
+def notify_change(tablename, action, rows):
+    """calls the change listeners"""
+    if not rows:
+        return
+    for listener in _change_listeners:
+        try:
+            listener(tablename, action, rows)
+        except Exception:
+            logger.exception('change listener %r failed on %s %s',
+                             listener, action, tablename)
+
+
+def _commit(*changes):
+    """commits the session, calling the write listeners of changes,
+    (tablename, action, rows) tuples, before and the change listeners
+    after
+    """
+    changes = [change for change in changes if change[2]]
+    for change in changes:
+        for listener in _write_listeners:
+            listener(*change)
+    db.session.commit()
+    for change in changes:
+        notify_change(*change)
+
+
+def _cascade(column, ids):
+    """returns the change of the castings removed along with deleted
+    movies or actors
+    """
+    return ('movie_actor_relationship', 'delete',
+            [{column: id} for id in ids])
+
+
+# rows per multi-row INSERT statement of the bulk methods
+BULK_CHUNK_SIZE = 500
+
+
+def _chunks(rows, size=BULK_CHUNK_SIZE):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def _is_postgres():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def _execute_for_ids(table, statement, ids):
+    """runs an UPDATE or DELETE statement restricted to ids and returns
+    the ids of the rows it touched
+    """
+    statement = statement.where(table.c.id.in_(ids))
+    if _is_postgres():
+        result = db.session.execute(statement.returning(table.c.id))
+        return [id for id, in result]
+    found = [id for id, in db.session.execute(
+        select([table.c.id]).where(table.c.id.in_(ids)))]
+    db.session.execute(statement)
+    return found
+
+
+def _update_ids(table, patches):
+    """applies patches (dicts of id and new column values) with one
+    statement per chunk of patches setting the same columns: an
+    UPDATE ... FROM (VALUES ...) on Postgres, an executemany of
+    UPDATE ... WHERE id = ? elsewhere
+    returns the ids of the updated rows
+    """
+    groups = {}
+    for patch in patches:
+        columns = tuple(sorted(key for key in patch if key != 'id'))
+        groups.setdefault(columns, []).append(patch)
+
+    updated = []
+    for columns, group in groups.items():
+        for chunk in _chunks(group):
+            if _is_postgres():
+                updated += _update_from_values(table, columns, chunk)
+                continue
+            found = set(id for id, in db.session.execute(
+                select([table.c.id]).where(
+                    table.c.id.in_([patch['id'] for patch in chunk]))))
+            chunk = [patch for patch in chunk if patch['id'] in found]
+            if chunk:
+                db.session.execute(
+                    table.update().where(table.c.id == bindparam('b_id'))
+                    .values({column: bindparam('b_' + column)
+                             for column in columns}),
+                    [{'b_' + key: value for key, value in patch.items()}
+                     for patch in chunk])
+            updated += [patch['id'] for patch in chunk]
+    return updated
+
+
+def _update_from_values(table, columns, patches):
+    """updates the rows of patches, which all set columns, with a single
+    UPDATE ... FROM (VALUES ...) statement
+    returns the ids of the updated rows
+    """
+    dialect = db.session.get_bind().dialect
+    names = ('id',) + columns
+    types = [table.c[name].type.compile(dialect=dialect) for name in names]
+    rows = []
+    parameters = {'updated_at': datetime.utcnow()}
+    for i, patch in enumerate(patches):
+        for name in names:
+            parameters[f'{name}_{i}'] = patch[name]
+        # cast, the types of a VALUES list are guessed from its values
+        rows.append('(' + ', '.join(f'CAST(:{name}_{i} AS {type_})'
+                                    for name, type_ in zip(names, types))
+                    + ')')
+    assignments = ''.join(f'{name} = v.{name}, ' for name in columns)
+    statement = text(
+        f'UPDATE {table.name} SET {assignments}updated_at = :updated_at '
+        f'FROM (VALUES {", ".join(rows)}) AS v ({", ".join(names)}) '
+        f'WHERE {table.name}.id = v.id RETURNING {table.name}.id')
+    return [id for id, in db.session.execute(statement, parameters)]
+
+
+def _bury(tablename, ids):
+    """records a tombstone for every deleted id"""
+    if ids:
+        db.session.execute(Tombstones.__table__.insert(), [
+            {'table_name': tablename, 'row_id': id} for id in ids])
+
+
+def prune_tombstones(before):
+    """deletes the tombstones recorded before the datetime before
+    returns the number of tombstones deleted
+    """
+    result = db.session.execute(Tombstones.__table__.delete().where(
+        Tombstones.deleted_at < before))
+    db.session.commit()
+    return result.rowcount
+
+
+def _delete_ids(table, ids, link_column):
+    """deletes the rows with ids and their movie_actor_relationship rows
+    with one DELETE ... WHERE id IN (...) per chunk and table
+    returns the ids of the deleted rows
+    """
+    deleted = []
+    for chunk in _chunks(ids):
+        db.session.execute(movie_actor_relationship.delete().where(
+            link_column.in_(chunk)))
+        deleted += _execute_for_ids(table, table.delete(), chunk)
+    return deleted
+
+
 # Table to capture the N:N relationship between movies and actors
+# the primary key (movie_id, actor_id) serves lookups by movie, the
+# actor_id index lookups by actor
 movie_actor_relationship = db.Table(
     'movie_actor_relationship',
     db.Model.metadata,
-    db.Column('movie_id', db.Integer, db.ForeignKey('movies.id')),
-    db.Column('actor_id', db.Integer, db.ForeignKey('actors.id'))
+    db.Column('movie_id', db.Integer,
+              db.ForeignKey('movies.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Column('actor_id', db.Integer,
+              db.ForeignKey('actors.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Index('ix_movie_actor_relationship_actor_id', 'actor_id')
 )
 
 
+def _linked(ids, own_column, other_model, other_column):
+    """returns {id: [formatted other_model rows linked to id]} with one
+    joined query per chunk of ids
+    """
+    linked = {id: [] for id in ids}
+    columns = [getattr(other_model, name) for name in other_model.fields]
+    for chunk in _chunks(list(linked)):
+        rows = (db.session.query(own_column, *columns)
+                .join(other_model, other_model.id == other_column)
+                .filter(own_column.in_(chunk))
+                .order_by(own_column, other_model.id))
+        for row in rows:
+            linked[row[0]].append(dict(zip(other_model.fields, row[1:])))
+    return linked
+
+
+def movies_of_actors(actor_ids):
+    """returns {actor id: [movie, ...]} for every id in actor_ids"""
+    return _linked(actor_ids, movie_actor_relationship.c.actor_id,
+                   Movies, movie_actor_relationship.c.movie_id)
+
+
+def actors_of_movies(movie_ids):
+    """returns {movie id: [actor, ...]} for every id in movie_ids"""
+    return _linked(movie_ids, movie_actor_relationship.c.movie_id,
+                   Actors, movie_actor_relationship.c.actor_id)
+
+
+def assign_actor(movie_id, actor_id):
+    """adds actor_id to the cast of movie_id
+    returns False if the actor was already cast
+    """
+    link = movie_actor_relationship
+    exists = db.session.query(link).filter(
+        link.c.movie_id == movie_id, link.c.actor_id == actor_id).first()
+    if exists:
+        return False
+    db.session.execute(link.insert().values(movie_id=movie_id,
+                                            actor_id=actor_id))
+    _touch('movie_actor_relationship')
+    _commit(('movie_actor_relationship', 'insert',
+             [{'movie_id': movie_id, 'actor_id': actor_id}]))
+    return True
+
+
+def unassign_actor(movie_id, actor_id):
+    """removes actor_id from the cast of movie_id
+    returns False if the actor was not cast
+    """
+    link = movie_actor_relationship
+    result = db.session.execute(link.delete().where(
+        (link.c.movie_id == movie_id) & (link.c.actor_id == actor_id)))
+    removed = []
+    if result.rowcount > 0:
+        _touch('movie_actor_relationship')
+        removed = [{'movie_id': movie_id, 'actor_id': actor_id}]
+    _commit(('movie_actor_relationship', 'delete', removed))
+    return result.rowcount > 0
+
+
+'''
+Change tracking
+    movies and actors have created_at and updated_at (UTC), set by the
+        model on every insert and update, bulk ones included
+    deletes leave a tombstone with the table name, the id and the time of
+        the delete, written in the same transaction
+    together they let GET /movies?since= and GET /actors?since= return
+        only the rows that changed since a client last synced
+'''
+
+
+class Tombstones(db.Model):
+
+    __tablename__ = "tombstones"
+    # backs the ?since= scans of deleted ids
+    __table_args__ = (
+        db.Index('ix_tombstones_table_name_deleted_at',
+                 'table_name', 'deleted_at', 'row_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String(40), nullable=False)
+    row_id = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<Tombstone {self.table_name} {self.row_id}>"
+
+
+'''
+Table versions
+    every write through the model methods bumps the version of the tables
+        it touched and records the time of the bump, in its own
+        transaction, so every worker and instance sees the same versions
+        as soon as the write is committed
+    the response cache builds its keys, ETags and Last-Modified headers
+        from them, see cache.py
+    concurrent writes to the same table queue on its version row until
+        the first one commits
+'''
+
+VERSIONED_TABLES = ('movies', 'actors', 'movie_actor_relationship')
+
+
+class TableVersions(db.Model):
+
+    __tablename__ = "table_versions"
+
+    table_name = Column(String(40), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    changed_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<TableVersion {self.table_name} {self.version}>"
+
+
+def _seed_versions(table, connection, **kw):
+    connection.execute(table.insert(), [
+        {'table_name': name, 'version': 0, 'changed_at': datetime.utcnow()}
+        for name in VERSIONED_TABLES])
+
+
+event.listen(TableVersions.__table__, 'after_create', _seed_versions)
+
+
+def _touch(*tablenames):
+    """bumps the versions of tablenames in the current transaction"""
+    table = TableVersions.__table__
+    now = datetime.utcnow()
+    result = db.session.execute(
+        table.update().where(table.c.table_name.in_(tablenames))
+        .values(version=table.c.version + 1, changed_at=now))
+    if result.rowcount < len(tablenames):
+        found = {name for name, in db.session.execute(
+            select([table.c.table_name])
+            .where(table.c.table_name.in_(tablenames)))}
+        db.session.execute(table.insert(), [
+            {'table_name': name, 'version': 1, 'changed_at': now}
+            for name in tablenames if name not in found])
+
+
+def _seconds(changed_at):
+    """returns the UTC datetime changed_at in seconds since the epoch"""
+    return calendar.timegm(changed_at.utctimetuple()) + (
+        changed_at.microsecond / 1e6)
+
+
+def table_versions(tablenames):
+    """returns the (version, changed_at in seconds since the epoch) of
+    every table in tablenames, None if one of them has no version row
+    """
+    table = TableVersions.__table__
+    found = {name: (version, _seconds(changed_at))
+             for name, version, changed_at in db.session.execute(
+                 select([table.c.table_name, table.c.version,
+                         table.c.changed_at])
+                 .where(table.c.table_name.in_(tablenames)))}
+    if any(name not in found for name in tablenames):
+        return None
+    return [found[name] for name in tablenames]
+
+
+def last_write_at():
+    """returns the time of the last write to any versioned table in
+    seconds since the epoch, None if none was ever written to
+    """
+    table = TableVersions.__table__
+    changed_at = db.session.execute(
+        select([db.func.max(table.c.changed_at)])
+        .where(table.c.version > 0)).scalar()
+    return _seconds(changed_at) if changed_at is not None else None
+
+
 class Movies(db.Model):
 
     __tablename__ = "movies"
+    # backs keyset pagination sorted by release_date
+    # and the ?since= scans of changed movies
+    __table_args__ = (
+        db.Index('ix_movies_release_date_id', 'release_date', 'id'),
+        db.Index('ix_movies_updated_at_id', 'updated_at', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     title = Column(String(80), unique=True, nullable=False)
     release_date = Column(Date, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow,
+                        onupdate=datetime.utcnow)
+
+    # columns returned by format(), in order
+    fields = ('id', 'title', 'release_date')
 
     def __repr__(self):
         return f"<Movie {self.id} {self.title}>"
@@ -76,19 +462,147 @@ class Movies(db.Model):
         """inserts a new record into movies table
         """
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+        _touch('movies')
+        _commit(('movies', 'insert', [self.format()]))
 
     def delete(self):
         """deletes a record from the movies table
         """
+        row = self.format()
         db.session.delete(self)
-        db.session.commit()
+        _bury('movies', [row['id']])
+        _touch('movies', 'movie_actor_relationship')
+        _commit(('movies', 'delete', [row]), _cascade('movie_id', [row['id']]))
 
-    @staticmethod
-    def update():
+    def update(self):
         """updates a movies table record
         """
-        db.session.commit()
+        row = self.format()
+        _touch('movies')
+        _commit(('movies', 'update', [row]))
+
+    @classmethod
+    def bulk_insert(cls, rows, on_conflict='skip'):
+        """inserts many movies in a single transaction
+        rows: dicts with title and release_date, titles must be distinct
+        on_conflict: 'skip' leaves a movie whose title already exists
+            alone, 'update' overwrites its release_date
+        returns the id of each row, None for skipped rows
+        """
+        table = cls.__table__
+        ids = {}
+        updated = set()
+        try:
+            if _is_postgres():
+                from sqlalchemy.dialects import postgresql
+                for chunk in _chunks(rows):
+                    statement = postgresql.insert(table).values(chunk)
+                    if on_conflict == 'update':
+                        statement = statement.on_conflict_do_update(
+                            index_elements=[table.c.title],
+                            set_={'release_date':
+                                  statement.excluded.release_date,
+                                  'updated_at':
+                                  statement.excluded.updated_at})
+                    else:
+                        statement = statement.on_conflict_do_nothing(
+                            index_elements=[table.c.title])
+                    # xmax is 0 for rows inserted by this statement
+                    statement = statement.returning(
+                        table.c.title, table.c.id,
+                        literal_column('xmax = 0'))
+                    for title, id, inserted in db.session.execute(statement):
+                        ids[title] = id
+                        if not inserted:
+                            updated.add(title)
+            else:
+                existing = {}
+                for chunk in _chunks(rows):
+                    existing.update(db.session.query(cls.title, cls.id)
+                                    .filter(cls.title.in_(
+                                        [row['title'] for row in chunk])))
+                new_rows = [row for row in rows
+                            if row['title'] not in existing]
+                if new_rows:
+                    db.session.execute(table.insert(), new_rows)
+                    for chunk in _chunks(new_rows):
+                        ids.update(db.session.query(cls.title, cls.id)
+                                   .filter(cls.title.in_(
+                                       [row['title'] for row in chunk])))
+                if on_conflict == 'update':
+                    updates = [{'b_title': row['title'],
+                                'b_release_date': row['release_date']}
+                               for row in rows if row['title'] in existing]
+                    if updates:
+                        db.session.execute(
+                            table.update()
+                            .where(table.c.title == bindparam('b_title'))
+                            .values(release_date=bindparam('b_release_date')),
+                            updates)
+                        ids.update(existing)
+                        updated.update(existing)
+            written = [dict(row, id=ids[row['title']]) for row in rows
+                       if row['title'] in ids]
+            _touch('movies')
+            _commit(('movies', 'insert', [row for row in written
+                                          if row['title'] not in updated]),
+                    ('movies', 'update', [row for row in written
+                                          if row['title'] in updated]))
+        except Exception:
+            db.session.rollback()
+            raise
+        return [ids.get(row['title']) for row in rows]
+
+    @classmethod
+    def bulk_update(cls, patches):
+        """updates many movies in a single transaction
+        patches: dicts with the id and the new column values
+        returns the ids of the updated rows
+        """
+        try:
+            ids = _update_ids(cls.__table__, patches)
+            updated = set(ids)
+            _touch(cls.__tablename__)
+            _commit(('movies', 'update', [patch for patch in patches
+                                          if patch['id'] in updated]))
+        except Exception:
+            db.session.rollback()
+            raise
+        return ids
+
+    @classmethod
+    def title_conflicts(cls, patches):
+        """returns the ids of the patches that would give a movie the
+        title of another one
+        """
+        titles = {patch['title']: patch['id'] for patch in patches
+                  if 'title' in patch}
+        conflicts = set()
+        for chunk in _chunks(list(titles)):
+            for title, id in (db.session.query(cls.title, cls.id)
+                              .filter(cls.title.in_(chunk))):
+                if id != titles[title]:
+                    conflicts.add(titles[title])
+        return conflicts
+
+    @classmethod
+    def bulk_delete(cls, ids):
+        """deletes many movies and their movie_actor_relationship rows
+        in a single transaction
+        returns the ids of the deleted rows
+        """
+        try:
+            ids = _delete_ids(cls.__table__, ids,
+                              movie_actor_relationship.c.movie_id)
+            _bury('movies', ids)
+            _touch('movies', 'movie_actor_relationship')
+            _commit(('movies', 'delete', [{'id': id} for id in ids]),
+                    _cascade('movie_id', ids))
+        except Exception:
+            db.session.rollback()
+            raise
+        return ids
 
     def format(self):
         """returns a formatted response of the movie"""
@@ -102,13 +616,26 @@ class Movies(db.Model):
 class Actors(db.Model):
 
     __tablename__ = "actors"
+    # backs keyset pagination sorted by name, ?gender= filters sorted
+    # by name and the ?since= scans of changed actors
+    __table_args__ = (
+        db.Index('ix_actors_name_id', 'name', 'id'),
+        db.Index('ix_actors_gender_name_id', 'gender', 'name', 'id'),
+        db.Index('ix_actors_updated_at_id', 'updated_at', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String(80), nullable=False)
     gender = Column(String(6), nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow,
+                        onupdate=datetime.utcnow)
     movies = db.relationship('Movies', secondary=movie_actor_relationship,
                              backref='movies_list', lazy=True)
 
+    # columns returned by format(), in order
+    fields = ('id', 'name', 'gender')
+
     def __repr__(self):
         return f"<Actor {self.id} {self.name}>"
 
@@ -116,19 +643,95 @@ class Actors(db.Model):
         """inserts a new record into the actors table
         """
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+        _touch('actors')
+        _commit(('actors', 'insert', [self.format()]))
 
     def delete(self):
         """deletes a record from the actors table
         """
+        row = self.format()
         db.session.delete(self)
-        db.session.commit()
+        _bury('actors', [row['id']])
+        _touch('actors', 'movie_actor_relationship')
+        _commit(('actors', 'delete', [row]), _cascade('actor_id', [row['id']]))
 
-    @staticmethod
-    def update():
+    def update(self):
         """updates a record in the actors table
         """
-        db.session.commit()
+        row = self.format()
+        _touch('actors')
+        _commit(('actors', 'update', [row]))
+
+    @classmethod
+    def bulk_insert(cls, rows):
+        """inserts many actors in a single transaction
+        rows: dicts with name and gender
+        returns the id of each row
+        """
+        table = cls.__table__
+        ids = []
+        try:
+            for chunk in _chunks(rows):
+                if _is_postgres():
+                    # the ids are taken from the sequence first, so each
+                    # row gets a known one whatever order RETURNING uses
+                    chunk_ids = [id for id, in db.session.execute(text(
+                        "SELECT nextval(pg_get_serial_sequence("
+                        "'actors', 'id')) FROM generate_series(1, :count)"),
+                        {'count': len(chunk)})]
+                    db.session.execute(table.insert().values([
+                        dict(row, id=id) for row, id in zip(chunk,
+                                                            chunk_ids)]))
+                else:
+                    # actors.id is the rowid: the rows of one INSERT get
+                    # consecutive ids after the largest one in use
+                    last = db.session.execute(
+                        table.insert().values(chunk)).lastrowid
+                    chunk_ids = range(last - len(chunk) + 1, last + 1)
+                ids.extend(chunk_ids)
+            _touch('actors')
+            _commit(('actors', 'insert',
+                     [dict(row, id=id) for row, id in zip(rows, ids)]))
+        except Exception:
+            db.session.rollback()
+            raise
+        return ids
+
+    @classmethod
+    def bulk_update(cls, patches):
+        """updates many actors in a single transaction
+        patches: dicts with the id and the new column values
+        returns the ids of the updated rows
+        """
+        try:
+            ids = _update_ids(cls.__table__, patches)
+            updated = set(ids)
+            _touch(cls.__tablename__)
+            _commit(('actors', 'update', [patch for patch in patches
+                                          if patch['id'] in updated]))
+        except Exception:
+            db.session.rollback()
+            raise
+        return ids
+
+    @classmethod
+    def bulk_delete(cls, ids):
+        """deletes many actors and their movie_actor_relationship rows
+        in a single transaction
+        returns the ids of the deleted rows
+        """
+        try:
+            ids = _delete_ids(cls.__table__, ids,
+                              movie_actor_relationship.c.actor_id)
+            _bury('actors', ids)
+            _touch('actors', 'movie_actor_relationship')
+            _commit(('actors', 'delete', [{'id': id} for id in ids]),
+                    _cascade('actor_id', ids))
+        except Exception:
+            db.session.rollback()
+            raise
+        return ids
 
     def format(self):
         """returns a formatted response of the actor"""
@@ -137,3 +740,66 @@ class Actors(db.Model):
             'name': self.name,
             'gender': self.gender,
         }
+
+
+'''
+Search indexes
+    GET /movies/search and GET /actors/search read movies.title and
+        actors.name through an index, see queries.py
+    Postgres: a GIN index of the words, to_tsvector('simple', column), and
+        a GIN trigram index (pg_trgm) that finds misspelled names
+    SQLite: an FTS5 table <table>_search of the column, kept up to date by
+        triggers on the table
+    they are created along with the tables by create_all, and by the
+        search migration on existing databases
+'''
+
+SEARCH_COLUMNS = {'movies': 'title', 'actors': 'name'}
+
+
+def search_ddl(dialect, table, column):
+    """returns the statements creating the search index of table.column"""
+    if dialect == 'postgresql':
+        return [
+            'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+            f'CREATE INDEX IF NOT EXISTS ix_{table}_{column}_words '
+            f"ON {table} USING gin (to_tsvector('simple', {column}))",
+            f'CREATE INDEX IF NOT EXISTS ix_{table}_{column}_trgm '
+            f'ON {table} USING gin ({column} gin_trgm_ops)'
+        ]
+    if dialect != 'sqlite':
+        return []
+    search = f'{table}_search'
+    insert = (f'INSERT INTO {search} (rowid, {column}) '
+              f'VALUES (new.id, new.{column});')
+    delete = (f"INSERT INTO {search} ({search}, rowid, {column}) "
+              f"VALUES ('delete', old.id, old.{column});")
+    return [
+        # prefix indexes of 2 and 3 characters for short partial words
+        f"CREATE VIRTUAL TABLE {search} USING fts5({column}, "
+        f"content='{table}', content_rowid='id', prefix='2 3')",
+        f'CREATE TRIGGER {search}_insert AFTER INSERT ON {table} '
+        f'BEGIN {insert} END',
+        f'CREATE TRIGGER {search}_delete AFTER DELETE ON {table} '
+        f'BEGIN {delete} END',
+        f'CREATE TRIGGER {search}_update AFTER UPDATE OF {column} '
+        f'ON {table} BEGIN {delete} {insert} END',
+        f"INSERT INTO {search} ({search}) VALUES ('rebuild')"
+    ]
+
+
+def _create_search_index(table, connection, **kw):
+    for statement in search_ddl(connection.dialect.name, table.name,
+                                SEARCH_COLUMNS[table.name]):
+        connection.execute(text(statement))
+
+
+def _drop_search_index(table, connection, **kw):
+    # the indexes and triggers go with the table
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text(f'DROP TABLE IF EXISTS {table.name}_search'))
+
+
+for _model in (Movies, Actors):
+    event.listen(_model.__table__, 'after_create', _create_search_index)
+    event.listen(_model.__table__, 'before_drop', _drop_search_index)
@@ -0,0 +1,132 @@
+import logging
+import os
+import threading
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool, StaticPool
+
+
+logger = logging.getLogger('casting.pool')
+
+
+'''
+Connection pool settings and metrics
+
+    engine_options(config, url) turns the DB_* settings of the Config
+        class into SQLAlchemy engine options; SQLite keeps its default
+        pool, the sizing options only apply to server databases; an
+        in-memory SQLite database (sqlite://, for tests) is one connection
+        shared by every thread, so all of them see the same tables
+    TimedQueuePool times every checkout: the wait for a free connection,
+        the checkouts that timed out and the peak number in use; a
+        checkout slower than slow_ms is logged with the pool state
+    guard_fork(engine) discards, without closing, connections a worker
+        inherited from a preloading parent (gunicorn --preload), so two
+        processes never talk over the same socket
+'''
+
+
+class PoolStats(object):
+    def __init__(self, slow_ms):
+        self.slow_ms = slow_ms
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def record(self, wait, pool, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+                self.peak = max(self.peak, pool.checkedout())
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        if timed_out or wait * 1000 >= self.slow_ms:
+            logger.warning('slow connection checkout: waited %.1f ms%s, %s',
+                           wait * 1000, ' and timed out' if timed_out else '',
+                           pool.status())
+
+
+class TimedQueuePool(QueuePool):
+    stats = None
+
+    @classmethod
+    def with_stats(cls, stats):
+        """returns a subclass recording to stats, the class attribute
+        outlives the pool being recreated by engine.dispose()
+        """
+        return type(cls.__name__, (cls,), {'stats': stats})
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.record(time.perf_counter() - start, self,
+                              timed_out=True)
+            raise
+        self.stats.record(time.perf_counter() - start, self)
+        return connection
+
+
+def engine_options(config, url):
+    """returns the SQLALCHEMY_ENGINE_OPTIONS for the DB_* settings"""
+    options = {'pool_pre_ping': config['DB_POOL_PRE_PING']}
+    if url in ('sqlite://', 'sqlite:///:memory:'):
+        options.update({'poolclass': StaticPool,
+                        'connect_args': {'check_same_thread': False}})
+    if url.startswith('sqlite'):
+        return options
+
+    options.update({
+        'poolclass': TimedQueuePool.with_stats(
+            PoolStats(config['DB_POOL_SLOW_CHECKOUT_MS'])),
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE']
+    })
+    timeout = config['DB_STATEMENT_TIMEOUT_MS']
+    if url.startswith(('postgres://', 'postgresql')) and timeout:
+        options['connect_args'] = {
+            'options': f'-c statement_timeout={timeout}'}
+    return options
+
+
+def guard_fork(engine):
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, record):
+        record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, record, proxy):
+        if record.info.get('pid', os.getpid()) != os.getpid():
+            # dropping the references makes the pool open a new one
+            record.connection = proxy.connection = None
+            raise exc.DisconnectionError(
+                'connection belongs to the parent process')
+
+
+def pool_stats(engine):
+    """returns the state and counters of the engine's pool"""
+    pool = engine.pool
+    stats = getattr(pool, 'stats', None)
+    if stats is None:
+        return {'status': pool.status()}
+    capacity = pool.size() + max(pool._max_overflow, 0)
+    waits = stats.checkouts + stats.timeouts
+    return {
+        'size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'overflow': max(pool.overflow(), 0),
+        'saturation': pool.checkedout() / capacity if capacity else 0.0,
+        'peak': stats.peak,
+        'checkouts': stats.checkouts,
+        'timeouts': stats.timeouts,
+        'wait_avg_ms': stats.wait_total * 1000 / waits if waits else 0.0,
+        'wait_max_ms': stats.wait_max * 1000
+    }
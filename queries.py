@@ -0,0 +1,570 @@
+import base64
+import binascii
+import json
+import re
+from datetime import date, datetime
+from flask import Response, current_app, request, abort
+from flask import json as flask_json
+from flask import stream_with_context
+from sqlalchemy import Date, Float, and_, cast, literal, or_, tuple_
+from sqlalchemy import UniqueConstraint
+from sqlalchemy import column, func, literal_column, table
+from models import db, Tombstones
+
+
+'''
+Keyset pagination for the list endpoints
+
+    rows are ordered by a sort column and then by id
+    a page starts right after the last row of the previous page, so every
+        page is one index range scan, however deep the client has paged
+    the cursor handed to clients is opaque: the base64 encoded sort spec
+        and the sort values of the last row
+'''
+
+
+def parse_limit(default, maximum):
+    '''returns the ?limit= page size, capped at maximum'''
+    limit = request.args.get('limit')
+    if limit is None:
+        return min(default, maximum)
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    return min(limit, maximum)
+
+
+def parse_sort(model, allowed):
+    '''returns the ?sort= spec and its list of (column, descending) keys
+        comma separated names, a leading - sorts that name descending; id
+        is always the last key, in the direction of the key before it
+    '''
+    spec = request.args.get('sort', 'id')
+    keys = []
+    for name in spec.split(','):
+        descending = name.startswith('-')
+        name = name[1:] if descending else name
+        if name not in allowed or name in [key.key for key, _ in keys]:
+            abort(400)
+        keys.append((getattr(model, name), descending))
+
+    if 'id' not in [column.key for column, _ in keys]:
+        keys.append((model.id, keys[-1][1]))
+    return spec, keys
+
+
+'''
+Filters and index checks for the list endpoints
+
+    ?<field>=<value> and ?<field>[<operator>]=<value> keep the rows whose
+        field compares to value, operators: eq, gt, gte, lt, lte and in
+        (comma separated values); values are parsed by the column type,
+        dates as YYYY-MM-DD, integers within 64 bits
+    every filter becomes a WHERE condition, the fields an endpoint can be
+        filtered on all lead an index
+    a sort is indexed when an index returns the rows in its order, after
+        the leading index columns filtered with eq; sort keys filtered
+        with eq, and the ones after a unique key, are left out; with
+        ALLOW_UNINDEXED_SORTS off (ProductionConfig) other sorts get a 400
+        instead of sorting the filtered table for every page
+'''
+
+FILTER_ARGUMENT = re.compile(r'^(\w+)(?:\[(\w+)\])?$')
+FILTER_OPERATORS = {
+    'eq': lambda column, value: column == value,
+    'gt': lambda column, value: column > value,
+    'gte': lambda column, value: column >= value,
+    'lt': lambda column, value: column < value,
+    'lte': lambda column, value: column <= value,
+    'in': lambda column, values: column.in_(values)
+}
+
+
+def _filter_value(column, value):
+    python_type = column.type.python_type
+    if python_type is date:
+        return date.fromisoformat(value)
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    value = python_type(value)
+    # the driver fails on integers over 64 bits, so they are a bad value
+    if python_type is int and not -2 ** 63 <= value < 2 ** 63:
+        raise ValueError(f'{column.key} out of range')
+    return value
+
+
+def parse_filters(model, allowed):
+    '''returns the conditions of the filter arguments and the names of
+        the fields compared to a single value with eq
+        arguments that are neither columns of model nor have an operator
+        are left alone; abort 400 on a field not in allowed, an unknown
+        operator or a value that doesn't parse
+    '''
+    conditions = []
+    equal = set()
+    for argument, values in request.args.lists():
+        match = FILTER_ARGUMENT.match(argument)
+        if not match:
+            continue
+        name, operator = match.groups()
+        if operator is None and name not in model.__table__.c:
+            continue
+        operator = operator or 'eq'
+        if name not in allowed or operator not in FILTER_OPERATORS:
+            abort(400)
+        column = getattr(model, name)
+        for value in values:
+            try:
+                if operator == 'in':
+                    value = [_filter_value(column, item)
+                             for item in value.split(',')]
+                else:
+                    value = _filter_value(column, value)
+            except ValueError:
+                abort(400)
+            conditions.append(FILTER_OPERATORS[operator](column, value))
+            if operator == 'eq':
+                equal.add(name)
+    return conditions, equal
+
+
+def _index_orders(table):
+    '''returns (column names, unique) of the primary key, the unique
+        constraints and the indexes of table
+    '''
+    orders = [([column.name for column in table.primary_key.columns], True)]
+    orders += [([column.name for column in constraint.columns], True)
+               for constraint in table.constraints
+               if isinstance(constraint, UniqueConstraint)]
+    orders += [([column.name for column in index.columns], index.unique)
+               for index in table.indexes]
+    return orders
+
+
+def indexed_sort(model, keys, equal=()):
+    '''returns True if an index of model reads the rows in the order of
+        keys once the keys and leading index columns in equal are skipped
+        the keys after the first ones that include a unique index don't
+        change the order, neither do their directions
+    '''
+    orders = _index_orders(model.__table__)
+    uniques = [set(columns) for columns, unique in orders if unique]
+    keys = [(column.key, descending) for column, descending in keys
+            if column.key not in equal]
+    for end in range(len(keys) + 1):
+        named = set(equal).union(name for name, _ in keys[:end])
+        if any(columns <= named for columns in uniques):
+            keys = keys[:end]
+            break
+    if len(set(descending for _, descending in keys)) > 1:
+        return False
+    names = [name for name, _ in keys]
+    if not names:
+        return True
+    for columns, _ in orders:
+        skip = 0
+        while skip < len(columns) and columns[skip] in equal:
+            skip += 1
+        rest = columns[skip:]
+        if len(names) <= len(rest) and rest[:len(names)] == names:
+            return True
+    return False
+
+
+def check_sort(model, keys, equal):
+    '''abort 400 if the sort isn't indexed and ALLOW_UNINDEXED_SORTS is
+        off
+    '''
+    if (not current_app.config['ALLOW_UNINDEXED_SORTS'] and
+            not indexed_sort(model, keys, equal)):
+        abort(400)
+
+
+def encode_cursor(spec, keys, row):
+    values = []
+    for column, _ in keys:
+        value = getattr(row, column.key)
+        if isinstance(value, date):
+            value = value.isoformat()
+        values.append(value)
+    data = json.dumps({'sort': spec, 'after': values}).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def parse_cursor(spec, keys):
+    '''returns the sort values of the ?cursor=, or None on the first page
+        abort 400 if the cursor is malformed, was issued for another sort
+        or holds a value of another type than its key column
+    '''
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if data['sort'] != spec or len(data['after']) != len(keys):
+            abort(400)
+        values = []
+        for (column, _), value in zip(keys, data['after']):
+            # dates travel as ISO strings
+            expected = (str if isinstance(column.type, Date)
+                        else column.type.python_type)
+            if not isinstance(value, expected) or isinstance(value, bool):
+                abort(400)
+            if isinstance(column.type, Date):
+                value = date.fromisoformat(value)
+            values.append(value)
+    except (ValueError, TypeError, KeyError, UnicodeError, binascii.Error):
+        abort(400)
+    return values
+
+
+def _after(keys, values):
+    '''row comparison (key1, key2, ...) > (value1, value2, ...) honouring
+        the direction of each key
+        keys sorted in one direction use a row value comparison, which the
+        database can answer with a single range scan of a composite index
+    '''
+    directions = set(descending for _, descending in keys)
+    if len(keys) > 1 and len(directions) == 1:
+        columns = tuple_(*[column for column, _ in keys])
+        if directions.pop():
+            return columns < tuple_(*values)
+        return columns > tuple_(*values)
+
+    clauses = []
+    for i, (column, descending) in enumerate(keys):
+        equal = [keys[j][0] == values[j] for j in range(i)]
+        if descending:
+            equal.append(column < values[i])
+        else:
+            equal.append(column > values[i])
+        clauses.append(and_(*equal))
+    return or_(*clauses)
+
+
+def paginate(query, spec, keys, limit, after=None):
+    '''returns one page of rows from query and the cursor of the next page
+        (None on the last page)
+    '''
+    if after is not None:
+        query = query.filter(_after(keys, after))
+    query = query.order_by(
+        *[column.desc() if descending else column.asc()
+          for column, descending in keys])
+
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(spec, keys, rows[-1])
+
+
+'''
+Delta sync for clients that mirror the catalogue
+
+    ?since=0 starts a sync, ?since=<cursor> continues it from the next
+        value of the previous response
+    changed rows are read in (updated_at, id) order and deleted ids in
+        (deleted_at, row_id) order, each from its own index, so a sync
+        costs as much as the churn since the last one, not the table size
+    changes of the last settle seconds are left for the next sync, so a
+        transaction that commits after a later one is not skipped over
+    a new sync starts the deletes at its own start time, a client that
+        has no rows yet has nothing to delete
+    a cursor whose deletes are older than the tombstone retention can no
+        longer be continued: 410, the client has to sync again from 0
+'''
+
+
+def encode_since(changed, deleted):
+    positions = {}
+    for name, position in (('changed', changed), ('deleted', deleted)):
+        if position is not None:
+            position = [position[0].isoformat(), position[1]]
+        positions[name] = position
+    data = json.dumps(positions).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def parse_since(retention):
+    '''returns the (changed, deleted) positions of the ?since= cursor,
+        each None or (datetime, id); None if there is no ?since=
+        abort 400 if the cursor is malformed, 410 if it is older than
+        retention
+    '''
+    since = request.args.get('since')
+    if since is None:
+        return None
+    if since == '0':
+        return None, None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(since.encode('ascii')))
+        positions = []
+        for name in ('changed', 'deleted'):
+            position = data[name]
+            if position is not None:
+                at, id = position
+                if not isinstance(id, int):
+                    abort(400)
+                position = (datetime.fromisoformat(at), id)
+            positions.append(position)
+    except (ValueError, TypeError, KeyError, UnicodeError, binascii.Error):
+        abort(400)
+
+    changed, deleted = positions
+    if deleted is None or deleted[0] < datetime.utcnow() - retention:
+        abort(410)
+    return changed, deleted
+
+
+def changes_since(model, fields, since, limit, settle):
+    '''returns (rows, deleted ids, next cursor, more) for a ?since= sync
+        rows are select_columns rows of fields, at most limit changed
+        rows and limit deleted ids are returned; more is True if either
+        was cut short
+    '''
+    until = datetime.utcnow() - settle
+    changed, deleted = since
+    if deleted is None:
+        deleted = (until, 0)
+
+    keys = [(model.updated_at, False), (model.id, False)]
+    query = select_columns(model, fields, keys).filter(
+        model.updated_at <= until)
+    if changed is not None:
+        query = query.filter(_after(keys, changed))
+    rows = query.order_by(model.updated_at, model.id).limit(limit + 1).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        changed = (rows[-1].updated_at, rows[-1].id)
+
+    keys = [(Tombstones.deleted_at, False), (Tombstones.row_id, False)]
+    query = (db.session.query(Tombstones.deleted_at, Tombstones.row_id)
+             .filter(Tombstones.table_name == model.__tablename__,
+                     Tombstones.deleted_at <= until,
+                     _after(keys, deleted))
+             .order_by(Tombstones.deleted_at, Tombstones.row_id))
+    tombstones = query.limit(limit + 1).all()
+    more = more or len(tombstones) > limit
+    tombstones = tombstones[:limit]
+    if tombstones:
+        deleted = tuple(tombstones[-1])
+
+    return (rows, [row_id for _, row_id in tombstones],
+            encode_since(changed, deleted), more)
+
+
+'''
+Column projection for the list endpoints
+
+    list endpoints select plain columns instead of loading ORM objects, so
+        no instances are built or tracked in the identity map
+    ?fields=id,title restricts the response, and the SELECT, to the given
+        columns; the sort keys are selected too, for the next cursor
+'''
+
+
+def parse_fields(model):
+    '''returns the ?fields= column names, all of model.fields by default
+        abort 400 on an unknown column
+    '''
+    fields = request.args.get('fields')
+    if fields is None:
+        return model.fields
+    names = tuple(dict.fromkeys(
+        name.strip() for name in fields.split(',') if name.strip()))
+    if not names or any(name not in model.fields for name in names):
+        abort(400)
+    return names
+
+
+def select_columns(model, fields, keys):
+    '''returns a query of the fields columns followed by any sort key
+        that is not one of them
+    '''
+    names = list(fields)
+    names += [column.key for column, _ in keys if column.key not in names]
+    return db.session.query(*[getattr(model, name) for name in names])
+
+
+def parse_include(allowed):
+    '''returns the ?include= relation name, or None
+        abort 400 if it is not one of allowed
+    '''
+    include = request.args.get('include')
+    if include is not None and include not in allowed:
+        abort(400)
+    return include
+
+
+def rows_formatter(fields, include=None, load_linked=None):
+    '''returns a function serializing a list of select_columns rows like
+        format()
+        with include, every item also gets the linked rows returned by
+        load_linked(ids), called once per list of rows
+    '''
+    def format_rows(rows):
+        items = [dict(zip(fields, row)) for row in rows]
+        if include:
+            linked = load_linked([row.id for row in rows])
+            for item, row in zip(items, rows):
+                item[include] = linked[row.id]
+        return items
+    return format_rows
+
+
+'''
+Ranked search for GET /movies/search and GET /actors/search
+
+    ?q= is split into words and every word has to match the start of a
+        word of the title or name: "brad pi" finds Brad Pitt
+    on Postgres a title or name similar enough to ?q= (pg_trgm similarity
+        threshold) matches too, so "bard pit" finds Brad Pitt as well
+    matches are read from the search indexes of models.py and ranked best
+        first (ts_rank plus similarity on Postgres, bm25 on SQLite), then
+        by id; every page ranks all the matches, so a search costs as much
+        as its matches, not the table size
+    ?cursor= holds the (rank, id) of the last row of a page, for the same
+        ?q= only; the next page is the best matches after it, so page N
+        costs as much as the first page instead of skipping N pages
+'''
+
+
+def parse_search():
+    '''returns the words of ?q=, abort 400 if there are none'''
+    words = re.findall(r'\w+', request.args.get('q', ''))
+    if not words:
+        abort(400)
+    return words
+
+
+def parse_search_cursor(words):
+    '''returns the [rank, id] of the ?cursor=, None on the first page
+        abort 400 if the cursor is malformed or was issued for another ?q=
+    '''
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        rank, id = data['after']
+        if data['q'] != ' '.join(words):
+            abort(400)
+    except (ValueError, TypeError, KeyError, UnicodeError, binascii.Error):
+        abort(400)
+    if (not isinstance(rank, (int, float)) or isinstance(rank, bool) or
+            not isinstance(id, int) or isinstance(id, bool)):
+        abort(400)
+    return [rank, id]
+
+
+def search_rows(model, searched, fields, words, limit, after=None):
+    '''returns one page of select_columns rows of the model rows whose
+        searched column matches words, best first, and the cursor of the
+        next page (None on the last page)
+        after: the [rank, id] of parse_search_cursor, None on the first page
+    '''
+    query = select_columns(model, fields, [(model.id, False)])
+    phrase = ' '.join(words)
+    if db.session.get_bind().dialect.name == 'postgresql':
+        config = literal_column("'simple'")
+        document = func.to_tsvector(config, searched)
+        prefixes = func.to_tsquery(
+            config, ' & '.join(f'{word}:*' for word in words))
+        # %% reaches the database as the pg_trgm % operator
+        query = query.filter(or_(document.op('@@')(prefixes),
+                                 searched.op('%%')(phrase)))
+        # ts_rank and similarity are real: as a double the rank goes
+        # through the JSON cursor and back without rounding
+        rank = cast(func.ts_rank(document, prefixes) +
+                    func.similarity(searched, phrase), Float(53))
+        after = after and [cast(literal(after[0]), Float(53))] + after[1:]
+        descending = True
+    else:
+        search = table(f'{model.__tablename__}_search', column('rowid'))
+        name = literal_column(search.name)
+        query = (query.join(search, search.c.rowid == model.id)
+                 .filter(name.op('MATCH')(
+                     ' '.join(f'"{word}"*' for word in words))))
+        # bm25 is lower for better matches
+        rank = func.bm25(name)
+        descending = False
+
+    keys = [(rank, descending), (model.id, False)]
+    query = query.add_columns(rank)
+    if after is not None:
+        query = query.filter(_after(keys, after))
+    rows = (query.order_by(rank.desc() if descending else rank, model.id)
+            .limit(limit + 1).all())
+    # the rank is only needed for the cursor
+    page = [tuple(row)[:-1] for row in rows[:limit]]
+    if len(rows) <= limit:
+        return page, None
+    last = rows[limit - 1]
+    data = json.dumps({'q': phrase, 'after': [last[-1], last.id]})
+    return page, base64.urlsafe_b64encode(
+        data.encode('utf-8')).decode('ascii')
+
+
+'''
+Streaming responses for full collection dumps
+
+    ?stream=1 streams the whole collection as one JSON document,
+        Accept: application/x-ndjson streams one JSON object per line
+    rows are read from a server-side cursor in batches of batch_size and
+        written out as soon as a batch is serialized, so worker memory and
+        time to first byte don't depend on the size of the table
+'''
+
+NDJSON = 'application/x-ndjson'
+
+
+def _wants_ndjson():
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON])
+    return best == NDJSON
+
+
+def wants_stream():
+    '''returns True if the client asked for a streamed dump'''
+    if request.args.get('stream', '').lower() in ('1', 'true'):
+        return True
+    return _wants_ndjson()
+
+
+def stream_rows(query, keys, name, format_rows, batch_size):
+    '''returns a streamed response of every row of query, ordered by keys
+    '''
+    query = query.order_by(
+        *[column.desc() if descending else column.asc()
+          for column, descending in keys])
+    rows = query.yield_per(batch_size)
+
+    def batches():
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield [flask_json.dumps(item) for item in format_rows(batch)]
+                batch = []
+        if batch:
+            yield [flask_json.dumps(item) for item in format_rows(batch)]
+
+    if _wants_ndjson():
+        def generate():
+            for batch in batches():
+                yield '\n'.join(batch) + '\n'
+        return Response(stream_with_context(generate()), mimetype=NDJSON)
+
+    def generate():
+        yield '{"success": true, "%s": [' % name
+        separator = ''
+        for batch in batches():
+            yield separator + ', '.join(batch)
+            separator = ', '
+        yield ']}\n'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
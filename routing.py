@@ -0,0 +1,169 @@
+import itertools
+import threading
+import time
+from functools import wraps
+from flask import current_app, g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, orm, text
+from sqlalchemy.sql import Select
+from pool import engine_options, guard_fork
+from sqltrace import trace_engine
+
+
+'''
+Read-replica routing
+
+    DATABASE_REPLICA_URLS lists read replicas of DATABASE_URL
+    views decorated with replicas.read_only run their SELECTs on a
+        replica, picked round-robin per request; everything else, flushes
+        and any other statement included, goes to the primary
+    a replica is pinged when a worker first picks it, then again in a
+        background thread every REPLICA_CHECK_SECONDS; one that fails or
+        lags more than REPLICA_MAX_LAG_SECONDS behind is skipped until it
+        passes again, with no healthy replica reads fall back to the
+        primary
+    read your writes: a read of tables changed in the last
+        REPLICA_MAX_LAG_SECONDS stays on the primary, so a client never
+        gets a response older than its own write, and no replica lag is
+        stored in the response cache
+    the time of the last write comes from the table versions that every
+        write bumps in its transaction (see models.table_versions), read
+        on the primary: the ones of the tables read, looked up by the
+        response cache that replicas.read_only goes under, or else the
+        last write to any table, so writes of every worker and instance
+        count, streamed and uncached reads included
+'''
+
+# seconds the last replayed transaction is behind, 0 if fully caught up
+POSTGRES_LAG = text(
+    'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() '
+    'THEN 0 ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) '
+    'END')
+
+
+class Replica(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.healthy = True
+        self.checked_at = None
+        # held while the replica is being checked
+        self.lock = threading.Lock()
+
+
+class ReplicaRouter(object):
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        replicas = []
+        for url in app.config['DATABASE_REPLICA_URLS']:
+            engine = create_engine(url, **engine_options(app.config, url))
+            guard_fork(engine)
+            trace_engine(engine, app.config)
+            replicas.append(Replica(engine))
+        app.extensions['replicas'] = {
+            'replicas': replicas,
+            'turns': itertools.count(),
+            'check': app.config['REPLICA_CHECK_SECONDS'],
+            'max_lag': app.config['REPLICA_MAX_LAG_SECONDS']
+        }
+
+    def read_only(self, f):
+        '''decorator for a GET view, goes under @response_cache.cached
+            lets the view read from the replicas
+        '''
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            state = current_app.extensions.get('replicas')
+            g.read_replica = False
+            if state and state['replicas']:
+                if 'tables_changed_at' in g:
+                    changed_at = g.tables_changed_at
+                else:
+                    # models imports this module
+                    from models import last_write_at
+                    changed_at = last_write_at()
+                g.read_replica = (
+                    changed_at is None or
+                    time.time() - changed_at > state['max_lag'])
+            return f(*args, **kwargs)
+        return wrapper
+
+    def use_primary(self):
+        """sends the remaining reads of the request to the primary"""
+        if has_request_context():
+            g.read_replica = False
+
+    def engine(self, app):
+        """returns the engine of the next healthy replica, or None"""
+        state = app.extensions.get('replicas')
+        if not state or not state['replicas']:
+            return None
+        # start at the next replica, then try the others in order
+        count = len(state['replicas'])
+        with self._lock:
+            start = next(state['turns']) % count
+        for i in range(count):
+            replica = state['replicas'][(start + i) % count]
+            if self._healthy(replica, state):
+                return replica.engine
+        return None
+
+    def _healthy(self, replica, state):
+        if replica.checked_at is None:
+            # the first check of a worker waits, there is no result yet
+            with replica.lock:
+                if replica.checked_at is None:
+                    self._check(replica, state)
+        elif (self.clock() - replica.checked_at >= state['check'] and
+                replica.lock.acquire(blocking=False)):
+            replica.checked_at = self.clock()
+
+            def run():
+                try:
+                    self._check(replica, state)
+                finally:
+                    replica.lock.release()
+            threading.Thread(target=run, daemon=True).start()
+        return replica.healthy
+
+    def _check(self, replica, state):
+        """pings replica and records whether it is healthy"""
+        try:
+            with replica.engine.connect() as connection:
+                if replica.engine.dialect.name == 'postgresql':
+                    lag = connection.scalar(POSTGRES_LAG) or 0
+                    replica.healthy = lag <= state['max_lag']
+                else:
+                    connection.scalar(text('SELECT 1'))
+                    replica.healthy = True
+        except Exception:
+            replica.healthy = False
+        replica.checked_at = self.clock()
+
+    def stats(self, app):
+        """returns the health of every replica"""
+        state = app.extensions.get('replicas') or {'replicas': []}
+        return [{'url': repr(replica.engine.url),
+                 'healthy': replica.healthy}
+                for replica in state['replicas']]
+
+
+replicas = ReplicaRouter()
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if (isinstance(clause, Select) and not self._flushing and
+                has_request_context() and g.get('read_replica')):
+            if 'replica_engine' not in g:
+                g.replica_engine = replicas.engine(self.app)
+            if g.replica_engine is not None:
+                return g.replica_engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
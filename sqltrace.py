@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+
+logger = logging.getLogger('casting.sql')
+
+
+'''
+Per-request SQL instrumentation
+
+    trace_engine(engine, config) times every statement run on engine
+    per request: the number of statements and their time are sent as a
+        Server-Timing header (db;dur=<ms>;desc="<n> queries") when
+        SQL_SERVER_TIMING is set, and reported as the db phase of
+        GET /metrics
+    a statement slower than SQL_SLOW_QUERY_MS is logged with the shape of
+        its parameters, their types and never their values
+    a statement run SQL_REPEAT_THRESHOLD times or more in one request is
+        logged as a likely N+1, e.g. reading Actors.movies actor by actor
+    query_budget(n) fails a test that runs more than n statements
+'''
+
+
+class RequestTrace(object):
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+
+# not counted by query_budget, test fixtures wrap tests in savepoints
+TRANSACTION_CONTROL = ('SAVEPOINT', 'RELEASE SAVEPOINT',
+                       'ROLLBACK TO SAVEPOINT')
+# statements run by the open query_budget blocks, by id
+_budgets = {}
+_budgets_lock = threading.Lock()
+
+
+def parameter_shape(parameters, executemany=False):
+    """returns the types of parameters, e.g. {'title': 'str'}"""
+    if executemany:
+        rows = list(parameters or [])
+        first = parameter_shape(rows[0]) if rows else None
+        return f'{len(rows)} x {first}'
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__
+                for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return tuple(type(value).__name__ for value in parameters)
+    return type(parameters).__name__
+
+
+def trace_engine(engine, config):
+    '''times the statements of engine
+        config: the app config, read at every statement so the settings
+        can be changed at runtime
+    '''
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info['sql_started'] = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop('sql_started', None)
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        if has_request_context():
+            trace = g.get('sql_trace')
+            if trace is None:
+                trace = g.sql_trace = RequestTrace()
+            trace.count += 1
+            trace.seconds += seconds
+            trace.statements[statement] += 1
+        if seconds * 1000 >= config['SQL_SLOW_QUERY_MS']:
+            logger.warning('slow query: %.1f ms %s parameters %s',
+                           seconds * 1000, statement,
+                           parameter_shape(parameters, executemany))
+        if _budgets and not statement.startswith(TRANSACTION_CONTROL):
+            with _budgets_lock:
+                for budget in _budgets.values():
+                    budget.append(statement)
+
+
+def request_trace():
+    """returns the RequestTrace of the current request, or None"""
+    return g.get('sql_trace') if has_request_context() else None
+
+
+class SQLTrace(object):
+    def init_app(self, app):
+        app.after_request(self._report)
+
+    @staticmethod
+    def _report(response):
+        trace = request_trace()
+        if trace is None:
+            return response
+        config = current_app.config
+        if config['SQL_SERVER_TIMING']:
+            response.headers.add(
+                'Server-Timing', f'db;dur={trace.seconds * 1000:.1f};'
+                f'desc="{trace.count} queries"')
+        for statement, count in trace.statements.items():
+            if count >= config['SQL_REPEAT_THRESHOLD']:
+                logger.warning('%d identical queries in %s %s, likely '
+                               'N+1: %s', count, request.method,
+                               request.path, statement)
+        return response
+
+
+sql_trace = SQLTrace()
+
+
+@contextmanager
+def query_budget(limit):
+    '''fails with an AssertionError when the block runs more than limit
+        statements, on any traced engine and in any thread
+    '''
+    statements = []
+    with _budgets_lock:
+        _budgets[id(statements)] = statements
+    try:
+        yield statements
+    finally:
+        with _budgets_lock:
+            del _budgets[id(statements)]
+    if len(statements) > limit:
+        raise AssertionError(
+            f'{len(statements)} queries, over the budget of {limit}:\n' +
+            '\n'.join(statements))
@@ -1,10 +1,189 @@
 import unittest
+import asyncio
 import os
 import json
-from app import create_app
-from models import setup_db, db, Movies, Actors, db_drop_and_create_all
-from flask_sqlalchemy import SQLAlchemy
-from datetime import date
+import base64
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+import rsa
+from jose import jwt
+import weakref
+from sqlalchemy import event, inspect, orm, text
+from sqlalchemy.engine.url import make_url
+from flask import Flask, _app_ctx_stack
+from flask_migrate import Migrate, upgrade, downgrade
+import auth
+from app import create_app, MOVIE_FILTERS, ACTOR_FILTERS
+from models import setup_db, db, Movies, Actors, db_init_records
+from models import movie_actor_relationship, _touch
+from cache import LocalBackend, response_cache
+from queries import encode_since, indexed_sort, _index_orders
+from changes import changes, _payloads, MAX_PAYLOAD
+from pool import PoolStats, TimedQueuePool, engine_options, guard_fork
+from pool import pool_stats
+from routing import replicas
+from asgi import WsgiToAsgi, create_asgi_app
+from metrics import MmapValues, Registry
+from autocomplete import PrefixIndex, autocomplete
+from sqltrace import parameter_shape, query_budget
+from sqlalchemy import create_engine, exc
+from sqlalchemy.pool import StaticPool
+from flask import json as flask_json
+from datetime import date, datetime, timedelta
+
+# ----------------------------------------------------------------------------#
+# Test database
+# ----------------------------------------------------------------------------#
+
+'''
+Test database
+    TEST_DATABASE_URL (default DATABASE_URL) is the database of the tests,
+        sqlite:// runs them against an in-memory SQLite database
+    under pytest-xdist every worker gets its own database: the worker id is
+        added to the SQLite file name or the Postgres database name, and a
+        missing Postgres database is created
+    the tables are created once per database and process; every test of a
+        TransactionalTestCase runs in one transaction on one connection,
+        the commits of the app only release a SAVEPOINT, and the
+        transaction is rolled back after the test
+    tests that need real commits (other threads or connections, NOTIFY)
+        set transactional = False and get new tables instead
+'''
+
+MEMORY_DATABASES = (None, '', ':memory:')
+
+
+def worker_database_url(url, worker):
+    """returns the url of the database of the pytest-xdist worker"""
+    database_url = make_url(url)
+    if not worker or database_url.database in MEMORY_DATABASES:
+        return url
+    if database_url.get_backend_name() == 'sqlite':
+        root, extension = os.path.splitext(database_url.database)
+        database_url.database = f'{root}_{worker}{extension}'
+        return str(database_url)
+
+    name = f'{database_url.database}_{worker}'
+    admin_url = make_url(url)
+    admin_url.database = 'postgres'
+    engine = create_engine(admin_url, isolation_level='AUTOCOMMIT')
+    with engine.connect() as connection:
+        if not connection.scalar(text(
+                'SELECT 1 FROM pg_database WHERE datname = :name'),
+                name=name):
+            connection.execute(f'CREATE DATABASE "{name}"')
+    engine.dispose()
+    database_url.database = name
+    return str(database_url)
+
+
+os.environ['DATABASE_URL'] = worker_database_url(
+    os.environ.get('TEST_DATABASE_URL', os.environ['DATABASE_URL']),
+    os.environ.get('PYTEST_XDIST_WORKER'))
+
+# the fixture each database holds: {url: fixture}, the engines of in-memory
+# databases are databases of their own
+_fixtures = {}
+_memory_fixtures = weakref.WeakKeyDictionary()
+
+
+def _fixture_store(engine):
+    if engine.url.database in MEMORY_DATABASES:
+        return _memory_fixtures, engine
+    return _fixtures, str(engine.url)
+
+
+class SavepointSession(orm.scoped_session):
+    '''Flask-SQLAlchemy removes the session after every request; closing
+        would leave the savepoint open, rolling back to the last commit
+        ends it and starts the next one
+    '''
+    def remove(self):
+        if self.registry.has():
+            self.registry().rollback()
+
+
+class TransactionalTestCase(unittest.TestCase):
+    transactional = True
+    # name of the rows populate() adds to the new tables
+    fixture = 'empty'
+
+    def populate(self):
+        """adds the rows every test of the class starts with"""
+
+    def use_database(self, app):
+        '''gives the test the tables of app's database holding the fixture
+            rows only, in a transaction rolled back after the test
+        '''
+        engine = db.get_engine(app)
+        store, key = _fixture_store(engine)
+        if not self.transactional:
+            # the rows it commits stay, the next test starts over
+            store.pop(key, None)
+            db.Model.metadata.drop_all(engine)
+            db.Model.metadata.create_all(engine)
+            self.populate()
+            return
+        if store.get(key) != self.fixture:
+            db.Model.metadata.drop_all(engine)
+            db.Model.metadata.create_all(engine)
+            self.populate()
+            db.session.remove()
+            store[key] = self.fixture
+
+        connection = engine.connect()
+        sqlite = engine.dialect.name == 'sqlite'
+        if sqlite:
+            # pysqlite begins transactions itself, and not before SAVEPOINT
+            connection.connection.connection.isolation_level = None
+        transaction = connection.begin()
+        if sqlite:
+            connection.execute(text('BEGIN'))
+        else:
+            # sequences ignore rollbacks, restart them after the fixture
+            for table in db.Model.metadata.sorted_tables:
+                if 'id' in table.c:
+                    connection.execute(text(
+                        f"SELECT setval(pg_get_serial_sequence("
+                        f"'{table.name}', 'id'), coalesce(max(id), 0) + 1, "
+                        f"false) FROM {table.name}"))
+
+        sessions = db.create_session({'bind': connection, 'binds': {}})
+        restarting = [True]
+
+        def session():
+            new_session = sessions()
+            new_session.begin_nested()
+            return new_session
+
+        @event.listens_for(sessions, 'after_transaction_end')
+        def restart_savepoint(session, ended):
+            if (restarting[0] and ended.nested and
+                    not ended._parent.nested):
+                session.expire_all()
+                session.begin_nested()
+
+        original = db.session
+        db.session = SavepointSession(
+            session, scopefunc=_app_ctx_stack.__ident_func__)
+
+        def rollback():
+            restarting[0] = False
+            if db.session.registry.has():
+                db.session.rollback()
+                db.session.close()
+            db.session = original
+            transaction.rollback()
+            if sqlite:
+                connection.connection.connection.isolation_level = ''
+            connection.close()
+        self.addCleanup(rollback)
+
 
 # get tokens
 assistant_token = os.getenv('ASSISTANT_TOKEN')
@@ -24,26 +203,22 @@ executive_producer_auth_header = {
 }
 
 
-class CastingTestCase(unittest.TestCase):
+class CastingTestCase(TransactionalTestCase):
+    fixture = 'init_records'
+
+    def populate(self):
+        db_init_records()
 
     def setUp(self):
         """Define test variables and initialize app."""
 
         self.app = create_app()
         self.client = self.app.test_client
-        self.database_path = os.environ['DATABASE_URL']
-        setup_db(self.app, self.database_path)
         self.casting_director_auth_header = casting_director_auth_header
         self.casting_assistant_auth_header = casting_assistant_auth_header
         self.executive_producer_auth_header = executive_producer_auth_header
 
-        db_drop_and_create_all()
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+        self.use_database(self.app)
 
     def tearDown(self):
         """Executed after reach test"""
@@ -388,5 +563,2569 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'not found')
 
 
+# ----------------------------------------------------------------------------#
+# Tests for the JWKS cache, run offline against a local JWKS file
+# ----------------------------------------------------------------------------#
+
+
+def b64_int(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def make_signing_key(kid):
+    """returns (private pem, public jwk) for a new RSA key"""
+    public, private = rsa.newkeys(1024)
+    public_jwk = {
+        'kty': 'RSA',
+        'kid': kid,
+        'use': 'sig',
+        'alg': 'RS256',
+        'n': b64_int(public.n),
+        'e': b64_int(public.e)
+    }
+    return private.save_pkcs1().decode('ascii'), public_jwk
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class OfflineAuthTestCase(unittest.TestCase):
+    """Base class swapping the auth caches for ones backed by a local
+    JWKS file."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.private_pem, cls.public_jwk = make_signing_key('kid-1')
+        cls.other_pem, cls.other_jwk = make_signing_key('kid-2')
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.jwks_path = os.path.join(self.tmpdir, 'jwks.json')
+        self.write_jwks([self.public_jwk])
+        self.clock = FakeClock()
+        self.cache = auth.JWKSCache('file://' + self.jwks_path, ttl=60,
+                                    stale_ttl=60, min_refresh_interval=10,
+                                    clock=self.clock)
+        self.token_cache = auth.TokenCache(maxsize=2, keys=self.cache)
+        self.rejected_cache = auth.RejectedTokenCache(maxsize=2)
+        self.originals = (auth.jwks_cache, auth.token_cache,
+                          auth.rejected_token_cache)
+        auth.jwks_cache = self.cache
+        auth.token_cache = self.token_cache
+        auth.rejected_token_cache = self.rejected_cache
+
+    def tearDown(self):
+        (auth.jwks_cache, auth.token_cache,
+         auth.rejected_token_cache) = self.originals
+        shutil.rmtree(self.tmpdir)
+
+    def write_jwks(self, keys):
+        with open(self.jwks_path, 'w') as jwks_file:
+            json.dump({'keys': keys}, jwks_file)
+
+    def make_token(self, private_pem=None, kid='kid-1', **claims):
+        payload = {
+            'iss': f'https://{auth.AUTH0_DOMAIN}/',
+            'aud': auth.API_AUDIENCE,
+            'exp': int(time.time()) + 3600,
+            'permissions': ['read:movies']
+        }
+        payload.update(claims)
+        return jwt.encode(payload, private_pem or self.private_pem,
+                          algorithm='RS256', headers={'kid': kid})
+
+
+class JWKSCacheTestCase(OfflineAuthTestCase):
+
+    def test_keys_fetched_once(self):
+        """Test repeated lookups reuse the fetched key set."""
+        for _ in range(5):
+            self.assertIsNotNone(self.cache.get_key('kid-1'))
+        self.assertEqual(self.cache.fetches, 1)
+
+    def test_unknown_kid_refreshes(self):
+        """Test an unknown kid forces a rate limited refresh."""
+        self.cache.get_key('kid-1')
+        self.write_jwks([self.public_jwk, self.other_jwk])
+
+        self.assertIsNone(self.cache.get_key('kid-2'))
+        self.assertEqual(self.cache.fetches, 1)
+
+        self.clock.now += 10
+        self.assertIsNotNone(self.cache.get_key('kid-2'))
+        self.assertIsNone(self.cache.get_key('kid-3'))
+        self.assertEqual(self.cache.fetches, 2)
+
+    def wait_for_refresh(self):
+        while self.cache._lock.locked():
+            time.sleep(0.01)
+
+    def test_stale_keys_served_when_fetch_fails(self):
+        """Test the cached keys outlive a failing JWKS endpoint until the
+        end of the stale window."""
+        self.cache.get_key('kid-1')
+        os.remove(self.jwks_path)
+
+        self.clock.now += 90
+        self.assertIsNotNone(self.cache.get_key('kid-1'))
+        self.wait_for_refresh()
+        self.clock.now += 29
+        self.assertIsNotNone(self.cache.get_key('kid-1'))
+        self.wait_for_refresh()
+        self.clock.now += 1
+        with self.assertRaises(auth.AuthError) as raised:
+            self.cache.get_key('kid-1')
+        self.assertEqual(raised.exception.status_code, 503)
+
+    def test_background_refresh_rate_limited(self):
+        """Test a failed background refresh is not retried by every
+        request of the stale window."""
+        self.cache.get_key('kid-1')
+        os.remove(self.jwks_path)
+
+        self.clock.now += 90
+        self.cache.get_key('kid-1')
+        self.wait_for_refresh()
+        self.clock.now += 5
+        for _ in range(5):
+            self.cache.get_key('kid-1')
+        self.wait_for_refresh()
+        self.assertEqual(self.cache.attempts, 2)
+
+        self.clock.now += 5
+        self.cache.get_key('kid-1')
+        self.wait_for_refresh()
+        self.assertEqual(self.cache.attempts, 3)
+
+    def test_expired_keys_refresh_rate_limited(self):
+        """Test past the stale window a failing endpoint is fetched at
+        most once per min_refresh_interval."""
+        self.cache.get_key('kid-1')
+        os.remove(self.jwks_path)
+        self.clock.now += 200
+
+        for _ in range(5):
+            with self.assertRaises(auth.AuthError):
+                self.cache.get_key('kid-1')
+        self.assertEqual(self.cache.attempts, 2)
+
+        self.write_jwks([self.public_jwk])
+        with self.assertRaises(auth.AuthError):
+            self.cache.get_key('kid-1')
+        self.clock.now += 10
+        self.assertIsNotNone(self.cache.get_key('kid-1'))
+        self.assertEqual(self.cache.attempts, 3)
+
+    def test_error_503_no_keys(self):
+        """Test an unreachable JWKS endpoint without cached keys."""
+        os.remove(self.jwks_path)
+        with self.assertRaises(auth.AuthError) as raised:
+            self.cache.get_key('kid-1')
+        self.assertEqual(raised.exception.status_code, 503)
+
+    def test_verify_decode_jwt_uses_cache(self):
+        """Test tokens are verified with the cached key."""
+        payload = auth.verify_decode_jwt(self.make_token())
+        auth.verify_decode_jwt(self.make_token())
+        self.assertEqual(payload['permissions'], ['read:movies'])
+        self.assertEqual(self.cache.fetches, 1)
+
+    def test_error_400_wrong_signing_key(self):
+        """Test a token signed by an unknown key is rejected."""
+        with self.assertRaises(auth.AuthError) as raised:
+            auth.verify_decode_jwt(self.make_token(self.other_pem))
+        self.assertEqual(raised.exception.status_code, 400)
+
+
+# ----------------------------------------------------------------------------#
+# Tests for the verified token cache
+# ----------------------------------------------------------------------------#
+
+
+class TokenCacheTestCase(OfflineAuthTestCase):
+
+    def test_repeat_token_hits_cache(self):
+        """Test a repeated token is verified only once."""
+        token = self.make_token()
+        first = auth.verify_token(token)
+        second = auth.verify_token(token)
+
+        self.assertIs(first, second)
+        self.assertEqual(first.permissions, frozenset(['read:movies']))
+        self.assertEqual(self.token_cache.hits, 1)
+        self.assertEqual(self.token_cache.misses, 1)
+
+    def test_expired_entry_evicted(self):
+        """Test an entry is dropped once the token expires."""
+        token = self.make_token()
+        auth.verify_token(token)
+        self.token_cache.clock = lambda: time.time() + 7200
+
+        self.assertIsNone(self.token_cache.get(token))
+
+    def test_rotated_key_evicts_entry(self):
+        """Test entries signed by a rotated out key are dropped."""
+        token = self.make_token()
+        auth.verify_token(token)
+        self.write_jwks([self.other_jwk])
+        self.cache.refresh()
+
+        self.assertIsNone(self.token_cache.get(token))
+
+    def test_expired_key_evicts_entry(self):
+        """Test entries are dropped once their key is past the stale
+        window."""
+        token = self.make_token()
+        auth.verify_token(token)
+        self.clock.now += 120
+
+        self.assertIsNone(self.token_cache.get(token))
+
+    def test_cache_is_bounded(self):
+        """Test the least recently used entry is evicted."""
+        tokens = [self.make_token(sub=str(i)) for i in range(3)]
+        for token in tokens:
+            auth.verify_token(token)
+
+        self.assertEqual(self.token_cache.stats()['size'], 2)
+        self.assertIsNone(self.token_cache.get(tokens[0]))
+
+    def test_check_permissions_with_set(self):
+        """Test permissions are checked against the cached set."""
+        entry = auth.verify_token(self.make_token())
+        self.assertTrue(auth.check_permissions(
+            'read:movies', entry.payload, entry.permissions))
+        with self.assertRaises(auth.AuthError):
+            auth.check_permissions(
+                'write:movies', entry.payload, entry.permissions)
+
+
+# ----------------------------------------------------------------------------#
+# Tests for the token pre-checks and the rejected token cache
+# ----------------------------------------------------------------------------#
+
+
+class RejectedTokenTestCase(OfflineAuthTestCase):
+
+    def assertRejected(self, token, status_code):
+        with self.assertRaises(auth.AuthError) as raised:
+            auth.verify_token(token)
+        self.assertEqual(raised.exception.status_code, status_code)
+        return raised.exception
+
+    def test_error_401_malformed_token(self):
+        """Test a malformed token fails before fetching the JWKS."""
+        self.assertRejected('not-a-jwt', 401)
+        self.assertRejected('a.b', 401)
+        self.assertRejected('!!.??.**', 400)
+        self.assertEqual(self.cache.fetches, 0)
+
+    def test_error_401_expired_token(self):
+        """Test an expired token fails before fetching the JWKS."""
+        error = self.assertRejected(
+            self.make_token(exp=int(time.time()) - 60), 401)
+        self.assertEqual(error.error['code'], 'token_expired')
+        self.assertEqual(self.cache.fetches, 0)
+
+    def test_rejected_token_replayed(self):
+        """Test a rejected token is not verified a second time."""
+        token = self.make_token(self.other_pem)
+        self.assertRejected(token, 400)
+        self.write_jwks([])
+        self.clock.now += 60
+        self.assertRejected(token, 400)
+
+        self.assertEqual(self.cache.fetches, 1)
+        self.assertEqual(self.rejected_cache.hits, 1)
+
+    def test_rejection_expires(self):
+        """Test a rejected token is verified again after the ttl."""
+        token = self.make_token()
+        self.rejected_cache.put(token, auth.AuthError({}, 401))
+        self.assertRejected(token, 401)
+
+        self.rejected_cache.clock = lambda: time.monotonic() + 60
+        self.assertTrue(auth.verify_token(token).payload)
+
+    def test_error_503_not_remembered(self):
+        """Test an unreachable JWKS endpoint is not cached as a rejection."""
+        os.remove(self.jwks_path)
+        token = self.make_token()
+        self.assertRejected(token, 503)
+        self.assertEqual(self.rejected_cache.stats()['size'], 0)
+
+
+# ----------------------------------------------------------------------------#
+# Endpoint tests with locally signed tokens
+# ----------------------------------------------------------------------------#
+
+
+class OfflineAppTestCase(TransactionalTestCase, OfflineAuthTestCase):
+    """Base class for endpoint tests that don't need live Auth0 tokens."""
+
+    def setUp(self):
+        super().setUp()
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.use_database(self.app)
+
+    def auth_header(self, *permissions):
+        token = self.make_token(permissions=list(permissions))
+        return {'Authorization': 'Bearer {}'.format(token)}
+
+    def query_plan(self, path, permission, table):
+        """returns the query plan of the last SELECT from table run by
+        GET path
+        """
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, many):
+            if statement.startswith('SELECT') and f'FROM {table}' in statement:
+                statements.append((statement, parameters))
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            res = self.client().get(path,
+                                    headers=self.auth_header(permission))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+        self.assertEqual(res.status_code, 200)
+
+        statement, parameters = statements[-1]
+        connection = db.session.connection()
+        if db.engine.dialect.name == 'sqlite':
+            return ' '.join(row[-1] for row in connection.execute(
+                'EXPLAIN QUERY PLAN ' + statement, parameters))
+        # the test tables are too small for the planner to pick an index
+        connection.execute('SET LOCAL enable_seqscan = off')
+        return ' '.join(row[0] for row in connection.execute(
+            'EXPLAIN ' + statement, parameters))
+
+    def assertSortedByIndex(self, plan, index):
+        self.assertIn(index, plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+        self.assertNotIn('Sort', plan)
+
+    def seed(self, count):
+        """adds count movies and count actors"""
+        first = date(2000, 1, 1)
+        db.session.add_all(
+            [Movies(title=f'Movie {i:03}',
+                    release_date=first + timedelta(days=(i * 7) % count))
+             for i in range(count)] +
+            [Actors(name=f'Actor {(i * 7) % count:03}',
+                    gender='Female' if i % 2 else 'Male')
+             for i in range(count)])
+        db.session.commit()
+
+
+# ----------------------------------------------------------------------------#
+# Tests for paginated GET movies and actors
+# ----------------------------------------------------------------------------#
+
+
+class PaginationTestCase(OfflineAppTestCase):
+
+    def walk(self, path, key, permission):
+        """follows the next cursors and returns every row"""
+        rows = []
+        url = path
+        while True:
+            res = self.client().get(url, headers=self.auth_header(permission))
+            data = res.get_json()
+            self.assertEqual(res.status_code, 200)
+            rows.extend(data[key])
+            if data['next'] is None:
+                return rows
+            separator = '&' if '?' in path else '?'
+            url = f'{path}{separator}cursor={data["next"]}'
+
+    def test_default_page_size(self):
+        """Test GET movies returns PAGE_SIZE rows and a cursor."""
+        self.seed(self.app.config['PAGE_SIZE'] + 1)
+        res = self.client().get(
+            '/movies', headers=self.auth_header('read:movies'))
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies']), self.app.config['PAGE_SIZE'])
+        self.assertIsNotNone(data['next'])
+
+    def test_walk_actors_by_id(self):
+        """Test following the cursors visits every actor once."""
+        self.seed(25)
+        actors = self.walk('/actors?limit=10', 'actors', 'read:actors')
+        self.assertEqual([actor['id'] for actor in actors],
+                         list(range(1, 26)))
+
+    def test_walk_actors_by_name(self):
+        """Test keyset pagination on actor names."""
+        self.seed(25)
+        actors = self.walk('/actors?limit=4&sort=name', 'actors',
+                           'read:actors')
+        names = [actor['name'] for actor in actors]
+        self.assertEqual(names, sorted(names))
+        self.assertEqual(len(set(actor['id'] for actor in actors)), 25)
+
+    def test_walk_movies_by_release_date_desc(self):
+        """Test descending keyset pagination on release dates."""
+        self.seed(25)
+        movies = self.walk('/movies?limit=6&sort=-release_date', 'movies',
+                           'read:movies')
+        keys = [(Movies.query.get(movie['id']).release_date, movie['id'])
+                for movie in movies]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+        self.assertEqual(len(keys), 25)
+
+    def test_limit_is_capped(self):
+        """Test ?limit= can't exceed MAX_PAGE_SIZE."""
+        self.app.config['MAX_PAGE_SIZE'] = 5
+        self.seed(10)
+        res = self.client().get(
+            '/movies?limit=1000', headers=self.auth_header('read:movies'))
+        self.assertEqual(len(res.get_json()['movies']), 5)
+
+    def test_error_400_bad_page_args(self):
+        """Test invalid limit, sort and cursor values."""
+        header = self.auth_header('read:actors')
+        for query in ('limit=0', 'limit=ten', 'sort=created_at',
+                      'cursor=garbage'):
+            res = self.client().get(f'/actors?{query}', headers=header)
+            self.assertEqual(res.status_code, 400, query)
+
+        res = self.client().get('/actors?limit=1', headers=header)
+        self.assertIsNone(res.get_json()['next'])
+
+    def test_error_400_cursor_of_wrong_types(self):
+        """Test cursor values must have the type of their sort column."""
+        def cursor(sort, after):
+            data = json.dumps({'sort': sort, 'after': after})
+            return base64.urlsafe_b64encode(data.encode('utf-8')).decode()
+
+        header = self.auth_header('read:movies')
+        for query in (f'cursor={cursor("id", ["x"])}',
+                      f'cursor={cursor("id", [{"id": 1}])}',
+                      f'cursor={cursor("id", [True])}',
+                      f'sort=title&cursor={cursor("title", [1, 1])}',
+                      f'sort=release_date&cursor='
+                      f'{cursor("release_date", [20000101, 1])}'):
+            res = self.client().get(f'/movies?{query}', headers=header)
+            self.assertEqual(res.status_code, 400, query)
+
+        res = self.client().get(
+            f'/movies?sort=title&cursor={cursor("title", ["Movie", 1])}',
+            headers=header)
+        self.assertEqual(res.status_code, 200)
+
+    def test_error_400_cursor_for_other_sort(self):
+        """Test a cursor can't be reused with another sort."""
+        self.seed(3)
+        header = self.auth_header('read:actors')
+        cursor = self.client().get(
+            '/actors?limit=1', headers=header).get_json()['next']
+        res = self.client().get(
+            f'/actors?limit=1&sort=name&cursor={cursor}', headers=header)
+        self.assertEqual(res.status_code, 400)
+
+
+# ----------------------------------------------------------------------------#
+# Tests for streamed GET movies and actors
+# ----------------------------------------------------------------------------#
+
+
+class StreamingTestCase(OfflineAppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['STREAM_BATCH_SIZE'] = 7
+        self.seed(self.app.config['PAGE_SIZE'] + 10)
+
+    def test_stream_json(self):
+        """Test ?stream=1 returns every movie in one JSON document."""
+        res = self.client().get(
+            '/movies?stream=1', headers=self.auth_header('read:movies'))
+        data = json.loads(res.get_data(as_text=True))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual([movie['id'] for movie in data['movies']],
+                         list(range(1, self.app.config['PAGE_SIZE'] + 11)))
+        self.assertEqual(data['movies'][0]['title'], 'Movie 000')
+
+    def test_stream_ndjson(self):
+        """Test Accept: application/x-ndjson streams one actor per line."""
+        headers = self.auth_header('read:actors')
+        headers['Accept'] = 'application/x-ndjson'
+        res = self.client().get('/actors?sort=-name', headers=headers)
+        lines = res.get_data(as_text=True).splitlines()
+        names = [json.loads(line)['name'] for line in lines]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(names), self.app.config['PAGE_SIZE'] + 10)
+        self.assertEqual(names, sorted(names, reverse=True))
+
+    def test_stream_empty_table(self):
+        """Test a streamed dump of an empty table is valid JSON."""
+        Actors.query.delete()
+        db.session.commit()
+        res = self.client().get(
+            '/actors?stream=1', headers=self.auth_header('read:actors'))
+        self.assertEqual(json.loads(res.get_data(as_text=True)),
+                         {'success': True, 'actors': []})
+
+
+# ----------------------------------------------------------------------------#
+# Tests for sparse fieldsets on GET movies and actors
+# ----------------------------------------------------------------------------#
+
+
+class FieldsTestCase(OfflineAppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.seed(5)
+
+    def test_projection_matches_format(self):
+        """Test the column projection serializes like format()."""
+        res = self.client().get(
+            '/movies', headers=self.auth_header('read:movies'))
+        with self.app.app_context():
+            expected = json.loads(flask_json.dumps(
+                [movie.format() for movie in Movies.query]))
+        self.assertEqual(res.get_json()['movies'], expected)
+
+    def test_sparse_fields(self):
+        """Test ?fields= only returns the requested columns."""
+        res = self.client().get(
+            '/actors?fields=name&sort=-id&limit=2',
+            headers=self.auth_header('read:actors'))
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'], [{'name': 'Actor 003'},
+                                          {'name': 'Actor 001'}])
+        self.assertIsNotNone(data['next'])
+
+    def test_sparse_fields_stream(self):
+        """Test ?fields= applies to streamed dumps."""
+        res = self.client().get(
+            '/movies?stream=1&fields=title,id',
+            headers=self.auth_header('read:movies'))
+        movies = json.loads(res.get_data(as_text=True))['movies']
+        self.assertEqual(movies[0], {'title': 'Movie 000', 'id': 1})
+
+    def test_error_400_unknown_field(self):
+        """Test ?fields= rejects unknown columns."""
+        res = self.client().get(
+            '/actors?fields=id,salary',
+            headers=self.auth_header('read:actors'))
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.get_json()['message'], 'bad request')
+
+
+# ----------------------------------------------------------------------------#
+# Tests for POST movies/bulk and actors/bulk
+# ----------------------------------------------------------------------------#
+
+
+class BulkCreateTestCase(OfflineAppTestCase):
+
+    def test_bulk_create_actors(self):
+        """Test POST actors/bulk inserts every valid actor."""
+        res = self.client().post(
+            '/actors/bulk',
+            json=[{'name': 'George Clooney', 'gender': 'Male'},
+                  {'name': 'Meryl Streep', 'gender': 'Female'}],
+            headers=self.auth_header('write:actors'))
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual([actor['index'] for actor in data['actors']], [0, 1])
+        self.assertEqual(Actors.query.get(data['actors'][1]['id']).name,
+                         'Meryl Streep')
+        self.assertEqual(data['errors'], [])
+
+    def test_bulk_insert_maps_ids_to_rows(self):
+        """Test bulk inserted actors get the id of their own row, with one
+        INSERT per chunk."""
+        self.seed(3)
+        Actors.bulk_delete([3])
+        rows = [{'name': f'Same {i % 2}', 'gender': ['Male', 'Female',
+                                                     'Other'][i % 3]}
+                for i in range(501)]
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            ids = Actors.bulk_insert(rows)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(len([statement for statement in statements
+                              if statement.startswith('INSERT INTO actors ')]),
+                         2)
+        self.assertEqual(len(set(ids)), 501)
+        found = {actor.id: {'name': actor.name, 'gender': actor.gender}
+                 for actor in Actors.query.filter(Actors.id.in_(ids))}
+        self.assertEqual([found[id] for id in ids], rows)
+
+    def test_bulk_create_reports_invalid_items(self):
+        """Test invalid items are reported and valid ones inserted."""
+        res = self.client().post(
+            '/movies/bulk',
+            json=[{'title': 'Sparta', 'release_date': '2020-02-16'},
+                  {'title': 'No date'},
+                  {'title': 'Sparta', 'release_date': '2020-02-17'},
+                  'not an object',
+                  {'title': 'Heat',
+                   'release_date': 'Fri, 15 Dec 1995 00:00:00 GMT'}],
+            headers=self.auth_header('write:movies'))
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual([movie['index'] for movie in data['movies']], [0, 4])
+        self.assertEqual([error['index'] for error in data['errors']],
+                         [1, 2, 3])
+        self.assertEqual(Movies.query.filter_by(title='Heat').one()
+                         .release_date, date(1995, 12, 15))
+
+    def test_bulk_create_ndjson(self):
+        """Test POST actors/bulk with an NDJSON body."""
+        body = '\n'.join([json.dumps({'name': 'A', 'gender': 'Male'}),
+                          '{broken',
+                          json.dumps({'name': 'B', 'gender': 'Female'})])
+        res = self.client().post(
+            '/actors/bulk', data=body, content_type='application/x-ndjson',
+            headers=self.auth_header('write:actors'))
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(len(data['actors']), 2)
+        self.assertEqual(data['errors'],
+                         [{'index': 1, 'message': 'invalid json'}])
+
+    def test_bulk_create_title_conflicts(self):
+        """Test existing titles are skipped or updated."""
+        self.seed(2)
+        header = self.auth_header('write:movies')
+        movies = [{'title': 'Movie 000', 'release_date': '1999-01-01'},
+                  {'title': 'New', 'release_date': '1999-01-01'}]
+
+        data = self.client().post(
+            '/movies/bulk', json=movies, headers=header).get_json()
+        self.assertEqual(data['skipped'], [0])
+        self.assertEqual(Movies.query.get(1).release_date, date(2000, 1, 1))
+
+        data = self.client().post(
+            '/movies/bulk?on_conflict=update', json=movies,
+            headers=header).get_json()
+        self.assertEqual(data['movies'][0], {'index': 0, 'id': 1})
+        self.assertEqual(Movies.query.get(1).release_date, date(1999, 1, 1))
+        self.assertEqual(Movies.query.count(), 3)
+
+    def test_error_400_bulk_all_invalid(self):
+        """Test a bulk request without any valid item."""
+        res = self.client().post(
+            '/actors/bulk', json=[{'name': 'No gender'}],
+            headers=self.auth_header('write:actors'))
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['errors'][0]['message'], 'gender is required')
+
+    def test_error_413_bulk_too_large(self):
+        """Test bulk requests over MAX_BULK_SIZE are refused."""
+        self.app.config['MAX_BULK_SIZE'] = 1
+        res = self.client().post(
+            '/actors/bulk', json=[{'name': 'A', 'gender': 'Male'}] * 2,
+            headers=self.auth_header('write:actors'))
+        self.assertEqual(res.status_code, 413)
+
+    def test_error_401_bulk_without_permission(self):
+        """Test POST movies/bulk requires write:movies."""
+        res = self.client().post(
+            '/movies/bulk', json=[],
+            headers=self.auth_header('write:actors'))
+        self.assertEqual(res.status_code, 401)
+
+
+# ----------------------------------------------------------------------------#
+# Tests for PATCH and DELETE movies/bulk and actors/bulk
+# ----------------------------------------------------------------------------#
+
+
+class BulkEditTestCase(OfflineAppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.seed(5)
+        db.session.execute(movie_actor_relationship.insert(), [
+            {'movie_id': 1, 'actor_id': 1},
+            {'movie_id': 2, 'actor_id': 1},
+            {'movie_id': 2, 'actor_id': 2}])
+        db.session.commit()
+
+    def links(self):
+        return db.session.execute(
+            movie_actor_relationship.select()).fetchall()
+
+    def test_bulk_edit_actors(self):
+        """Test PATCH actors/bulk updates every existing actor."""
+        res = self.client().patch(
+            '/actors/bulk',
+            json=[{'id': 1, 'gender': 'Other'},
+                  {'id': 2, 'gender': 'Other'},
+                  {'id': 3, 'name': 'Bradley Cooper'},
+                  {'id': 99, 'gender': 'Other'},
+                  {'id': 4}],
+            headers=self.auth_header('update:actors'))
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], [1, 2, 3])
+        self.assertEqual(data['not_found'], [99])
+        self.assertEqual(data['errors'][0]['index'], 4)
+        db.session.expire_all()
+        self.assertEqual(Actors.query.get(2).gender, 'Other')
+        self.assertEqual(Actors.query.get(3).name, 'Bradley Cooper')
+
+    def test_bulk_edit_is_atomic(self):
+        """Test a failing patch rolls back the whole batch."""
+        with mock.patch('models._touch',
+                        side_effect=exc.OperationalError('', {}, None)):
+            res = self.client().patch(
+                '/movies/bulk',
+                json=[{'id': 1, 'release_date': '1999-01-01'},
+                      {'id': 2, 'title': 'Renamed'}],
+                headers=self.auth_header('update:movies'))
+
+        self.assertEqual(res.status_code, 422)
+        db.session.expire_all()
+        self.assertEqual(Movies.query.get(1).release_date, date(2000, 1, 1))
+        self.assertEqual(Movies.query.get(2).title, 'Movie 001')
+
+    def test_bulk_edit_title_conflicts(self):
+        """Test titles already taken are reported per item."""
+        res = self.client().patch(
+            '/movies/bulk',
+            json=[{'id': 1, 'release_date': '1999-01-01'},
+                  {'id': 2, 'title': 'Movie 003'},
+                  {'id': 3, 'title': 'Sequel'},
+                  {'id': 4, 'title': 'Sequel'},
+                  {'id': 5, 'title': 'Movie 004'}],
+            headers=self.auth_header('update:movies'))
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], [1, 3, 5])
+        self.assertEqual(data['errors'], [
+            {'index': 1, 'message': 'title already exists'},
+            {'index': 3, 'message': 'duplicate title in request'}])
+        db.session.expire_all()
+        self.assertEqual(Movies.query.get(1).release_date, date(1999, 1, 1))
+        self.assertEqual(Movies.query.get(2).title, 'Movie 001')
+        self.assertEqual(Movies.query.get(3).title, 'Sequel')
+
+    def test_bulk_edit_one_statement_per_columns(self):
+        """Test distinct patches of the same columns run one UPDATE."""
+        updates = []
+
+        def count(conn, cursor, statement, *args):
+            if statement.startswith('UPDATE movies'):
+                updates.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            res = self.client().patch(
+                '/movies/bulk',
+                json=[{'id': id, 'title': f'Renamed {id}'}
+                      for id in range(1, 6)] +
+                     [{'id': 99, 'title': 'Missing'}],
+                headers=self.auth_header('update:movies'))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+        self.assertEqual(res.get_json()['updated'], [1, 2, 3, 4, 5])
+        self.assertEqual(len(updates), 1)
+        db.session.expire_all()
+        self.assertEqual(Movies.query.get(4).title, 'Renamed 4')
+
+    def test_bulk_delete_movies(self):
+        """Test DELETE movies/bulk also removes their castings."""
+        res = self.client().delete(
+            '/movies/bulk', json={'ids': [2, 3, 42]},
+            headers=self.auth_header('delete:movies'))
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], [2, 3])
+        self.assertEqual(data['not_found'], [42])
+        self.assertEqual([tuple(link) for link in self.links()], [(1, 1)])
+        self.assertEqual(Movies.query.count(), 3)
+
+    def test_bulk_delete_actors(self):
+        """Test DELETE actors/bulk also removes their castings."""
+        res = self.client().delete(
+            '/actors/bulk', json={'ids': [1]},
+            headers=self.auth_header('delete:actors'))
+
+        self.assertEqual(res.get_json()['deleted'], [1])
+        self.assertEqual([tuple(link) for link in self.links()], [(2, 2)])
+
+    def test_error_400_bulk_delete_bad_ids(self):
+        """Test DELETE actors/bulk requires a list of integer ids."""
+        header = self.auth_header('delete:actors')
+        for body in ({'ids': []}, {'ids': ['1']}, [1, 2]):
+            res = self.client().delete('/actors/bulk', json=body,
+                                       headers=header)
+            self.assertEqual(res.status_code, 400, body)
+
+
+# ----------------------------------------------------------------------------#
+# Tests for the casting endpoints
+# ----------------------------------------------------------------------------#
+
+
+class CastingEndpointsTestCase(OfflineAppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.seed(30)
+        db.session.execute(movie_actor_relationship.insert(), [
+            {'movie_id': movie_id, 'actor_id': actor_id}
+            for actor_id in range(1, 31)
+            for movie_id in range(actor_id, min(actor_id + 3, 31))])
+        db.session.commit()
+
+    def count_queries(self, request):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            res = request()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        return res, len(statements)
+
+    def test_get_actor_movies(self):
+        """Test GET actors/<id>/movies."""
+        res = self.client().get(
+            '/actors/2/movies', headers=self.auth_header('read:movies'))
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['movies']],
+                         [2, 3, 4])
+        self.assertEqual(set(data['movies'][0]), set(Movies.fields))
+
+    def test_get_movie_actors(self):
+        """Test GET movies/<id>/actors."""
+        res = self.client().get(
+            '/movies/3/actors', headers=self.auth_header('read:actors'))
+        self.assertEqual([actor['id'] for actor in res.get_json()['actors']],
+                         [1, 2, 3])
+
+    def test_error_404_casting_unknown_id(self):
+        """Test casting reads of an id that doesn't exist."""
+        res = self.client().get(
+            '/movies/300/actors', headers=self.auth_header('read:actors'))
+        self.assertEqual(res.status_code, 404)
+
+    def test_include_query_count_is_constant(self):
+        """Test ?include= costs the same number of queries for any page."""
+        header = self.auth_header('read:actors')
+        res, small = self.count_queries(lambda: self.client().get(
+            '/actors?include=movies&limit=2', headers=header))
+        self.assertEqual(len(res.get_json()['actors'][0]['movies']), 3)
+
+        res, large = self.count_queries(lambda: self.client().get(
+            '/actors?include=movies&limit=30', headers=header))
+        actors = res.get_json()['actors']
+        self.assertEqual(small, large)
+        self.assertEqual([len(actor['movies']) for actor in actors[-3:]],
+                         [3, 2, 1])
+
+    def test_include_stream(self):
+        """Test ?include= on streamed dumps."""
+        self.app.config['STREAM_BATCH_SIZE'] = 7
+        res = self.client().get(
+            '/movies?include=actors&stream=1',
+            headers=self.auth_header('read:movies'))
+        movies = json.loads(res.get_data(as_text=True))['movies']
+        self.assertEqual([actor['id'] for actor in movies[29]['actors']],
+                         [28, 29, 30])
+
+    def test_error_400_unknown_include(self):
+        """Test ?include= only accepts the linked collection."""
+        res = self.client().get(
+            '/movies?include=movies', headers=self.auth_header('read:movies'))
+        self.assertEqual(res.status_code, 400)
+
+    def test_assign_and_unassign_actor(self):
+        """Test PUT and DELETE movies/<id>/actors/<id>."""
+        header = self.auth_header('update:movies')
+        res = self.client().put('/movies/1/actors/5', headers=header)
+        self.assertEqual(res.status_code, 201)
+        res = self.client().put('/movies/1/actors/5', headers=header)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().delete('/movies/1/actors/5', headers=header)
+        self.assertEqual(res.status_code, 200)
+        res = self.client().delete('/movies/1/actors/5', headers=header)
+        self.assertEqual(res.status_code, 404)
+
+    def test_error_404_assign_unknown_actor(self):
+        """Test casting an actor that doesn't exist."""
+        res = self.client().put(
+            '/movies/1/actors/500', headers=self.auth_header('update:movies'))
+        self.assertEqual(res.status_code, 404)
+
+    def test_error_401_assign_without_permission(self):
+        """Test casting requires update:movies."""
+        res = self.client().put(
+            '/movies/1/actors/5', headers=self.auth_header('read:movies'))
+        self.assertEqual(res.status_code, 401)
+
+
+# ----------------------------------------------------------------------------#
+# Tests for the migrations
+# ----------------------------------------------------------------------------#
+
+
+class MigrationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        setup_db(self.app, 'sqlite:///' + os.path.join(self.tmpdir, 'm.db'))
+        Migrate(self.app, db)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.drop_all()
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_casting_keys_and_indexes(self):
+        """Test upgrading a database with duplicate castings."""
+        upgrade(revision='3f2c1a7d9e10')
+        db.session.execute(
+            "INSERT INTO movies (title, release_date) "
+            "VALUES ('Fight Club', '1999-10-15')")
+        db.session.execute(
+            "INSERT INTO actors (name, gender) VALUES ('Brad Pitt', 'Male')")
+        db.session.execute(
+            "INSERT INTO movie_actor_relationship "
+            "VALUES (1, 1), (1, 1), (NULL, 1)")
+        db.session.commit()
+
+        upgrade(revision='8b41d6e2c9a5')
+        inspector = inspect(db.engine)
+        self.assertEqual(
+            inspector.get_pk_constraint('movie_actor_relationship')
+            ['constrained_columns'], ['movie_id', 'actor_id'])
+        self.assertEqual(
+            [key['options'] for key in
+             inspector.get_foreign_keys('movie_actor_relationship')],
+            [{'ondelete': 'CASCADE'}] * 2)
+        self.assertEqual(
+            [index['name'] for index in inspector.get_indexes('actors')],
+            ['ix_actors_name_id'])
+        self.assertEqual(db.session.execute(
+            'SELECT * FROM movie_actor_relationship').fetchall(), [(1, 1)])
+
+        downgrade(revision='3f2c1a7d9e10')
+        self.assertEqual(inspect(db.engine).get_indexes('actors'), [])
+
+    def test_change_tracking(self):
+        """Test existing rows get timestamps and the tombstones table."""
+        upgrade(revision='8b41d6e2c9a5')
+        db.session.execute(
+            "INSERT INTO movies (title, release_date) "
+            "VALUES ('Fight Club', '1999-10-15')")
+        db.session.commit()
+
+        upgrade()
+        inspector = inspect(db.engine)
+        columns = {column['name']: column
+                   for column in inspector.get_columns('movies')}
+        self.assertFalse(columns['updated_at']['nullable'])
+        self.assertIn('ix_movies_updated_at_id',
+                      [index['name'] for index in
+                       inspector.get_indexes('movies')])
+        self.assertIn('tombstones', inspector.get_table_names())
+        movie = Movies.query.one()
+        self.assertIsNotNone(movie.created_at)
+        self.assertEqual(movie.created_at, movie.updated_at)
+
+        downgrade(revision='8b41d6e2c9a5')
+        self.assertNotIn('updated_at', [
+            column['name']
+            for column in inspect(db.engine).get_columns('movies')])
+
+    def test_search_indexes(self):
+        """Test existing rows are searchable after the upgrade."""
+        upgrade(revision='c4a9e2f7b613')
+        db.session.execute(
+            "INSERT INTO actors (name, gender, created_at, updated_at) "
+            "VALUES ('Brad Pitt', 'Male', '2020-01-01', '2020-01-01')")
+        db.session.commit()
+
+        upgrade()
+        self.assertEqual(db.session.execute(
+            "SELECT rowid FROM actors_search WHERE actors_search "
+            "MATCH 'pi*'").fetchall(), [(1,)])
+        db.session.execute("UPDATE actors SET name = 'Emma Stone'")
+        self.assertEqual(db.session.execute(
+            "SELECT rowid FROM actors_search WHERE actors_search "
+            "MATCH 'stone'").fetchall(), [(1,)])
+        db.session.commit()
+
+        downgrade(revision='c4a9e2f7b613')
+        self.assertNotIn('actors_search',
+                         inspect(db.engine).get_table_names())
+
+    def test_table_versions(self):
+        """Test every cached table starts at version 0."""
+        upgrade()
+        self.assertEqual(sorted(db.session.execute(
+            'SELECT table_name, version FROM table_versions').fetchall()),
+            [('actors', 0), ('movie_actor_relationship', 0), ('movies', 0)])
+
+        downgrade(revision='f1b7c94e2d08')
+        self.assertNotIn('table_versions',
+                         inspect(db.engine).get_table_names())
+
+
+# ----------------------------------------------------------------------------#
+# Tests for the response cache
+# ----------------------------------------------------------------------------#
+
+
+class ResponseCacheTestCase(OfflineAppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.seed(5)
+
+    def get(self, path, permission):
+        return self.client().get(path, headers=self.auth_header(permission))
+
+    def test_repeated_read_is_a_hit(self):
+        """Test the second identical GET movies is served from the cache."""
+        first = self.get('/movies?limit=2', 'read:movies')
+        second = self.get('/movies?limit=2', 'read:movies')
+
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(first.get_json(), second.get_json())
+        self.assertEqual(self.get('/movies?limit=3', 'read:movies')
+                         .headers['X-Cache'], 'MISS')
+        stats = response_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']),
+                         (1, 2, 2))
+
+    def test_get_item(self):
+        """Test GET movies/<id> and actors/<id>."""
+        res = self.get('/movies/2', 'read:movies')
+        self.assertEqual(res.get_json()['movie']['title'], 'Movie 001')
+        res = self.get('/actors/2', 'read:actors')
+        self.assertEqual(res.get_json()['actor']['name'], 'Actor 002')
+        self.assertEqual(self.get('/actors/50', 'read:actors').status_code,
+                         404)
+
+    def test_write_invalidates_table(self):
+        """Test a PATCH serves fresh movie reads but keeps actor reads."""
+        self.get('/movies/2', 'read:movies')
+        self.get('/actors', 'read:actors')
+        self.client().patch('/movies/2', json={'title': 'Renamed'},
+                            headers=self.auth_header('update:movies'))
+
+        res = self.get('/movies/2', 'read:movies')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(res.get_json()['movie']['title'], 'Renamed')
+        self.assertEqual(self.get('/actors', 'read:actors')
+                         .headers['X-Cache'], 'HIT')
+
+    def test_write_of_another_worker_invalidates(self):
+        """Test a write committed outside this process is never served."""
+        self.get('/movies/2', 'read:movies')
+        # what another worker's PATCH leaves: the row and its version
+        db.session.execute("UPDATE movies SET title = 'Renamed' WHERE id = 2")
+        _touch('movies')
+        db.session.commit()
+
+        res = self.get('/movies/2', 'read:movies')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(res.get_json()['movie']['title'], 'Renamed')
+
+    def test_bulk_and_casting_writes_invalidate(self):
+        """Test bulk deletes and castings invalidate the reads of them."""
+        self.get('/actors/1/movies', 'read:movies')
+        self.client().put('/movies/3/actors/1',
+                          headers=self.auth_header('update:movies'))
+        res = self.get('/actors/1/movies', 'read:movies')
+        self.assertEqual([movie['id'] for movie in res.get_json()['movies']],
+                         [3])
+
+        self.client().delete('/movies/bulk', json={'ids': [3]},
+                             headers=self.auth_header('delete:movies'))
+        res = self.get('/actors/1/movies', 'read:movies')
+        self.assertEqual(res.get_json()['movies'], [])
+
+    def test_errors_and_streams_are_not_cached(self):
+        """Test 404s and streamed dumps bypass the cache."""
+        self.get('/movies/50', 'read:movies')
+        self.get('/movies?stream=1', 'read:movies')
+        self.assertEqual(response_cache.stats()['size'], 0)
+
+    def test_eviction_by_size(self):
+        """Test the local backend evicts least recently used bodies."""
+        backend = LocalBackend(max_bytes=10)
+        backend.set('a', b'1234', 60)
+        backend.set('b', b'1234', 60)
+        backend.get('a')
+        backend.set('c', b'1234', 60)
+
+        self.assertEqual((backend.get('a'), backend.get('b')),
+                         (b'1234', None))
+        self.assertEqual(backend.size, 8)
+        backend.set('big', b'x' * 11, 60)
+        self.assertIsNone(backend.get('big'))
+
+    def test_concurrent_misses_build_once(self):
+        """Test concurrent requests for a missing key run the view once."""
+        app = Flask(__name__)
+        app.config['CACHE_TTL'] = 60
+        app.config['CACHE_CONTROL'] = 'no-cache'
+        app.extensions['response_cache'] = LocalBackend(1024)
+        calls = []
+
+        @app.route('/slow')
+        @response_cache.cached('movies')
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return flask_json.jsonify({'success': True})
+
+        results = []
+
+        def fetch():
+            results.append(app.test_client().get('/slow').status_code)
+        threads = [threading.Thread(target=fetch) for _ in range(8)]
+        with mock.patch('cache.table_versions',
+                        return_value=[(1, 1577836800.0)]):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(results, [200] * 8)
+        self.assertEqual(len(calls), 1)
+
+
+class ConditionalGetTestCase(OfflineAppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.seed(5)
+        self.header = self.auth_header('read:movies', 'update:movies')
+
+    def get(self, path, **headers):
+        return self.client().get(path, headers=dict(self.header, **headers))
+
+    def test_if_none_match_skips_query(self):
+        """Test a matching ETag returns 304 reading the versions only."""
+        res = self.get('/movies?limit=2')
+        etag = res.headers['ETag']
+        self.assertEqual(res.headers['Cache-Control'], 'private, no-cache')
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            res = self.get('/movies?limit=2', **{'If-None-Match': etag})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.get_data(), b'')
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual([statement for statement in statements
+                          if statement.startswith('SELECT')],
+                         [statement for statement in statements
+                          if 'FROM table_versions' in statement])
+
+    def test_etag_changes_on_write(self):
+        """Test a write to movies changes the ETag of movie reads only."""
+        movie = self.get('/movies/1').headers['ETag']
+        actors = self.client().get(
+            '/actors', headers=self.auth_header('read:actors'))
+        self.client().patch('/movies/1', json={'title': 'Renamed'},
+                            headers=self.header)
+
+        res = self.get('/movies/1', **{'If-None-Match': movie})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], movie)
+        res = self.client().get('/actors', headers=dict(
+            self.auth_header('read:actors'),
+            **{'If-None-Match': actors.headers['ETag']}))
+        self.assertEqual(res.status_code, 304)
+
+    def test_etag_changes_on_write_of_another_worker(self):
+        """Test a write committed outside this process changes the ETag,
+        with the response cache off as well."""
+        for backend in ('local', 'none'):
+            self.app.config['CACHE_BACKEND'] = backend
+            response_cache.init_app(self.app)
+            res = self.get('/movies/1')
+            _touch('movies')
+            db.session.commit()
+
+            res = self.get('/movies/1', **{
+                'If-None-Match': res.headers['ETag'],
+                'If-Modified-Since': res.headers['Last-Modified']})
+            self.assertEqual(res.status_code, 200)
+
+    def test_etag_depends_on_query(self):
+        """Test pages with different arguments have different ETags."""
+        self.assertNotEqual(self.get('/movies?limit=2').headers['ETag'],
+                            self.get('/movies?limit=3').headers['ETag'])
+
+    def test_if_modified_since(self):
+        """Test If-Modified-Since against the time of the last write."""
+        res = self.get('/movies')
+        last_modified = res.headers['Last-Modified']
+        self.assertEqual(
+            self.get('/movies', **{'If-Modified-Since': last_modified})
+            .status_code, 304)
+        self.assertEqual(
+            self.get('/movies', **{
+                'If-Modified-Since': 'Sat, 01 Jan 2000 00:00:00 GMT'})
+            .status_code, 200)
+
+    def test_without_response_cache(self):
+        """Test ETags still work with CACHE_BACKEND none."""
+        self.app.config['CACHE_BACKEND'] = 'none'
+        response_cache.init_app(self.app)
+        res = self.get('/movies')
+        self.assertNotIn('X-Cache', res.headers)
+        self.assertEqual(
+            self.get('/movies', **{'If-None-Match': res.headers['ETag']})
+            .status_code, 304)
+        self.assertEqual(response_cache.stats()['size'], 0)
+
+    def test_errors_have_no_etag(self):
+        """Test 404 responses carry no validators."""
+        self.assertNotIn('ETag', self.get('/movies/50').headers)
+
+    def test_errors_are_never_not_modified(self):
+        """Test a conditional request that fails gets its error, not a 304.
+        """
+        future = 'Fri, 01 Jan 2100 00:00:00 GMT'
+        for backend in ('local', 'none'):
+            self.app.config['CACHE_BACKEND'] = backend
+            response_cache.init_app(self.app)
+            for path, status in [('/movies/999', 404),
+                                 ('/movies?sort=bogus', 400),
+                                 ('/movies/1', 304)]:
+                res = self.get(path, **{'If-Modified-Since': future})
+                self.assertEqual(res.status_code, status, (backend, path))
+
+
+# ----------------------------------------------------------------------------#
+# Tests for delta sync
+# ----------------------------------------------------------------------------#
+
+
+class DeltaSyncTestCase(OfflineAppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['SYNC_SETTLE_SECONDS'] = 0
+        self.seed(5)
+        self.header = self.auth_header(
+            'read:movies', 'write:movies', 'update:movies', 'delete:movies')
+
+    def sync(self, since='0', limit=50):
+        """follows the sync cursors until there is no more"""
+        movies = []
+        deleted = []
+        while True:
+            res = self.client().get(f'/movies?since={since}&limit={limit}',
+                                    headers=self.header)
+            self.assertEqual(res.status_code, 200)
+            data = res.get_json()
+            movies += data['movies']
+            deleted += data['deleted']
+            since = data['next']
+            if not data['more']:
+                return movies, deleted, since
+
+    def test_initial_sync(self):
+        """Test since=0 pages through every movie and no deletes."""
+        movies, deleted, _ = self.sync(limit=2)
+        self.assertEqual(sorted(movie['id'] for movie in movies),
+                         [1, 2, 3, 4, 5])
+        self.assertEqual(deleted, [])
+
+    def test_sync_returns_changes_only(self):
+        """Test a sync after writes returns changed and deleted rows."""
+        _, _, since = self.sync()
+        self.client().patch('/movies/2', json={'title': 'Renamed'},
+                            headers=self.header)
+        self.client().post('/movies/bulk', json=[{
+            'title': 'New', 'release_date': '2020-01-01'}],
+            headers=self.header)
+        self.client().delete('/movies/bulk', json={'ids': [3, 4]},
+                             headers=self.header)
+
+        movies, deleted, since = self.sync(since)
+        self.assertEqual([(movie['id'], movie['title']) for movie in movies],
+                         [(2, 'Renamed'), (6, 'New')])
+        self.assertEqual(deleted, [3, 4])
+        self.assertEqual(self.sync(since)[:2], ([], []))
+
+    def test_settle_window(self):
+        """Test changes younger than SYNC_SETTLE_SECONDS wait."""
+        self.app.config['SYNC_SETTLE_SECONDS'] = 60
+        movies, deleted, since = self.sync()
+        self.assertEqual(movies, [])
+        self.app.config['SYNC_SETTLE_SECONDS'] = 0
+        self.assertEqual(len(self.sync(since)[0]), 5)
+
+    def test_since_is_not_cached(self):
+        """Test sync responses bypass the response cache."""
+        res = self.client().get('/movies?since=0', headers=self.header)
+        self.assertNotIn('X-Cache', res.headers)
+        self.assertNotIn('ETag', res.headers)
+
+    def test_error_400_malformed_since(self):
+        """Test a malformed since cursor."""
+        res = self.client().get('/movies?since=abc', headers=self.header)
+        self.assertEqual(res.status_code, 400)
+
+    def test_error_410_expired_since(self):
+        """Test a cursor older than the tombstone retention."""
+        old = datetime.utcnow() - timedelta(days=31)
+        res = self.client().get(
+            '/actors?since=' + encode_since(None, (old, 0)),
+            headers=self.auth_header('read:actors'))
+        self.assertEqual(res.status_code, 410)
+
+
+# ----------------------------------------------------------------------------#
+# Tests for the change feed
+# ----------------------------------------------------------------------------#
+
+
+class ChangeFeedTestCase(OfflineAppTestCase):
+    transactional = False
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['CHANGES_HEARTBEAT_SECONDS'] = 0.05
+        self.app.config['CHANGES_MAX_STREAM_SECONDS'] = 1
+        self.header = self.auth_header(
+            'read:movies', 'read:actors', 'write:movies', 'write:actors')
+
+    def subscribe(self, path='/changes', **headers):
+        """opens the stream and returns its chunk iterator after retry"""
+        res = self.client().get(path, headers=dict(self.header, **headers),
+                                buffered=False)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        chunks = iter(res.response)
+        self.assertEqual(next(chunks), b'retry: 1000\n\n')
+        self.addCleanup(res.close)
+        return chunks
+
+    def next_event(self, chunks):
+        """returns the next event as a dict of its fields"""
+        for chunk in chunks:
+            if chunk.startswith(b':'):
+                continue
+            fields = dict(line.split(': ', 1) for line in
+                          chunk.decode('utf-8').strip().split('\n'))
+            fields['data'] = json.loads(fields['data'])
+            return fields
+        self.fail('stream ended')
+
+    def add_movie(self, title):
+        self.client().post('/movies/bulk', json=[{
+            'title': title, 'release_date': '2020-01-01'}],
+            headers=self.header)
+
+    def test_write_is_pushed(self):
+        """Test a write reaches an open stream."""
+        chunks = self.subscribe()
+        self.add_movie('Pushed')
+        event = self.next_event(chunks)
+
+        self.assertEqual(event['event'], 'movies')
+        self.assertEqual(event['data']['action'], 'insert')
+        self.assertEqual(event['data']['rows'][0]['title'], 'Pushed')
+
+    def test_tables_filter(self):
+        """Test ?tables= only streams the given tables."""
+        chunks = self.subscribe('/changes?tables=actors')
+        self.add_movie('Ignored')
+        self.client().post('/actors/bulk', json=[{
+            'name': 'Kept', 'gender': 'Male'}], headers=self.header)
+        self.assertEqual(self.next_event(chunks)['event'], 'actors')
+
+    def test_resume_with_last_event_id(self):
+        """Test reconnecting with Last-Event-ID replays missed events."""
+        chunks = self.subscribe()
+        self.add_movie('First')
+        first = self.next_event(chunks)['id']
+        self.add_movie('Second')
+        self.add_movie('Third')
+
+        chunks = self.subscribe(**{'Last-Event-ID': first})
+        self.assertEqual(
+            [self.next_event(chunks)['data']['rows'][0]['title']
+             for _ in range(2)], ['Second', 'Third'])
+
+    def test_unknown_last_event_id(self):
+        """Test an id that is no longer kept asks the client to resync."""
+        chunks = self.subscribe(**{'Last-Event-ID': 'gone'})
+        event = self.next_event(chunks)
+        self.assertEqual(event['event'], 'reset')
+        self.assertEqual(event['data'], {'reason': 'unknown_id'})
+
+    def test_slow_subscriber_is_reset(self):
+        """Test a full subscriber queue is dropped for a reset event."""
+        self.app.config['CHANGES_QUEUE_SIZE'] = 2
+        changes.init_app(self.app)
+        chunks = self.subscribe()
+        for i in range(3):
+            self.add_movie(f'Movie {i}')
+
+        event = self.next_event(chunks)
+        self.assertEqual(event['data'], {'reason': 'overflow'})
+        self.assertEqual(changes.feed.stats()['resets'], 1)
+
+    def test_stream_ends(self):
+        """Test the stream ends after CHANGES_MAX_STREAM_SECONDS."""
+        self.app.config['CHANGES_MAX_STREAM_SECONDS'] = 0.1
+        chunks = self.subscribe()
+        self.assertTrue(all(chunk == b': keepalive\n\n' for chunk in chunks))
+        self.assertEqual(changes.feed.stats()['subscribers'], 0)
+
+    def test_error_401_changes_without_both_permissions(self):
+        """Test the feed requires read:movies and read:actors."""
+        res = self.client().get(
+            '/changes', headers=self.auth_header('read:movies'))
+        self.assertEqual(res.status_code, 401)
+
+    def test_error_400_unknown_table(self):
+        """Test an unknown ?tables= name."""
+        res = self.client().get('/changes?tables=movies,users',
+                                headers=self.header)
+        self.assertEqual(res.status_code, 400)
+
+    def test_failed_listener_keeps_the_write(self):
+        """Test a listener failing after the commit doesn't fail the write.
+        """
+        def fail(tablename, action, rows):
+            raise RuntimeError('listener down')
+        with mock.patch('models._change_listeners', [fail]), \
+                self.assertLogs('casting.models', 'ERROR'):
+            res = self.client().post('/movies/bulk', json=[{
+                'title': 'Kept', 'release_date': '2020-01-01'}],
+                headers=self.header)
+
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(Movies.query.filter_by(title='Kept').count(), 1)
+
+    def test_write_listener_commits_with_the_write(self):
+        """Test write listeners run in the write transaction, before the
+        change listeners.
+        """
+        calls = []
+
+        def record(tablename, action, rows):
+            calls.append(('write', db.session.query(Movies.id)
+                          .filter_by(title=rows[0]['title']).count()))
+
+        def fail(tablename, action, rows):
+            raise RuntimeError('NOTIFY failed')
+        with mock.patch('models._write_listeners', [record]), \
+                mock.patch('models._change_listeners',
+                           [lambda *change: calls.append(('change',))]):
+            self.add_movie('Sent')
+        self.assertEqual(calls, [('write', 1), ('change',)])
+
+        with mock.patch('models._write_listeners', [fail]):
+            res = self.client().post('/movies/bulk', json=[{
+                'title': 'Rolled back', 'release_date': '2020-01-01'}],
+                headers=self.header)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(
+            Movies.query.filter_by(title='Rolled back').count(), 0)
+
+    def test_notify_payloads_are_split(self):
+        """Test large writes are split into payloads NOTIFY accepts."""
+        rows = [{'id': i, 'name': 'x' * 70} for i in range(500)]
+        payloads = _payloads('insert', rows)
+        self.assertGreater(len(payloads), 1)
+        self.assertTrue(all(len(payload) <= MAX_PAYLOAD
+                            for payload in payloads))
+        self.assertEqual(
+            sum(len(json.loads(payload)['rows']) for payload in payloads),
+            500)
+
+
+# ----------------------------------------------------------------------------#
+# Tests for the connection pool
+# ----------------------------------------------------------------------------#
+
+
+class PoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def make_engine(self, **options):
+        engine = create_engine(
+            'sqlite:///' + os.path.join(self.tmpdir, 'pool.db'),
+            poolclass=TimedQueuePool.with_stats(PoolStats(slow_ms=50)),
+            connect_args={'check_same_thread': False}, **options)
+        self.addCleanup(engine.dispose)
+        return engine
+
+    def test_checkout_wait_and_timeout(self):
+        """Test an exhausted pool records the wait and the timeout."""
+        engine = self.make_engine(pool_size=1, max_overflow=0,
+                                  pool_timeout=0.1)
+        connection = engine.connect()
+        stats = pool_stats(engine)
+        self.assertEqual((stats['checked_out'], stats['saturation']),
+                         (1, 1.0))
+
+        with self.assertLogs('casting.pool', 'WARNING'):
+            with self.assertRaises(exc.TimeoutError):
+                engine.connect()
+        connection.close()
+
+        stats = pool_stats(engine)
+        self.assertEqual((stats['checkouts'], stats['timeouts']), (1, 1))
+        self.assertGreaterEqual(stats['wait_max_ms'], 100)
+        self.assertEqual(stats['checked_out'], 0)
+
+    def test_stats_survive_dispose(self):
+        """Test engine.dispose() keeps the counters."""
+        engine = self.make_engine(pool_size=1)
+        engine.connect().close()
+        engine.dispose()
+        engine.connect().close()
+        self.assertEqual(pool_stats(engine)['checkouts'], 2)
+
+    def test_inherited_connections_are_replaced(self):
+        """Test a connection opened by another process isn't reused."""
+        engine = self.make_engine(pool_size=1)
+        guard_fork(engine)
+        connection = engine.connect()
+        first = connection.connection.connection
+        connection.close()
+
+        with mock.patch('pool.os.getpid', return_value=-1):
+            connection = engine.connect()
+        self.assertIsNot(connection.connection.connection, first)
+        connection.close()
+
+    def test_engine_options(self):
+        """Test the DB_* settings become engine options."""
+        config = {
+            'DB_POOL_PRE_PING': True, 'DB_POOL_SIZE': 3,
+            'DB_MAX_OVERFLOW': 2, 'DB_POOL_TIMEOUT': 1,
+            'DB_POOL_RECYCLE': 60, 'DB_STATEMENT_TIMEOUT_MS': 500,
+            'DB_POOL_SLOW_CHECKOUT_MS': 100
+        }
+        self.assertEqual(engine_options(config, 'sqlite:////tmp/c.db'),
+                         {'pool_pre_ping': True})
+        self.assertIs(engine_options(config, 'sqlite://')['poolclass'],
+                      StaticPool)
+        options = engine_options(config, 'postgres://localhost/casting')
+        self.assertEqual((options['pool_size'], options['max_overflow'],
+                          options['pool_recycle']), (3, 2, 60))
+        self.assertEqual(options['connect_args'],
+                         {'options': '-c statement_timeout=500'})
+
+
+class HealthTestCase(OfflineAppTestCase):
+
+    def test_health(self):
+        """Test GET health reports the pool, cache and feed."""
+        res = self.client().get('/health')
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data), {'success', 'database', 'cache',
+                                     'changes', 'replicas', 'autocomplete'})
+
+
+# ----------------------------------------------------------------------------#
+# Tests for read replica routing
+# ----------------------------------------------------------------------------#
+
+
+class ReplicaTestCase(OfflineAppTestCase):
+    transactional = False
+
+    def setUp(self):
+        super().setUp()
+        self.replica_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.replica_dir)
+        self.add_movie(db.engine, 'Primary')
+        self.use_replicas('one', 'two')
+        self.header = self.auth_header('read:movies', 'write:movies')
+
+    def use_replicas(self, *names):
+        """points DATABASE_REPLICA_URLS at stand-in SQLite databases
+        holding one movie called after the database
+        """
+        urls = []
+        for name in names:
+            url = 'sqlite:///' + os.path.join(self.replica_dir, name + '.db')
+            engine = create_engine(url)
+            db.Model.metadata.create_all(engine)
+            self.add_movie(engine, name)
+            engine.dispose()
+            urls.append(url)
+        self.app.config['DATABASE_REPLICA_URLS'] = urls
+        replicas.init_app(self.app)
+
+    def add_movie(self, engine, title):
+        engine.execute(Movies.__table__.insert(), {
+            'title': title, 'release_date': date(2000, 1, 1)})
+
+    def title(self, path='/movies'):
+        res = self.client().get(path, headers=self.header)
+        self.assertEqual(res.status_code, 200)
+        return res.get_json()['movies'][0]['title']
+
+    def test_reads_round_robin(self):
+        """Test GET movies alternates between the replicas."""
+        self.assertEqual(
+            set([self.title('/movies?limit=1'),
+                 self.title('/movies?limit=2')]),
+            {'one', 'two'})
+
+    def test_recent_write_reads_primary(self):
+        """Test reads of a table just written to go to the primary."""
+        self.client().post('/movies/bulk', json=[{
+            'title': 'Written', 'release_date': '2020-01-01'}],
+            headers=self.header)
+        self.assertEqual(self.title('/movies?sort=-release_date'), 'Written')
+
+    def test_recent_write_streams_from_primary(self):
+        """Test streamed reads of a table just written to go to the
+        primary."""
+        self.client().post('/movies/bulk', json=[{
+            'title': 'Written', 'release_date': '2020-01-01'}],
+            headers=self.header)
+        res = self.client().get('/movies?stream=1', headers=self.header)
+        self.assertIn('Written', [
+            movie['title'] for movie in
+            json.loads(res.get_data(as_text=True))['movies']])
+
+    def test_write_of_another_worker_reads_primary(self):
+        """Test a write committed outside this process keeps reads on the
+        primary."""
+        db.session.execute(Movies.__table__.insert(), {
+            'title': 'Written', 'release_date': date(2020, 1, 1)})
+        _touch('movies')
+        db.session.commit()
+        self.assertEqual(self.title('/movies?sort=-release_date'), 'Written')
+
+    def test_recheck_runs_in_background(self):
+        """Test a due replica check runs once, off the request thread."""
+        self.use_replicas('three')
+        self.assertEqual(self.title(), 'three')
+        replica = self.app.extensions['replicas']['replicas'][0]
+        threads = []
+
+        def check(replica, state):
+            threads.append(threading.current_thread())
+            time.sleep(0.1)
+        with mock.patch.object(replicas, '_check', check), \
+                mock.patch.object(replicas, 'clock',
+                                  lambda: time.monotonic() + 60):
+            for limit in range(1, 4):
+                self.assertEqual(self.title(f'/movies?limit={limit}'),
+                                 'three')
+            with replica.lock:
+                pass
+
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_since_reads_primary(self):
+        """Test delta syncs always read the primary."""
+        self.app.config['SYNC_SETTLE_SECONDS'] = 0
+        self.assertEqual(self.title('/movies?since=0'), 'Primary')
+
+    def test_unhealthy_replica_is_skipped(self):
+        """Test a replica that can't be reached falls back."""
+        self.app.config['DATABASE_REPLICA_URLS'] = [
+            'sqlite:///' + os.path.join(self.replica_dir, 'missing', 'x.db')]
+        replicas.init_app(self.app)
+
+        self.assertEqual(self.title(), 'Primary')
+        res = self.client().get('/health')
+        self.assertEqual([replica['healthy'] for replica in
+                          res.get_json()['replicas']], [False])
+
+    def test_no_replicas(self):
+        """Test reads use the primary without DATABASE_REPLICA_URLS."""
+        self.use_replicas()
+        self.assertEqual(self.title(), 'Primary')
+
+
+# ----------------------------------------------------------------------------#
+# Tests for startup
+# ----------------------------------------------------------------------------#
+
+
+class StartupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'startup.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_import_creates_nothing(self):
+        """Test importing the app opens no database and needs no Auth0."""
+        env = {key: value for key, value in os.environ.items()
+               if key not in ('AUTH0_DOMAIN', 'ALGORITHMS', 'API_AUDIENCE')}
+        env['DATABASE_URL'] = 'sqlite:///' + self.path
+        result = subprocess.run(
+            [sys.executable, '-c',
+             'import sys, app; '
+             'assert not hasattr(app, "app"); '
+             'assert "jose" not in sys.modules'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+            capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_setup_db_runs_no_ddl(self):
+        """Test setup_db leaves the schema to the migrations."""
+        app = Flask(__name__)
+        setup_db(app, 'sqlite:///' + self.path)
+        with app.app_context():
+            self.assertEqual(inspect(db.engine).get_table_names(), [])
+
+    def test_setup_db_default_url(self):
+        """Test setup_db falls back to the url of the Config class."""
+        app = Flask(__name__)
+        setup_db(app)
+        self.assertEqual(app.config['SQLALCHEMY_DATABASE_URI'],
+                         os.environ['DATABASE_URL'])
+
+
+# ----------------------------------------------------------------------------#
+# Tests for the ASGI entry point
+# ----------------------------------------------------------------------------#
+
+
+class AsgiTestCase(OfflineAppTestCase):
+    transactional = False
+
+    def setUp(self):
+        super().setUp()
+        self.asgi = WsgiToAsgi(self.app, 2)
+        self.addCleanup(lambda: self.asgi.executor and
+                        self.asgi.executor.shutdown())
+
+    def request(self, method, path, headers=None, body=b'', chunks=None,
+                root_path=''):
+        """returns (status, headers, body) of a request to the ASGI app
+            chunks: the client disconnects after this many body chunks
+            root_path: the prefix the app is mounted under
+        """
+        path, _, query = path.partition('?')
+        scope = {
+            'type': 'http', 'method': method, 'path': root_path + path,
+            'root_path': root_path,
+            'query_string': query.encode('latin-1'), 'http_version': '1.1',
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in (headers or {}).items()]
+        }
+        sent = []
+
+        async def run():
+            disconnected = asyncio.Event()
+            requests = [{'type': 'http.request', 'body': body[:5],
+                         'more_body': True},
+                        {'type': 'http.request', 'body': body[5:]}]
+
+            async def receive():
+                if requests:
+                    return requests.pop(0)
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+                if (chunks is not None and
+                        message['type'] == 'http.response.body' and
+                        len(sent) > chunks):
+                    disconnected.set()
+                    await asyncio.sleep(0.01)
+
+            await self.asgi(scope, receive, send)
+
+        asyncio.run(run())
+        start = sent[0]
+        return (start['status'], dict(start['headers']),
+                b''.join(message.get('body', b'') for message in sent[1:]))
+
+    def test_get_matches_wsgi(self):
+        """Test a GET returns the body and headers of the Flask app."""
+        self.seed(3)
+        headers = self.auth_header('read:movies')
+        status, sent, body = self.request('GET', '/movies?limit=2', headers)
+        res = self.client().get('/movies?limit=2', headers=headers)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(sent[b'content-type'], b'application/json')
+        self.assertEqual(json.loads(body), res.get_json())
+
+    def test_mounted_under_root_path(self):
+        """Test an app mounted under a prefix routes the path after it."""
+        self.seed(3)
+        headers = self.auth_header('read:movies')
+        status, _, body = self.request('GET', '/movies?limit=2', headers,
+                                       root_path='/api')
+        res = self.client().get('/movies?limit=2', headers=headers)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), res.get_json())
+
+    def test_post_body(self):
+        """Test a request body sent in several messages is read whole."""
+        status, _, body = self.request(
+            'POST', '/actors', dict(self.auth_header('write:actors'),
+                                    **{'Content-Type': 'application/json'}),
+            json.dumps({'name': 'Async Actor', 'gender': 'Female'})
+            .encode('utf-8'))
+        self.assertIn(status, (200, 201))
+        self.assertEqual(Actors.query.one().name, 'Async Actor')
+
+    def test_error_handlers(self):
+        """Test the Flask error handlers answer through ASGI."""
+        status, _, body = self.request('GET', '/movies')
+        self.assertEqual(status, 401)
+        self.assertFalse(json.loads(body)['success'])
+
+        status, _, body = self.request(
+            'GET', '/movies/999', self.auth_header('read:movies'))
+        self.assertEqual(status, 404)
+
+    def test_disconnect_closes_stream(self):
+        """Test a client going away ends its GET /changes stream."""
+        self.app.config['CHANGES_HEARTBEAT_SECONDS'] = 0.01
+        status, _, body = self.request(
+            'GET', '/changes',
+            self.auth_header('read:movies', 'read:actors'), chunks=2)
+
+        self.assertEqual(status, 200)
+        self.assertTrue(body.startswith(b'retry: 1000\n\n'))
+        with self.app.app_context():
+            self.assertEqual(changes.feed.stats()['subscribers'], 0)
+
+    def test_lifespan(self):
+        """Test startup fetches the signing keys off the event loop."""
+        sent = []
+
+        async def run():
+            messages = [{'type': 'lifespan.startup'},
+                        {'type': 'lifespan.shutdown'}]
+
+            async def receive():
+                if len(messages) == 1:
+                    # give the key fetch a chance before shutting down
+                    await asyncio.sleep(0.2)
+                return messages.pop(0)
+
+            async def send(message):
+                sent.append(message['type'])
+
+            await self.asgi({'type': 'lifespan'}, receive, send)
+
+        asyncio.run(run())
+        self.assertEqual(sent, ['lifespan.startup.complete',
+                                'lifespan.shutdown.complete'])
+        self.assertEqual(self.cache.fetches, 1)
+
+    def test_threads_follow_pool(self):
+        """Test the thread count defaults to the pool capacity."""
+        asgi_app = create_asgi_app()
+        self.assertEqual(asgi_app.threads,
+                         asgi_app.wsgi_app.config['DB_POOL_SIZE'] +
+                         asgi_app.wsgi_app.config['DB_MAX_OVERFLOW'])
+
+
+# ----------------------------------------------------------------------------#
+# Tests for GET /metrics
+# ----------------------------------------------------------------------------#
+
+
+class MetricsTestCase(OfflineAppTestCase):
+
+    def metrics(self):
+        res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        return res.get_data(as_text=True).splitlines()
+
+    def test_request_counted_by_route_and_status(self):
+        """Test requests are counted by URL rule, method and status."""
+        self.seed(2)
+        self.client().get('/movies/1', headers=self.auth_header('read:movies'))
+        self.client().get('/movies/2', headers=self.auth_header('read:movies'))
+        self.client().get('/movies/1')
+        lines = self.metrics()
+
+        self.assertIn('http_request_duration_seconds_count{method="GET",'
+                      'route="/movies/<int:movie_id>",status="200"} 2', lines)
+        self.assertIn('http_request_duration_seconds_count{method="GET",'
+                      'route="/movies/<int:movie_id>",status="401"} 1', lines)
+        self.assertIn('http_request_duration_seconds_bucket{method="GET",'
+                      'route="/movies/<int:movie_id>",status="200",'
+                      'le="+Inf"} 2', lines)
+
+    def test_phases(self):
+        """Test the auth, database and serialization phases are timed."""
+        self.seed(2)
+        self.client().get('/movies', headers=self.auth_header('read:movies'))
+        text = '\n'.join(self.metrics())
+
+        for phase in ('auth_header', 'verify_jwt', 'permissions', 'db',
+                      'serialize'):
+            self.assertIn('http_request_phase_seconds_count{'
+                          f'phase="{phase}",route="/movies"}} 1', text)
+
+    def test_unmatched_route(self):
+        """Test requests for unknown paths share one label."""
+        self.client().get('/no/such/path')
+        self.assertIn('http_request_duration_seconds_count{method="GET",'
+                      'route="unmatched",status="404"} 1', self.metrics())
+
+
+class MmapValuesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_processes_are_summed(self):
+        """Test the values of every worker process are added up."""
+        values = MmapValues(self.tmpdir)
+        values.add('requests', 1.0)
+        pid = os.fork()
+        if pid == 0:
+            values.add('requests', 2.0)
+            values.add('errors', 1.0)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        values.add('requests', 4.0)
+
+        self.assertEqual(dict(values.items()),
+                         {'requests': 7.0, 'errors': 1.0})
+        self.assertEqual(len(os.listdir(self.tmpdir)), 2)
+
+    def test_file_grows(self):
+        """Test a file outgrowing its initial size is remapped."""
+        values = MmapValues(self.tmpdir)
+        values.initial_size = 64
+        for i in range(50):
+            values.add(f'key {i}', i)
+
+        self.assertEqual(dict(values.items()),
+                         {f'key {i}': float(i) for i in range(50)})
+
+    def test_histogram_rendered_cumulative(self):
+        """Test the buckets are rendered cumulative with sum and count."""
+        registry = Registry(MmapValues(self.tmpdir))
+        for seconds in (0.003, 0.003, 0.2, 30):
+            registry.observe('http_request_duration_seconds',
+                             {'route': '/movies'}, seconds)
+        lines = registry.render().splitlines()
+
+        self.assertIn('# TYPE http_request_duration_seconds histogram', lines)
+        for le, count in [('0.005', 2), ('0.1', 2), ('0.25', 3),
+                          ('10.0', 3), ('+Inf', 4)]:
+            self.assertIn('http_request_duration_seconds_bucket{'
+                          f'route="/movies",le="{le}"}} {count}', lines)
+        self.assertIn('http_request_duration_seconds_sum{route="/movies"} '
+                      '30.206', lines)
+
+
+# ----------------------------------------------------------------------------#
+# Tests for the SQL instrumentation
+# ----------------------------------------------------------------------------#
+
+
+class SQLTraceTestCase(OfflineAppTestCase):
+
+    def test_server_timing(self):
+        """Test the query count and time are sent as Server-Timing."""
+        self.seed(2)
+        res = self.client().get('/movies/1',
+                                headers=self.auth_header('read:movies'))
+        header = res.headers['Server-Timing']
+
+        self.assertRegex(header, r'^db;dur=\d+\.\d;desc="\d+ queries"$')
+
+    def test_server_timing_disabled(self):
+        """Test SQL_SERVER_TIMING turns the header off."""
+        self.app.config['SQL_SERVER_TIMING'] = False
+        res = self.client().get('/movies',
+                                headers=self.auth_header('read:movies'))
+        self.assertNotIn('Server-Timing', res.headers)
+
+    def test_slow_query_logged_without_values(self):
+        """Test slow queries are logged with their parameter types only."""
+        self.seed(2)
+        self.app.config['SQL_SLOW_QUERY_MS'] = 0
+        with self.assertLogs('casting.sql', 'WARNING') as logs:
+            Movies.query.filter(Movies.title == 'Movie 001').all()
+
+        select, = [line for line in logs.output if 'SELECT' in line]
+        self.assertIn("'str'", select.split('parameters')[1])
+        self.assertNotIn('Movie 001', select)
+
+    def test_repeated_statement_flagged(self):
+        """Test reading Actors.movies actor by actor is flagged as N+1."""
+        self.seed(6)
+        with self.app.test_request_context('/actors'):
+            with self.assertLogs('casting.sql', 'WARNING') as logs:
+                for actor in Actors.query.all():
+                    actor.movies
+                self.app.process_response(self.app.response_class())
+
+        self.assertIn('6 identical queries in GET /actors', logs.output[0])
+
+    def test_list_within_budget(self):
+        """Test listing movies with their actors runs a fixed query count."""
+        self.seed(20)
+        headers = self.auth_header('read:movies')
+        with query_budget(3):
+            res = self.client().get('/movies?include=actors&limit=20',
+                                    headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_budget_exceeded(self):
+        """Test query_budget fails a block over its budget."""
+        self.seed(3)
+        with self.assertRaises(AssertionError) as raised:
+            with query_budget(2):
+                for actor in Actors.query.all():
+                    actor.movies
+        self.assertIn('4 queries, over the budget of 2', str(raised.exception))
+
+    def test_parameter_shape(self):
+        """Test the shape of positional and executemany parameters."""
+        self.assertEqual(parameter_shape((1, 'a')), ('int', 'str'))
+        self.assertEqual(parameter_shape([{'id': 1}, {'id': 2}], True),
+                         "2 x {'id': 'int'}")
+
+
+
+# ----------------------------------------------------------------------------#
+# Tests for filtered and sorted GET movies and actors
+# ----------------------------------------------------------------------------#
+
+
+class FilterSortTestCase(OfflineAppTestCase):
+
+    def get(self, path, key, permission):
+        res = self.client().get(path, headers=self.auth_header(permission))
+        self.assertEqual(res.status_code, 200, path)
+        return res.get_json()[key]
+
+    def walk(self, path, key, permission):
+        """follows the next cursors and returns every row"""
+        rows, url = [], path
+        while url:
+            res = self.client().get(url, headers=self.auth_header(permission))
+            data = res.get_json()
+            rows.extend(data[key])
+            url = data['next'] and f'{path}&cursor={data["next"]}'
+        return rows
+
+    def test_filters(self):
+        """Test the filter operators on every kind of column."""
+        self.seed(10)
+        movies = self.get('/movies?release_date[gte]=2000-01-04&'
+                          'release_date[lt]=2000-01-06&sort=release_date',
+                          'movies', 'read:movies')
+        self.assertEqual([Movies.query.get(movie['id']).release_date
+                          for movie in movies],
+                         [date(2000, 1, 4), date(2000, 1, 5)])
+        self.assertEqual(self.get('/movies?title=Movie%20003', 'movies',
+                                  'read:movies')[0]['id'], 4)
+        self.assertEqual(
+            [actor['id'] for actor in self.get('/actors?id[in]=1,3,99',
+                                               'actors', 'read:actors')],
+            [1, 3])
+        actors = self.get('/actors?gender=Female&id[gt]=4', 'actors',
+                          'read:actors')
+        self.assertEqual([actor['id'] for actor in actors], [6, 8, 10])
+
+    def test_walk_multi_key_sort(self):
+        """Test keyset pagination sorted by two keys in two directions."""
+        self.seed(25)
+        movies = self.walk('/movies?limit=4&sort=-release_date,title',
+                           'movies', 'read:movies')
+        keys = [(-Movies.query.get(movie['id']).release_date.toordinal(),
+                 movie['title']) for movie in movies]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(keys), 25)
+
+    def test_walk_filtered(self):
+        """Test keyset pagination of filtered rows."""
+        self.seed(25)
+        actors = self.walk('/actors?limit=3&gender=Female&sort=name',
+                           'actors', 'read:actors')
+        self.assertEqual([actor['gender'] for actor in actors],
+                         ['Female'] * 12)
+        names = [actor['name'] for actor in actors]
+        self.assertEqual(names, sorted(names))
+
+    def test_indexed_sorts(self):
+        """Test which sorts an index returns in order."""
+        def keys(model, *names):
+            return [(getattr(model, name.lstrip('-')), name[0] == '-')
+                    for name in names]
+
+        self.assertTrue(indexed_sort(Movies, keys(Movies, '-release_date',
+                                                  '-id')))
+        self.assertTrue(indexed_sort(Movies, keys(Movies, 'title', 'id')))
+        self.assertFalse(indexed_sort(Movies, keys(Movies, '-release_date',
+                                                   'title', 'id')))
+        self.assertFalse(indexed_sort(Actors, keys(Actors, 'gender', 'id')))
+        self.assertTrue(indexed_sort(Actors, keys(Actors, 'name', 'id'),
+                                     {'gender'}))
+        self.assertTrue(indexed_sort(Actors, keys(Actors, 'id'),
+                                     {'gender'}))
+        self.assertTrue(indexed_sort(Actors, keys(Actors, 'gender'),
+                                     {'gender'}))
+        self.assertTrue(indexed_sort(Actors, keys(Actors, 'id', '-name')))
+        self.assertTrue(indexed_sort(Movies, keys(Movies, '-title',
+                                                  'release_date')))
+        self.assertFalse(indexed_sort(Actors, keys(Actors, 'name', '-id')))
+
+    def test_filter_fields_are_indexed(self):
+        """Test every filter field leads an index."""
+        for model, fields in ((Movies, MOVIE_FILTERS),
+                              (Actors, ACTOR_FILTERS)):
+            leading = set(columns[0] for columns, _ in
+                          _index_orders(model.__table__))
+            self.assertLessEqual(set(fields), leading, model)
+
+    def test_range_filter_reads_the_index(self):
+        """Test a release_date range sorted by release_date is one index
+        range scan.
+        """
+        self.seed(10)
+        plan = self.query_plan(
+            '/movies?release_date[gte]=2000-01-05&sort=-release_date',
+            'read:movies', 'movies')
+        self.assertSortedByIndex(plan, 'ix_movies_release_date_id')
+
+    def test_equal_filter_reads_the_index(self):
+        """Test ?gender= sorted by name reads the gender index in order."""
+        self.seed(10)
+        plan = self.query_plan('/actors?gender=Female&sort=name&limit=3',
+                               'read:actors', 'actors')
+        self.assertSortedByIndex(plan, 'ix_actors_gender_name_id')
+
+    def test_unindexed_sort_is_sorted(self):
+        """Test a sort no index returns in order needs a sort step."""
+        self.seed(10)
+        plan = self.query_plan('/movies?sort=-release_date,title',
+                               'read:movies', 'movies')
+        self.assertTrue('TEMP B-TREE' in plan or 'Sort' in plan, plan)
+
+    def test_error_400_unindexed_sort_in_production(self):
+        """Test unindexed sorts are rejected without ALLOW_UNINDEXED_SORTS.
+        """
+        self.app.config['ALLOW_UNINDEXED_SORTS'] = False
+        header = self.auth_header('read:movies', 'read:actors')
+        for path, status in [('/movies?sort=-release_date,title', 400),
+                             ('/actors?sort=gender', 400),
+                             ('/movies?sort=-release_date', 200),
+                             ('/actors?gender=Male&sort=name', 200),
+                             ('/actors?gender=Male&sort=gender', 200),
+                             ('/actors?sort=id,-name', 200),
+                             ('/actors?gender=Male', 200)]:
+            res = self.client().get(path, headers=header)
+            self.assertEqual(res.status_code, status, path)
+
+    def test_error_400_bad_filters(self):
+        """Test unknown fields and operators, bad values and filtered syncs.
+        """
+        header = self.auth_header('read:movies', 'read:actors')
+        for path in ('/actors?created_at=2020-01-01', '/actors?name[like]=a',
+                     '/movies?release_date[gte]=yesterday', '/actors?id=one',
+                     '/movies?title[gt]=A&since=0', '/actors?sort=name,name',
+                     f'/actors?id={2 ** 63}', f'/actors?id[in]=1,{2 ** 64}'):
+            res = self.client().get(path, headers=header)
+            self.assertEqual(res.status_code, 400, path)
+
+
+# ----------------------------------------------------------------------------#
+# Tests for search
+# ----------------------------------------------------------------------------#
+
+
+class SearchTestCase(OfflineAppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Actors.bulk_insert([
+            {'name': 'Brad Pitt', 'gender': 'Male'},
+            {'name': 'Bradley Cooper', 'gender': 'Male'},
+            {'name': 'Anne Hathaway', 'gender': 'Female'},
+            {'name': 'Pitt Bradford', 'gender': 'Male'}])
+
+    def search(self, path, key, permission):
+        res = self.client().get(path, headers=self.auth_header(permission))
+        self.assertEqual(res.status_code, 200)
+        return [row['name' if key == 'actors' else 'title']
+                for row in res.get_json()[key]]
+
+    def test_search_by_word_prefixes(self):
+        """Test every word of ?q= has to start a word of the name."""
+        self.assertEqual(self.search('/actors/search?q=brad%20pi',
+                                     'actors', 'read:actors'),
+                         ['Brad Pitt', 'Pitt Bradford'])
+        self.assertEqual(self.search('/actors/search?q=HATH',
+                                     'actors', 'read:actors'),
+                         ['Anne Hathaway'])
+        self.assertEqual(self.search('/actors/search?q=hathaways',
+                                     'actors', 'read:actors'), [])
+
+    def test_search_movies_with_fields(self):
+        """Test searching movie titles with ?fields=."""
+        self.seed(12)
+        res = self.client().get('/movies/search?q=movie%20010&fields=title',
+                                headers=self.auth_header('read:movies'))
+        self.assertEqual(res.get_json()['movies'], [{'title': 'Movie 010'}])
+
+    def test_walk_pages(self):
+        """Test following the cursors visits every match once."""
+        self.seed(25)
+        rows, url = [], '/actors/search?q=actor&limit=10'
+        while url:
+            res = self.client().get(
+                url, headers=self.auth_header('read:actors'))
+            data = res.get_json()
+            rows.extend(data['actors'])
+            url = data['next'] and (
+                f'/actors/search?q=actor&limit=10&cursor={data["next"]}')
+        self.assertEqual(len(set(row['id'] for row in rows)), 25)
+
+    def test_walk_pages_of_ties(self):
+        """Test pages that end within rows of the same rank, on every
+        database TEST_DATABASE_URL points to."""
+        Actors.bulk_insert([{'name': 'Tied Actor', 'gender': 'Male'}] * 7 +
+                           [{'name': 'Tied Actor Jr', 'gender': 'Male'}] * 5)
+        ids, url = [], '/actors/search?q=tied&limit=3'
+        while url:
+            data = self.client().get(
+                url, headers=self.auth_header('read:actors')).get_json()
+            ids.extend(row['id'] for row in data['actors'])
+            url = data['next'] and (
+                f'/actors/search?q=tied&limit=3&cursor={data["next"]}')
+        self.assertEqual(len(ids), 12)
+        self.assertEqual(len(set(ids)), 12)
+
+    def test_pages_start_after_the_cursor(self):
+        """Test later pages filter on the (rank, id) of the cursor instead
+        of skipping the earlier pages."""
+        self.seed(25)
+        header = self.auth_header('read:actors')
+        cursor = self.client().get('/actors/search?q=actor&limit=10',
+                                   headers=header).get_json()['next']
+        statements = []
+
+        def record(conn, cursor, statement, parameters, *args):
+            statements.append((statement, parameters))
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            res = self.client().get(
+                f'/actors/search?q=actor&limit=10&cursor={cursor}',
+                headers=header)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(len(res.get_json()['actors']), 10)
+        search = [(statement, parameters)
+                  for statement, parameters in statements
+                  if 'actors_search' in statement or
+                  'to_tsvector' in statement]
+        self.assertEqual(len(search), 1)
+        statement, parameters = search[0]
+        # SQLite always sends an OFFSET, it has to be 0
+        if 'OFFSET' in statement:
+            self.assertEqual(parameters[-1], 0)
+
+    def test_index_follows_writes(self):
+        """Test updated and deleted names are searched as they are now."""
+        actor = Actors.query.filter_by(name='Anne Hathaway').one()
+        actor.name = 'Emma Stone'
+        actor.update()
+        Actors.bulk_delete([Actors.query.filter_by(
+            name='Brad Pitt').one().id])
+
+        self.assertEqual(self.search('/actors/search?q=hathaway',
+                                     'actors', 'read:actors'), [])
+        self.assertEqual(self.search('/actors/search?q=stone',
+                                     'actors', 'read:actors'), ['Emma Stone'])
+        self.assertEqual(self.search('/actors/search?q=brad',
+                                     'actors', 'read:actors'),
+                         ['Bradley Cooper', 'Pitt Bradford'])
+
+    def test_search_reads_the_index(self):
+        """Test the search query is answered from the search index."""
+        plan = self.query_plan('/actors/search?q=brad', 'read:actors',
+                               'actors')
+        if db.engine.dialect.name == 'sqlite':
+            self.assertIn('actors_search VIRTUAL TABLE', plan)
+            self.assertNotIn('SCAN actors ', plan + ' ')
+        else:
+            self.assertIn('ix_actors_name_words', plan)
+
+    def test_error_400_bad_search(self):
+        """Test missing words, malformed cursors and cursors of another q."""
+        header = self.auth_header('read:actors')
+        cursor = self.client().get('/actors/search?q=brad&limit=1',
+                                   headers=header).get_json()['next']
+        for query in ('', 'q=', 'q=%21%21', 'q=brad&cursor=garbage',
+                      f'q=pitt&cursor={cursor}'):
+            res = self.client().get(f'/actors/search?{query}',
+                                    headers=header)
+            self.assertEqual(res.status_code, 400, query)
+
+    def test_error_401_search_without_permission(self):
+        """Test searching actors requires read:actors."""
+        res = self.client().get('/actors/search?q=brad',
+                                headers=self.auth_header('read:movies'))
+        self.assertEqual(res.status_code, 401)
+
+
+
+# ----------------------------------------------------------------------------#
+# Tests for autocomplete
+# ----------------------------------------------------------------------------#
+
+
+class PrefixIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = PrefixIndex.build([
+            (1, 'Brad Pitt'), (2, 'Bradley Cooper'), (3, 'Zoë Saldaña'),
+            (4, 'Pitt Bradford'), (5, 'Ann  Ann')], 100)
+
+    def test_word_prefixes(self):
+        """Test every word of a name starts a key, in key order."""
+        self.assertEqual(self.index.lookup('Brad', 10), [
+            (1, 'Brad Pitt'), (4, 'Pitt Bradford'), (2, 'Bradley Cooper')])
+        self.assertEqual(self.index.lookup('brad p', 10), [(1, 'Brad Pitt')])
+        self.assertEqual(self.index.lookup('brad', 2), [
+            (1, 'Brad Pitt'), (4, 'Pitt Bradford')])
+
+    def test_case_accents_and_repeats(self):
+        """Test lookups ignore case and accents, and list a name once."""
+        self.assertEqual(self.index.lookup('ZOE', 10),
+                         [(3, 'Zoë Saldaña')])
+        self.assertEqual(self.index.lookup('salda', 10),
+                         [(3, 'Zoë Saldaña')])
+        self.assertEqual(self.index.lookup('ann', 10), [(5, 'Ann  Ann')])
+
+    def test_add_and_remove(self):
+        """Test a new name replaces the old one and removals."""
+        self.index.add(1, 'Emma Stone')
+        self.index.remove(2)
+        self.index.remove(42)
+        self.assertEqual(self.index.lookup('brad', 10),
+                         [(4, 'Pitt Bradford')])
+        self.assertEqual(self.index.lookup('st', 10), [(1, 'Emma Stone')])
+        self.assertEqual(len(self.index), 8)
+
+    def test_full(self):
+        """Test an index stops taking names at max_entries keys."""
+        index = PrefixIndex.build([(1, 'Brad Pitt'), (2, 'Emma Stone')], 3)
+        self.assertTrue(index.full)
+        index = PrefixIndex.build([(1, 'Brad Pitt')], 3)
+        index.add(2, 'Emma Stone')
+        self.assertTrue(index.full)
+        self.assertEqual(index.lookup('emma', 10), [])
+
+
+class AutocompleteTestCase(OfflineAppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Actors.bulk_insert([
+            {'name': 'Brad Pitt', 'gender': 'Male'},
+            {'name': 'Bradley Cooper', 'gender': 'Male'},
+            {'name': 'Anne Hathaway', 'gender': 'Female'}])
+        Movies.bulk_insert([
+            {'title': 'Bravehearts', 'release_date': date(1995, 5, 24)},
+            {'title': 'Fight Club', 'release_date': date(1999, 10, 15)}])
+
+    def suggest(self, query, *permissions):
+        res = self.client().get(
+            f'/autocomplete?{query}', headers=self.auth_header(
+                *(permissions or ('read:movies', 'read:actors'))))
+        self.assertEqual(res.status_code, 200)
+        return res.get_json()
+
+    def test_suggestions_from_memory(self):
+        """Test suggestions are served without querying the database."""
+        autocomplete.refresh(self.app)
+        with query_budget(0):
+            data = self.suggest('prefix=bra')
+        self.assertEqual(data['actors'], [
+            {'id': 1, 'name': 'Brad Pitt'},
+            {'id': 2, 'name': 'Bradley Cooper'}])
+        self.assertEqual(data['movies'], [{'id': 1, 'title': 'Bravehearts'}])
+        self.assertEqual(self.suggest('prefix=b&limit=1&types=actors'),
+                         {'success': True,
+                          'actors': [{'id': 1, 'name': 'Brad Pitt'}]})
+
+    def test_index_follows_writes(self):
+        """Test inserts, renames and deletes reach the index."""
+        autocomplete.refresh(self.app)
+        Actors(name='Brad Renfro', gender='Male').insert()
+        actor = Actors.query.get(1)
+        actor.name = 'William Bradley Pitt'
+        actor.update()
+        Actors.query.get(2).delete()
+        Actors.bulk_update([{'id': 3, 'gender': 'Male'}])
+
+        self.assertEqual(
+            self.suggest('prefix=brad&types=actors', 'read:actors'),
+            {'success': True, 'actors': [
+                {'id': 4, 'name': 'Brad Renfro'},
+                {'id': 1, 'name': 'William Bradley Pitt'}]})
+        self.assertEqual(
+            self.suggest('prefix=anne&types=actors', 'read:actors')
+            ['actors'], [{'id': 3, 'name': 'Anne Hathaway'}])
+
+    def test_writes_while_reading(self):
+        """Test writes committed while the index is read are applied."""
+        build = PrefixIndex.build
+
+        def build_after_write(rows, max_entries):
+            rows = list(rows)
+            if not Actors.query.filter_by(name='Brad Renfro').count():
+                Actors(name='Brad Renfro', gender='Male').insert()
+            return build(rows, max_entries)
+
+        with mock.patch.object(PrefixIndex, 'build', build_after_write):
+            autocomplete.refresh(self.app)
+        self.assertEqual(
+            [actor['name'] for actor in self.suggest(
+                'prefix=brad&types=actors', 'read:actors')['actors']],
+            ['Brad Pitt', 'Brad Renfro', 'Bradley Cooper'])
+
+    def test_database_until_ready_or_full(self):
+        """Test the search query answers until the index is read, and when
+        it is full.
+        """
+        self.assertEqual(self.suggest('prefix=bra&types=actors',
+                                      'read:actors')['actors'],
+                         [{'id': 1, 'name': 'Brad Pitt'},
+                          {'id': 2, 'name': 'Bradley Cooper'}])
+        self.app.extensions['autocomplete']['actors'].max_entries = 2
+        autocomplete.refresh(self.app)
+        res = self.client().get('/health')
+        self.assertEqual(res.get_json()['autocomplete']['actors'],
+                         {'entries': 2, 'ready': True, 'full': True})
+        self.assertEqual(len(self.suggest('prefix=bra&types=actors',
+                                          'read:actors')['actors']), 2)
+
+    def test_error_400_bad_arguments(self):
+        """Test a missing prefix and unknown types."""
+        header = self.auth_header('read:movies', 'read:actors')
+        for query in ('', 'prefix=%20', 'prefix=a&types=castings'):
+            res = self.client().get(f'/autocomplete?{query}', headers=header)
+            self.assertEqual(res.status_code, 400, query)
+
+    def test_error_401_without_permission(self):
+        """Test suggesting actors requires read:actors."""
+        res = self.client().get('/autocomplete?prefix=bra',
+                                headers=self.auth_header('read:movies'))
+        self.assertEqual(res.status_code, 401)
+        res = self.client().get('/autocomplete?prefix=bra')
+        self.assertEqual(res.status_code, 401)
+
+    def test_failed_read_backs_off(self):
+        """Test an index whose read failed is not read again before
+        AUTOCOMPLETE_RETRY_SECONDS."""
+        table_index = autocomplete.indexes['actors']
+        with mock.patch.object(PrefixIndex, 'build', side_effect=OSError):
+            with self.assertRaises(OSError):
+                table_index.build(100)
+        self.assertIsNone(table_index.index)
+        self.assertFalse(table_index.due(300, 30))
+
+        later = time.monotonic() + 31
+        with mock.patch('autocomplete.time.monotonic', return_value=later):
+            self.assertTrue(table_index.due(300, 30))
+            self.assertFalse(table_index.due(300, 30))
+
+    def test_one_read_per_retry_interval(self):
+        """Test requests waiting for an index start one read between
+        them."""
+        self.app.config['AUTOCOMPLETE_BACKGROUND_BUILD'] = True
+        with mock.patch.object(autocomplete, 'start') as start:
+            for _ in range(5):
+                self.suggest('prefix=bra&types=actors')
+        self.assertEqual(start.call_count, 1)
+
+
+class AutocompleteBackgroundTestCase(OfflineAppTestCase):
+    # the index is read in another thread, on its own connection
+    transactional = False
+
+    def test_read_at_first_request(self):
+        """Test the first request starts reading the index."""
+        Actors(name='Brad Pitt', gender='Male').insert()
+        self.app.config['AUTOCOMPLETE_BACKGROUND_BUILD'] = True
+        autocomplete.init_app(self.app)
+        self.client().get('/health')
+        for _ in range(100):
+            status = self.client().get('/health').get_json()['autocomplete']
+            if status['actors']['ready'] and status['movies']['ready']:
+                break
+            time.sleep(0.05)
+        self.assertEqual(status['actors'],
+                         {'entries': 2, 'ready': True, 'full': False})
+
+
 if __name__ == '__main__':
     unittest.main()